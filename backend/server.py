@@ -1,5 +1,6 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Response, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Response, Request, BackgroundTasks, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
@@ -7,9 +8,10 @@ import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Set
 import uuid
 from datetime import datetime, timezone, timedelta
+from zoneinfo import ZoneInfo
 import jwt
 from passlib.context import CryptContext
 import requests
@@ -18,15 +20,235 @@ import json
 import re
 import secrets
 from fastapi import File, UploadFile
-import base64
+import hashlib
+import hmac
+import tempfile
+import multiprocessing
+import threading
+from contextvars import ContextVar
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
+import bisect
+import heapq
+import random
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import Counter, deque, OrderedDict
+from functools import partial, wraps
+from math import radians, degrees, sin, cos, atan2, ceil, exp, log
+from pymongo import UpdateOne, ReturnDocument, monitoring
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError
+from cachetools import TTLCache
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from thumbnails import render_thumbnail
 
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# MongoDB command monitoring
+DB_SLOW_COMMAND_MS = float(os.environ.get('DB_SLOW_COMMAND_MS', '100'))
+DB_QUERY_BUDGET = int(os.environ.get('DB_QUERY_BUDGET', '10'))
+DB_DEBUG_HEADERS = os.environ.get('DB_DEBUG_HEADERS', 'false').lower() == 'true'
+
+# Driver-internal commands that say nothing about handler behaviour
+UNMONITORED_COMMANDS = {"hello", "ismaster", "isMaster", "saslStart", "saslContinue", "ping", "endSessions", "killCursors"}
+
+# Where each command keeps its filter
+COMMAND_FILTER_FIELDS = {"find": "filter", "count": "query", "distinct": "query", "findAndModify": "query", "aggregate": "pipeline"}
+
+class QueryStats:
+    """Mongo commands issued on behalf of one request (updated from Motor's executor threads)"""
+    
+    def __init__(self):
+        self.count = 0
+        self.duration_ms = 0.0
+        self.by_target: Dict[str, int] = {}
+        self.lock = threading.Lock()
+    
+    def record(self, target: str, duration_ms: float):
+        with self.lock:
+            self.count += 1
+            self.duration_ms += duration_ms
+            self.by_target[target] = self.by_target.get(target, 0) + 1
+
+# Motor copies the caller's context into its executor threads, so listeners see the request's stats
+request_query_stats: ContextVar[Optional[QueryStats]] = ContextVar('request_query_stats', default=None)
+
+# Request tracing; off (and free) unless a sample rate or a latency threshold is set
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0'))
+TRACE_SLOW_MS = float(os.environ.get('TRACE_SLOW_MS', '0'))  # keep every trace at least this slow
+TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', 'file')  # "file" or "otlp"
+TRACE_FILE = os.environ.get('TRACE_FILE', str(ROOT_DIR / 'traces.jsonl'))
+TRACE_FILE_MAX_BYTES = int(os.environ.get('TRACE_FILE_MAX_BYTES', str(50 * 1024 * 1024)))
+TRACE_FILE_BACKUPS = 5
+TRACE_OTLP_ENDPOINT = os.environ.get('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+TRACE_MAX_SPANS = 500  # per trace, so an N+1 request cannot grow a trace without bound
+TRACE_QUEUE_SIZE = 1000
+TRACE_BATCH_SIZE = 100
+TRACING_ENABLED = TRACE_SAMPLE_RATE > 0 or TRACE_SLOW_MS > 0
+
+class Trace:
+    """Finished spans of one request; DB spans are appended from Motor's executor threads"""
+    
+    def __init__(self, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans: List[Dict] = []
+        self.dropped_spans = 0
+        self.closed = False
+    
+    def add_span(self, name: str, span_id: str, parent_id: Optional[str], start_ns: int, end_ns: int,
+                 attributes: Dict, error: Optional[str] = None):
+        if self.closed:
+            return
+        if len(self.spans) >= TRACE_MAX_SPANS and parent_id is not None:
+            self.dropped_spans += 1
+            return
+        self.spans.append({
+            "span_id": span_id,
+            "parent_id": parent_id,
+            "name": name,
+            "start_ns": start_ns,
+            "end_ns": end_ns,
+            "attributes": attributes,
+            "error": error
+        })
+
+def new_span_id() -> str:
+    return f"{random.getrandbits(64):016x}"
+
+class Span:
+    __slots__ = ("trace", "name", "attributes", "span_id", "parent_id", "start_ns", "token")
+    
+    def __init__(self, trace: Trace, name: str, attributes: Dict, parent_id: Optional[str] = None):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+        self.span_id = new_span_id()
+        self.parent_id = parent_id
+    
+    def set(self, key: str, value):
+        self.attributes[key] = value
+    
+    def __enter__(self):
+        self.start_ns = time.time_ns()
+        self.token = current_span.set(self)
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        current_span.reset(self.token)
+        error = None
+        if exc_type is not None:
+            error = f"{exc_type.__name__}: {exc}" if str(exc) else exc_type.__name__
+        self.trace.add_span(self.name, self.span_id, self.parent_id, self.start_ns, time.time_ns(), self.attributes, error)
+        return False
+
+class NoopSpan:
+    """Returned when the current request is not being traced"""
+    
+    def set(self, key: str, value):
+        pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NOOP_SPAN = NoopSpan()
+
+current_span: ContextVar[Optional[Span]] = ContextVar('current_span', default=None)
+
+def trace_span(name: str, **attributes):
+    """Child span of the current span; a shared no-op when the request is not traced"""
+    parent = current_span.get()
+    if parent is None:
+        return NOOP_SPAN
+    return Span(parent.trace, name, attributes, parent.span_id)
+
+def traced(name: str):
+    """Wrap an async function (e.g. a FastAPI dependency) in a span"""
+    def decorator(fn):
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with trace_span(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def query_shape(value):
+    """Filter with every literal replaced by "?" so it can be logged and grouped safely"""
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, list) and any(isinstance(item, dict) for item in value):
+        return [query_shape(item) for item in value]
+    return "?"
+
+def command_filter(command_name: str, command: Dict):
+    if command_name in COMMAND_FILTER_FIELDS:
+        return command.get(COMMAND_FILTER_FIELDS[command_name])
+    if command_name == "update" and command.get('updates'):
+        return command['updates'][0].get('q')
+    if command_name == "delete" and command.get('deletes'):
+        return command['deletes'][0].get('q')
+    return None
+
+class CommandStatsListener(monitoring.CommandListener):
+    """Attributes every command to the current request and logs slow ones with their filter shape"""
+    
+    def __init__(self):
+        self.pending: Dict[tuple, tuple] = {}
+        self.totals: Dict[str, List[float]] = {}  # command -> [count, seconds]
+        self.lock = threading.Lock()
+    
+    def started(self, event):
+        if event.command_name in UNMONITORED_COMMANDS:
+            return
+        self.pending[(event.connection_id, event.request_id)] = (request_query_stats.get(), current_span.get(), event.command)
+    
+    def _finished(self, event, error: Optional[str] = None):
+        entry = self.pending.pop((event.connection_id, event.request_id), None)
+        if entry is None:
+            return
+        stats, parent, command = entry
+        duration_ms = event.duration_micros / 1000
+        collection = command.get(event.command_name)
+        target = f"{event.command_name} {collection}" if isinstance(collection, str) else event.command_name
+        
+        if parent is not None:
+            end_ns = time.time_ns()
+            parent.trace.add_span(f"mongo {target}", new_span_id(), parent.span_id, end_ns - event.duration_micros * 1000, end_ns, {
+                "db.operation": event.command_name,
+                "db.collection": collection if isinstance(collection, str) else None,
+                "db.filter": json.dumps(query_shape(command_filter(event.command_name, command)), default=str)
+            }, error)
+        
+        with self.lock:
+            total = self.totals.setdefault(event.command_name, [0, 0.0])
+            total[0] += 1
+            total[1] += duration_ms / 1000
+        if stats is not None:
+            stats.record(target, duration_ms)
+        
+        if duration_ms >= DB_SLOW_COMMAND_MS:
+            shape = query_shape(command_filter(event.command_name, command))
+            logging.warning(f"Slow Mongo command: {target} took {duration_ms:.1f} ms, filter {json.dumps(shape)}")
+    
+    def succeeded(self, event):
+        self._finished(event)
+    
+    def failed(self, event):
+        self._finished(event, str(event.failure.get('errmsg', 'command failed')))
+
+command_listener = CommandStatsListener()
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True, event_listeners=[command_listener])
 db = client[os.environ['DB_NAME']]
 
 # JWT Configuration
@@ -34,16 +256,115 @@ JWT_SECRET = os.environ.get('JWT_SECRET', 'healer-super-secret-key-change-in-pro
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRATION_HOURS = 720  # 30 days
 
+# Pharmacy/driver ids for callers whose token predates their profile (or cookie sessions)
+SCOPE_CACHE_SIZE = int(os.environ.get('SCOPE_CACHE_SIZE', '10000'))
+SCOPE_CACHE_TTL_SECONDS = int(os.environ.get('SCOPE_CACHE_TTL_SECONDS', '300'))
+
+# Revoked token ids; the in-memory Bloom filter is rebuilt from Mongo every sync interval
+REVOCATION_BLOOM_CAPACITY = int(os.environ.get('REVOCATION_BLOOM_CAPACITY', '100000'))
+REVOCATION_BLOOM_ERROR_RATE = float(os.environ.get('REVOCATION_BLOOM_ERROR_RATE', '0.001'))
+REVOCATION_SYNC_SECONDS = int(os.environ.get('REVOCATION_SYNC_SECONDS', '30'))
+
+# Driver location trail retention
+TRAIL_RAW_RETENTION_DAYS = int(os.environ.get('TRAIL_RAW_RETENTION_DAYS', '7'))
+TRAIL_ARCHIVE_RETENTION_DAYS = int(os.environ.get('TRAIL_ARCHIVE_RETENTION_DAYS', '180'))
+TRAIL_ARCHIVE_DELAY_MINUTES = 60  # wait for late pings before downsampling
+TRAIL_ARCHIVE_TOLERANCE_M = 15.0
+
+# Driver dispatch
+DISPATCH_AUTO_ASSIGN = os.environ.get('DISPATCH_AUTO_ASSIGN', 'false').lower() == 'true'
+DISPATCH_MAX_PICKUP_KM = float(os.environ.get('DISPATCH_MAX_PICKUP_KM', '15'))
+DISPATCH_GRID_CELL_DEG = 0.01  # ~1.1 km cells
+DISPATCH_BATCH_MATCHING = os.environ.get('DISPATCH_BATCH_MATCHING', 'false').lower() == 'true'
+DISPATCH_MATCH_INTERVAL_SECONDS = int(os.environ.get('DISPATCH_MATCH_INTERVAL_SECONDS', '30'))
+DISPATCH_MATCH_MAX_ORDERS = 500
+DISPATCH_MATCH_CANDIDATES = 10  # nearest drivers per order offered to the batch solver
+
+# Multi-order trip batching
+TRIP_BATCHING = os.environ.get('TRIP_BATCHING', 'false').lower() == 'true'
+TRIP_BATCHING_INTERVAL_SECONDS = int(os.environ.get('TRIP_BATCHING_INTERVAL_SECONDS', '60'))
+TRIP_BATCH_WINDOW_MINUTES = 10  # orders placed this close together can share a trip
+TRIP_MAX_ORDERS = 4
+TRIP_MAX_BEARING_SPREAD_DEG = 45.0
+TRIP_MAX_DROP_SPREAD_KM = 3.0
+TRIP_OPEN_MINUTES = 10  # a trip no driver accepts in this time is dissolved and its orders offered singly
+
+# Driver earnings rollups are bucketed by local calendar day/week/month
+EARNINGS_TIMEZONE = ZoneInfo(os.environ.get('EARNINGS_TIMEZONE', 'Asia/Kolkata'))
+EARNINGS_PERIODS = ("day", "week", "month")
+
+# Transactional outbox for order side effects
+OUTBOX_WORKERS = int(os.environ.get('OUTBOX_WORKERS', '4'))
+OUTBOX_PARTITIONS = 16  # events of one aggregate always land in the same partition
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_LEASE_SECONDS = 60
+OUTBOX_APPLIED_WINDOW = 50  # recent event keys remembered on each target document
+
+# OTP / verification code issuance
+CODE_TTL_MINUTES = 10
+CODE_RESEND_COOLDOWN_SECONDS = 30
+CODE_MAX_SENDS = 5
+VERIFIED_RECORD_TTL_MINUTES = 30  # how long a verified code stays usable for the follow-up action
+
+# Collections whose documents stop being valid at expires_at (TTL-indexed)
+EXPIRING_COLLECTIONS = ("sessions", "verification_codes", "password_resets", "revoked_tokens")
+EXPIRED_PURGE_INTERVAL_SECONDS = int(os.environ.get('EXPIRED_PURGE_INTERVAL_SECONDS', '3600'))
+EXPIRED_PURGE_COMPACT = os.environ.get('EXPIRED_PURGE_COMPACT', 'false').lower() == 'true'
+
+# Content-addressed media store (profile pictures, medicine images)
+MEDIA_ROOT = Path(os.environ.get('MEDIA_ROOT', str(ROOT_DIR / 'media')))
+MEDIA_MAX_UPLOAD_BYTES = int(os.environ.get('MEDIA_MAX_UPLOAD_BYTES', str(5 * 1024 * 1024)))
+MEDIA_CHUNK_SIZE = 64 * 1024
+MAX_REQUEST_BYTES = MEDIA_MAX_UPLOAD_BYTES + 64 * 1024  # largest upload plus multipart framing
+MEDIA_EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/webp": "webp",
+    "image/gif": "gif",
+}
+
+# Derived thumbnails: longest edge in pixels per size name
+THUMBNAIL_SIZES = {"sm": 64, "md": 160, "lg": 320}
+THUMBNAIL_FORMATS = {"webp": "WEBP", "jpg": "JPEG"}
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', str(os.cpu_count() or 1)))
+THUMBNAIL_CACHE_MAX_BYTES = int(os.environ.get('THUMBNAIL_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+
+# Notifications (OTP and verification codes)
+NOTIFICATION_EMAIL_PROVIDER = os.environ.get('NOTIFICATION_EMAIL_PROVIDER', 'log')
+NOTIFICATION_SMS_PROVIDER = os.environ.get('NOTIFICATION_SMS_PROVIDER', 'log')
+NOTIFICATION_FILE = os.environ.get('NOTIFICATION_FILE', str(ROOT_DIR / 'notifications.jsonl'))
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_QUEUE_SIZE = 10000
+
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # Razorpay client (will be initialized when keys are provided)
+# RAZORPAY_BASE_URL points the SDK at another host, e.g. scripts/fake_razorpay.py
+RAZORPAY_BASE_URL = os.environ.get('RAZORPAY_BASE_URL')
+PAYMENT_GATEWAY_TIMEOUT_SECONDS = float(os.environ.get('PAYMENT_GATEWAY_TIMEOUT_SECONDS', '10'))
+PAYMENT_GATEWAY_MAX_CONCURRENCY = int(os.environ.get('PAYMENT_GATEWAY_MAX_CONCURRENCY', '16'))
+PAYMENT_GATEWAY_FAILURE_THRESHOLD = int(os.environ.get('PAYMENT_GATEWAY_FAILURE_THRESHOLD', '5'))
+PAYMENT_GATEWAY_RESET_SECONDS = float(os.environ.get('PAYMENT_GATEWAY_RESET_SECONDS', '30'))
+
+# Webhook events are persisted on receipt and applied to orders in batches
+RAZORPAY_WEBHOOK_SECRET = os.environ.get('RAZORPAY_WEBHOOK_SECRET')
+PAYMENT_EVENT_BATCH_SIZE = 500
+PAYMENT_EVENT_LINGER_SECONDS = 0.05
+PAYMENT_EVENT_RETENTION_DAYS = 30
+PAYMENT_RECONCILE_INTERVAL_SECONDS = int(os.environ.get('PAYMENT_RECONCILE_INTERVAL_SECONDS', '300'))
+PAYMENT_RECONCILE_AFTER_MINUTES = int(os.environ.get('PAYMENT_RECONCILE_AFTER_MINUTES', '15'))
+PAYMENT_RECONCILE_WINDOW_HOURS = 48
+PAYMENT_RECONCILE_BATCH_SIZE = 100
+
 razorpay_client = None
 try:
     RAZORPAY_KEY_ID = os.environ.get('RAZORPAY_KEY_ID')
     RAZORPAY_KEY_SECRET = os.environ.get('RAZORPAY_KEY_SECRET')
     if RAZORPAY_KEY_ID and RAZORPAY_KEY_SECRET:
-        razorpay_client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET))
+        client_options = {"base_url": RAZORPAY_BASE_URL} if RAZORPAY_BASE_URL else {}
+        razorpay_client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET), **client_options)
 except Exception as e:
     logging.warning(f"Razorpay client initialization failed: {e}")
 
@@ -99,7 +420,7 @@ class User(BaseModel):
     profile_pic: Optional[str] = None
     reward_points: int = 0
     is_healer_pro: bool = False
-    healer_pro_expires_at: Optional[str] = None
+    healer_pro_expires_at: Optional[datetime] = None
     email_verified: bool = False
     phone_verified: bool = False
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -198,6 +519,7 @@ class Order(BaseModel):
     payment_method: str
     payment_status: str = "pending"
     razorpay_order_id: Optional[str] = None
+    razorpay_payment_id: Optional[str] = None
     distance_km: float = 0.0
     estimated_time: int = 0  # in minutes
     cancellation_charge: float = 0.0
@@ -205,6 +527,10 @@ class Order(BaseModel):
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class AvailableOrder(Order):
+    pickup_distance_km: Optional[float] = None
+    driver_earning: float = 0.0
+
 # Driver Models
 class DriverCreate(BaseModel):
     vehicle_type: str
@@ -230,6 +556,8 @@ class Driver(BaseModel):
     is_available: bool = True
     is_verified: bool = False
     rating: float = 0.0
+    rating_sum: int = 0
+    rating_count: int = 0
     total_earnings: float = 0.0
     total_deliveries: int = 0
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -257,6 +585,25 @@ class DriverEarning(BaseModel):
     state: str
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class TripStop(BaseModel):
+    order_id: str
+    location: Location
+    leg_distance_km: float
+    cumulative_distance_km: float
+    estimated_time: int  # minutes from pickup
+
+class Trip(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    pharmacy_id: str
+    driver_id: Optional[str] = None
+    order_ids: List[str]
+    stops: List[TripStop]
+    total_distance_km: float = 0.0
+    status: str = "open"  # open, assigned, completed
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
 class DriverReview(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -293,20 +640,6 @@ class VerifyCodeRequest(BaseModel):
     value: str  # email or phone number
     code: str
 
-# Verification Storage Model
-class VerificationCode(BaseModel):
-    model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    user_id: str
-    type: str  # "email" or "phone"
-    value: str  # email or phone number
-    code: str
-    expires_at: datetime
-    verified: bool = False
-    resend_count: int = 0
-    last_resent_at: Optional[datetime] = None
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-
 # ==================== HELPER FUNCTIONS ====================
 
 def validate_password(password: str) -> tuple[bool, str]:
@@ -326,13 +659,33 @@ def validate_email(email: str) -> tuple[bool, str]:
         return False, "Invalid email format"
     return True, "Email is valid"
 
-def create_jwt_token(user_id: str, role: str) -> str:
-    """Create JWT token for user"""
+def as_utc(value) -> datetime:
+    """Timezone-aware UTC datetime from a stored date (native or legacy ISO string)"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+def to_document(model: BaseModel) -> Dict:
+    """Mongo document for a model; datetimes are stored as native BSON dates in UTC"""
+    document = model.model_dump()
+    for key, value in document.items():
+        if isinstance(value, datetime):
+            document[key] = as_utc(value).astimezone(timezone.utc)
+    return document
+
+def create_jwt_token(user_id: str, role: str, scope: Optional[Dict] = None) -> str:
+    """Create JWT token for user, embedding their pharmacy/driver scope if known"""
+    now = datetime.now(timezone.utc)
     payload = {
         "user_id": user_id,
         "role": role,
-        "exp": datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRATION_HOURS)
+        "jti": uuid.uuid4().hex,
+        "iat": now,
+        "exp": now + timedelta(hours=JWT_EXPIRATION_HOURS)
     }
+    payload.update(scope or {})
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
 def verify_jwt_token(token: str) -> Dict:
@@ -345,6 +698,12 @@ def verify_jwt_token(token: str) -> Dict:
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+# Internal bookkeeping fields never returned to clients
+USER_PROJECTION = {"_id": 0, "applied_events": 0}
+DRIVER_PROJECTION = {"_id": 0, "applied_events": 0}
+INTERNAL_USER_FIELDS = ("tokens_valid_after",)
+
+@traced("get_current_user")
 async def get_current_user(request: Request, credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)) -> Dict:
     """Get current user from JWT token or session cookie"""
     token = None
@@ -354,9 +713,11 @@ async def get_current_user(request: Request, credentials: Optional[HTTPAuthoriza
     if session_token:
         # Verify session token from Emergent Auth or custom session
         session = await db.sessions.find_one({"session_token": session_token})
-        if session and session['expires_at'] > datetime.now(timezone.utc).isoformat():
-            user = await db.users.find_one({"id": session['user_id']}, {"_id": 0})
+        if session and as_utc(session['expires_at']) > datetime.now(timezone.utc):
+            user = await db.users.find_one({"id": session['user_id']}, USER_PROJECTION)
             if user:
+                for field in INTERNAL_USER_FIELDS:
+                    user.pop(field, None)
                 return user
     
     # Try to get token from Authorization header
@@ -367,12 +728,77 @@ async def get_current_user(request: Request, credentials: Optional[HTTPAuthoriza
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     payload = verify_jwt_token(token)
-    user = await db.users.find_one({"id": payload['user_id']}, {"_id": 0})
+    user = await db.users.find_one({"id": payload['user_id']}, USER_PROJECTION)
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
     
+    # Tokens issued before the last password reset are no longer valid
+    valid_after = user.pop('tokens_valid_after', None)
+    if valid_after and payload.get('iat', 0) < as_utc(valid_after).timestamp():
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    
+    if await is_token_revoked(payload.get('jti')):
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    
+    request.state.token_claims = payload
     return user
 
+scope_cache = TTLCache(maxsize=SCOPE_CACHE_SIZE, ttl=SCOPE_CACHE_TTL_SECONDS)
+
+async def load_user_scope(user_id: str, role: str) -> Dict:
+    """Look up the scoped claims for a user: pharmacy_id for owners, driver_id/driver_state for drivers"""
+    scope = {}
+    if role == UserRole.PHARMACY:
+        pharmacy = await db.pharmacies.find_one({"owner_id": user_id}, {"_id": 0, "id": 1})
+        if pharmacy:
+            scope = {"pharmacy_id": pharmacy['id']}
+    elif role == UserRole.DRIVER:
+        driver = await db.drivers.find_one({"user_id": user_id}, {"_id": 0, "id": 1, "state": 1})
+        if driver:
+            scope = {"driver_id": driver['id'], "driver_state": driver['state']}
+    
+    # Users without a profile yet are not cached so the profile shows up immediately
+    if scope:
+        scope_cache[user_id] = scope
+    return scope
+
+async def resolve_user_scope(request: Request, user: Dict) -> Dict:
+    """Scoped claims from the bearer token, falling back to the scope cache and then the database"""
+    claims = getattr(request.state, 'token_claims', None) or {}
+    if claims.get('pharmacy_id') or claims.get('driver_id'):
+        return claims
+    
+    scope = scope_cache.get(user['id'])
+    if scope is None:
+        scope = await load_user_scope(user['id'], user['role'])
+    return scope
+
+async def current_pharmacy(request: Request, current_user: Dict = Depends(get_current_user)) -> Dict:
+    """The caller's pharmacy ({"id"}) without a per-request pharmacies lookup"""
+    if current_user['role'] != UserRole.PHARMACY:
+        raise HTTPException(status_code=403, detail="Only pharmacy owners can access this")
+    
+    scope = await resolve_user_scope(request, current_user)
+    if not scope.get('pharmacy_id'):
+        raise HTTPException(status_code=404, detail="Pharmacy not found. Please create a pharmacy first.")
+    
+    return {"id": scope['pharmacy_id']}
+
+async def current_driver(request: Request, current_user: Dict = Depends(get_current_user)) -> Dict:
+    """The caller's driver profile ({"id", "state"}) without a per-request drivers lookup"""
+    if current_user['role'] != UserRole.DRIVER:
+        raise HTTPException(status_code=403, detail="Only drivers can access this")
+    
+    scope = await resolve_user_scope(request, current_user)
+    if not scope.get('driver_id'):
+        raise HTTPException(status_code=404, detail="Driver profile not found")
+    
+    return {"id": scope['driver_id'], "state": scope['driver_state']}
+
+def geo_point(lat: float, lng: float) -> Dict:
+    """GeoJSON point for 2dsphere indexes (note the lng, lat order)"""
+    return {"type": "Point", "coordinates": [lng, lat]}
+
 def calculate_distance(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
     """Calculate distance between two coordinates in km (simple approximation)"""
     from math import radians, sin, cos, sqrt, atan2
@@ -414,6 +840,31 @@ def calculate_driver_earning(distance_km: float, state: str) -> float:
     rates = STATE_DELIVERY_RATES.get(state, STATE_DELIVERY_RATES["default"])
     return rates["base"] + (distance_km * rates["per_km"])
 
+def calculate_trip_leg_earning(leg_distance_km: float, state: str, is_first_stop: bool) -> float:
+    """Driver earning for one stop of a batched trip (stops add up to calculate_driver_earning for the route)"""
+    rates = STATE_DELIVERY_RATES.get(state, STATE_DELIVERY_RATES["default"])
+    base = rates["base"] if is_first_stop else 0
+    return base + (leg_distance_km * rates["per_km"])
+
+def earnings_bucket_start(at: datetime, period: str) -> datetime:
+    """Start (as UTC) of the local day/week/month bucket containing a timestamp"""
+    local = at.astimezone(EARNINGS_TIMEZONE).replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == "week":
+        local -= timedelta(days=local.weekday())  # ISO weeks start on Monday
+    elif period == "month":
+        local = local.replace(day=1)
+    return local.astimezone(timezone.utc)
+
+def earnings_bucket_label(start: datetime, period: str) -> str:
+    """Human-readable bucket key: 2026-10-19, 2026-W42 or 2026-10"""
+    local = start.astimezone(EARNINGS_TIMEZONE)
+    if period == "week":
+        year, week, _ = local.isocalendar()
+        return f"{year}-W{week:02d}"
+    if period == "month":
+        return local.strftime("%Y-%m")
+    return local.strftime("%Y-%m-%d")
+
 def calculate_reward_points(order_amount: float) -> int:
     """Calculate reward points: 1 point per ₹20 spent"""
     return int(order_amount / 20)
@@ -422,6 +873,313 @@ def calculate_discount_from_points(points_used: int) -> float:
     """Convert points to discount: 1 point = ₹0.25"""
     return points_used * 0.25
 
+# ==================== NOTIFICATIONS ====================
+
+class Notification(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    channel: str  # "email" or "sms"
+    to: str
+    subject: str
+    body: str
+    attempts: int = 0
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class NotificationProvider(ABC):
+    """Base class for email/SMS providers. Subclasses implement send_batch."""
+    name = "base"
+    batch_size = 50
+    rate_per_second = 20.0  # messages per second allowed by the provider
+    timeout_seconds = 10.0
+    
+    @abstractmethod
+    async def send_batch(self, messages: List[Notification]) -> List[str]:
+        """Send messages; return ids of messages that failed (raise to fail the whole batch)"""
+
+class LogNotificationProvider(NotificationProvider):
+    """Local sink that writes messages to the application log"""
+    name = "log"
+    rate_per_second = 1000.0
+    
+    async def send_batch(self, messages: List[Notification]) -> List[str]:
+        for message in messages:
+            logging.info(f"[notification:{message.channel}] to={message.to} subject={message.subject!r} body={message.body!r}")
+        return []
+
+class FileNotificationProvider(NotificationProvider):
+    """Local sink that appends messages as JSON lines, for tests and development"""
+    name = "file"
+    rate_per_second = 1000.0
+    
+    def __init__(self, path: str = NOTIFICATION_FILE):
+        self.path = path
+    
+    def _append(self, lines: str):
+        with open(self.path, "a") as f:
+            f.write(lines)
+    
+    async def send_batch(self, messages: List[Notification]) -> List[str]:
+        lines = "".join(message.model_dump_json() + "\n" for message in messages)
+        await asyncio.to_thread(self._append, lines)
+        return []
+
+NOTIFICATION_PROVIDERS = {
+    "log": LogNotificationProvider,
+    "file": FileNotificationProvider,
+}
+
+def register_notification_provider(name: str, provider_class: type):
+    """Make a provider available to NOTIFICATION_EMAIL_PROVIDER / NOTIFICATION_SMS_PROVIDER"""
+    NOTIFICATION_PROVIDERS[name] = provider_class
+
+class TokenBucket:
+    """Async token bucket used to rate-limit a provider"""
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+    
+    async def acquire(self, count: int = 1):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= count:
+                self.tokens -= count
+                return
+            await asyncio.sleep((count - self.tokens) / self.rate)
+
+class NotificationDispatcher:
+    """Queue for one provider: batches, rate-limits, retries and dead-letters messages"""
+    
+    def __init__(self, provider: NotificationProvider, linger_seconds: float = 0.05):
+        self.provider = provider
+        self.linger_seconds = linger_seconds
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=NOTIFICATION_QUEUE_SIZE)
+        self.bucket = TokenBucket(provider.rate_per_second, max(provider.rate_per_second, provider.batch_size))
+        self.sent_total = 0
+        self.failed_total = 0
+        self.dead_total = 0
+        self.dead_letter_tasks: Set[asyncio.Task] = set()  # strong references until each write finishes
+    
+    def submit(self, message: Notification):
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            logging.error(f"Notification queue for {self.provider.name} is full")
+            task = asyncio.create_task(self.dead_letter([message], "queue full"))
+            self.dead_letter_tasks.add(task)
+            task.add_done_callback(self.dead_letter_tasks.discard)
+    
+    async def next_batch(self) -> List[Notification]:
+        """Wait for one message, then collect more until the batch is full or the linger time passes"""
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.linger_seconds
+        while len(batch) < self.provider.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+    
+    async def run(self):
+        while True:
+            batch = await self.next_batch()
+            await self.bucket.acquire(len(batch))
+            try:
+                failed_ids = set(await asyncio.wait_for(
+                    self.provider.send_batch(batch),
+                    timeout=self.provider.timeout_seconds
+                ))
+                error = "provider rejected message"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failed_ids = {message.id for message in batch}
+                error = str(e) or type(e).__name__
+            
+            self.sent_total += len(batch) - len(failed_ids)
+            failed = [message for message in batch if message.id in failed_ids]
+            if failed:
+                self.failed_total += len(failed)
+                await self.retry_or_dead_letter(failed, error)
+    
+    async def retry_or_dead_letter(self, messages: List[Notification], error: str):
+        dead = []
+        loop = asyncio.get_running_loop()
+        for message in messages:
+            message.attempts += 1
+            if message.attempts >= NOTIFICATION_MAX_ATTEMPTS:
+                dead.append(message)
+            else:
+                backoff = min(2 ** message.attempts, 60) * random.uniform(0.5, 1.5)
+                loop.call_later(backoff, self.submit, message)
+        if dead:
+            await self.dead_letter(dead, error)
+    
+    async def dead_letter(self, messages: List[Notification], error: str):
+        self.dead_total += len(messages)
+        logging.error(f"Dead-lettering {len(messages)} {self.provider.name} notifications: {error}")
+        try:
+            await db.notification_dead_letters.insert_many([
+                {**message.model_dump(), "provider": self.provider.name, "error": error, "failed_at": datetime.now(timezone.utc)}
+                for message in messages
+            ])
+        except Exception as e:
+            logging.error(f"Failed to store dead-lettered notifications: {str(e)}")
+
+class NotificationService:
+    """Routes messages to a dispatcher per channel without blocking the caller"""
+    
+    def __init__(self, channel_providers: Dict[str, str]):
+        self.channel_providers = channel_providers
+        self.dispatchers: Dict[str, NotificationDispatcher] = {}
+    
+    def dispatcher(self, channel: str) -> NotificationDispatcher:
+        if channel not in self.dispatchers:
+            provider_name = self.channel_providers.get(channel, "log")
+            self.dispatchers[channel] = NotificationDispatcher(NOTIFICATION_PROVIDERS[provider_name]())
+        return self.dispatchers[channel]
+    
+    def send(self, channel: str, to: str, subject: str, body: str):
+        self.dispatcher(channel).submit(Notification(channel=channel, to=to, subject=subject, body=body))
+    
+    def start(self) -> List[asyncio.Task]:
+        return [asyncio.create_task(self.dispatcher(channel).run()) for channel in self.channel_providers]
+    
+    def stats(self) -> Dict:
+        return {
+            channel: {
+                "provider": d.provider.name,
+                "queued": d.queue.qsize(),
+                "sent_total": d.sent_total,
+                "failed_total": d.failed_total,
+                "dead_total": d.dead_total
+            }
+            for channel, d in self.dispatchers.items()
+        }
+
+notifications = NotificationService({
+    "email": NOTIFICATION_EMAIL_PROVIDER,
+    "sms": NOTIFICATION_SMS_PROVIDER,
+})
+
+@api_router.get("/health/notifications")
+async def get_notification_health():
+    """Queue depth and delivery counters per notification channel"""
+    return notifications.stats()
+
+# ==================== TOKEN REVOCATION ====================
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings (double hashing of a 128-bit blake2b digest)"""
+    
+    def __init__(self, capacity: int, error_rate: float):
+        capacity = max(capacity, 1)
+        self.bit_count = max(8, ceil(-capacity * log(error_rate) / (log(2) ** 2)))
+        self.hash_count = max(1, round(self.bit_count / capacity * log(2)))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.item_count = 0
+    
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.bit_count for i in range(self.hash_count))
+    
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.item_count += 1
+    
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+    
+    def false_positive_rate(self) -> float:
+        """Expected false-positive probability at the current fill"""
+        return (1 - exp(-self.hash_count * self.item_count / self.bit_count)) ** self.hash_count
+
+class RevocationStats:
+    def __init__(self):
+        self.checks = 0
+        self.bloom_hits = 0
+        self.false_positives = 0
+        self.last_sync_at: Optional[datetime] = None
+
+revocation_filter = BloomFilter(REVOCATION_BLOOM_CAPACITY, REVOCATION_BLOOM_ERROR_RATE)
+revocation_stats = RevocationStats()
+
+async def sync_revocation_filter():
+    """Rebuild the Bloom filter from revoked_tokens (expired rows drop out via TTL)"""
+    global revocation_filter
+    count = await db.revoked_tokens.estimated_document_count()
+    rebuilt = BloomFilter(max(REVOCATION_BLOOM_CAPACITY, count * 2), REVOCATION_BLOOM_ERROR_RATE)
+    async for record in db.revoked_tokens.find({}, {"_id": 0, "jti": 1}):
+        rebuilt.add(record['jti'])
+    revocation_filter = rebuilt
+    revocation_stats.last_sync_at = datetime.now(timezone.utc)
+
+async def revocation_sync_loop(interval_seconds: int = REVOCATION_SYNC_SECONDS):
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await sync_revocation_filter()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Revocation filter sync failed: {str(e)}")
+
+async def is_token_revoked(jti: Optional[str]) -> bool:
+    """Bloom filter first; only a possible hit costs an exact lookup"""
+    if not jti:
+        return False
+    revocation_stats.checks += 1
+    if jti not in revocation_filter:
+        return False
+    
+    revocation_stats.bloom_hits += 1
+    if await db.revoked_tokens.find_one({"jti": jti}, {"_id": 1}):
+        return True
+    revocation_stats.false_positives += 1
+    return False
+
+async def revoke_token(payload: Dict):
+    """Deny a token until it would have expired anyway"""
+    await db.revoked_tokens.update_one(
+        {"jti": payload['jti']},
+        {"$setOnInsert": {
+            "jti": payload['jti'],
+            "user_id": payload['user_id'],
+            "revoked_at": datetime.now(timezone.utc),
+            "expires_at": datetime.fromtimestamp(payload['exp'], timezone.utc)
+        }},
+        upsert=True
+    )
+    # Visible in this process immediately, in others after their next sync
+    revocation_filter.add(payload['jti'])
+
+@api_router.get("/health/revocations")
+async def get_revocation_health():
+    """Bloom filter size, fill and false-positive rates for the token denylist"""
+    # Checks for tokens that are not actually revoked; the filter's false positives come from these
+    negatives = revocation_stats.checks - revocation_stats.bloom_hits + revocation_stats.false_positives
+    return {
+        "revoked_tokens": revocation_filter.item_count,
+        "memory_bytes": len(revocation_filter.bits),
+        "bits": revocation_filter.bit_count,
+        "hash_functions": revocation_filter.hash_count,
+        "expected_false_positive_rate": revocation_filter.false_positive_rate(),
+        "checks": revocation_stats.checks,
+        "bloom_hits": revocation_stats.bloom_hits,
+        "false_positives": revocation_stats.false_positives,
+        "observed_false_positive_rate": revocation_stats.false_positives / negatives if negatives else 0.0,
+        "last_sync_at": revocation_stats.last_sync_at
+    }
+
 # ==================== AUTH ROUTES ====================
 
 @api_router.post("/auth/register")
@@ -447,7 +1205,8 @@ async def register(user_data: UserRegister):
         raise HTTPException(status_code=400, detail=f"Phone number is required for {user_data.role} registration")
     
     # Hash password
-    hashed_password = pwd_context.hash(user_data.password)
+    with trace_span("bcrypt.hash"):
+        hashed_password = pwd_context.hash(user_data.password)
     
     # Create user
     user = User(
@@ -457,9 +1216,8 @@ async def register(user_data: UserRegister):
         role=user_data.role
     )
     
-    user_dict = user.model_dump()
+    user_dict = to_document(user)
     user_dict['password_hash'] = hashed_password
-    user_dict['created_at'] = user_dict['created_at'].isoformat()
     
     await db.users.insert_one(user_dict)
     
@@ -485,15 +1243,21 @@ async def login(credentials: UserLogin):
         raise HTTPException(status_code=401, detail="No account found with this email. Please sign up first.")
     
     # Verify password
-    if not pwd_context.verify(credentials.password, user['password_hash']):
+    with trace_span("bcrypt.verify"):
+        password_ok = pwd_context.verify(credentials.password, user['password_hash'])
+    if not password_ok:
         raise HTTPException(status_code=401, detail="Incorrect password. Please try again or use 'Forgot Password'.")
     
     # Create JWT token
-    token = create_jwt_token(user['id'], user['role'])
+    scope = await load_user_scope(user['id'], user['role'])
+    token = create_jwt_token(user['id'], user['role'], scope)
     
-    # Remove password hash from response
+    # Remove password hash and internal fields from response
     user.pop('password_hash', None)
     user.pop('_id', None)
+    user.pop('applied_events', None)
+    for field in INTERNAL_USER_FIELDS:
+        user.pop(field, None)
     
     return {
         "user": user,
@@ -506,10 +1270,12 @@ async def process_google_session(x_session_id: str = Header(...), response: Resp
     """Process Google OAuth session from Emergent Auth"""
     try:
         # Call Emergent Auth API to get user data
-        auth_response = requests.get(
-            "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
-            headers={"X-Session-ID": x_session_id}
-        )
+        with trace_span("http GET emergent session-data") as span:
+            auth_response = requests.get(
+                "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
+                headers={"X-Session-ID": x_session_id}
+            )
+            span.set("http.status_code", auth_response.status_code)
         
         if auth_response.status_code != 200:
             raise HTTPException(status_code=401, detail="Invalid session")
@@ -527,8 +1293,7 @@ async def process_google_session(x_session_id: str = Header(...), response: Resp
                 role=UserRole.CUSTOMER,
                 profile_pic=auth_data.get('picture')
             )
-            user_dict = new_user.model_dump()
-            user_dict['created_at'] = user_dict['created_at'].isoformat()
+            user_dict = to_document(new_user)
             await db.users.insert_one(user_dict)
             user = user_dict
         
@@ -539,11 +1304,10 @@ async def process_google_session(x_session_id: str = Header(...), response: Resp
             expires_at=datetime.now(timezone.utc) + timedelta(days=7)
         )
         
-        session_dict = session.model_dump()
-        session_dict['created_at'] = session_dict['created_at'].isoformat()
-        session_dict['expires_at'] = session_dict['expires_at'].isoformat()
+        session_dict = to_document(session)
         
-        await db.sessions.insert_one(session_dict)
+        # Emergent may hand back a session token we already stored
+        await db.sessions.replace_one({"session_token": session_dict['session_token']}, session_dict, upsert=True)
         
         # Set httpOnly cookie
         if response:
@@ -578,14 +1342,28 @@ async def get_me(current_user: Dict = Depends(get_current_user)):
     """Get current user info"""
     return current_user
 
+@api_router.post("/auth/refresh")
+async def refresh_token(current_user: Dict = Depends(get_current_user)):
+    """Issue a fresh token carrying the caller's current pharmacy/driver scope"""
+    scope = await load_user_scope(current_user['id'], current_user['role'])
+    return {"token": create_jwt_token(current_user['id'], current_user['role'], scope)}
+
 @api_router.post("/auth/logout")
-async def logout(request: Request, response: Response):
-    """Logout user"""
+async def logout(request: Request, response: Response, credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)):
+    """Logout user, revoking the bearer token if one was sent"""
     session_token = request.cookies.get('session_token')
     if session_token:
         await db.sessions.delete_one({"session_token": session_token})
         response.delete_cookie("session_token", path="/")
     
+    if credentials:
+        try:
+            payload = verify_jwt_token(credentials.credentials)
+        except HTTPException:
+            payload = None
+        if payload and payload.get('jti'):
+            await revoke_token(payload)
+    
     return {"message": "Logout successful"}
 
 @api_router.post("/auth/forgot-password")
@@ -599,22 +1377,41 @@ async def forgot_password(email: EmailStr):
     # Generate OTP
     otp = secrets.randbelow(900000) + 100000  # 6-digit OTP
     
-    # Store OTP with expiry (10 minutes)
-    await db.password_resets.update_one(
-        {"email": email},
-        {
-            "$set": {
-                "otp": str(otp),
-                "expires_at": (datetime.now(timezone.utc) + timedelta(minutes=10)).isoformat(),
-                "created_at": datetime.now(timezone.utc).isoformat()
-            }
-        },
-        upsert=True
-    )
+    # Store OTP with expiry (10 minutes) in one atomic upsert; a reset still in
+    # its cooldown collides with the unique email index instead of matching
+    now = datetime.now(timezone.utc)
+    try:
+        await db.password_resets.find_one_and_update(
+            {
+                "email": email,
+                "$or": [
+                    {"last_sent_at": {"$lte": now - timedelta(seconds=CODE_RESEND_COOLDOWN_SECONDS)}},
+                    {"last_sent_at": {"$exists": False}}
+                ]
+            },
+            {
+                "$set": {
+                    "otp": str(otp),
+                    "expires_at": now + timedelta(minutes=CODE_TTL_MINUTES),
+                    "verified": False,
+                    "last_sent_at": now,
+                    "created_at": now
+                }
+            },
+            {"_id": 1},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Please wait 30 seconds before requesting another code")
     
-    # In production, send email here
-    # For now, return OTP (remove in production!)
-    logging.info(f"Password reset OTP for {email}: {otp}")
+    # Delivered asynchronously so provider latency never reaches this request
+    # For now, also return OTP (remove in production!)
+    notifications.send(
+        "email",
+        email,
+        "Reset your Healer password",
+        f"Your Healer password reset code is {otp}. It expires in 10 minutes."
+    )
     
     return {
         "message": "Password reset OTP sent to your email",
@@ -629,16 +1426,19 @@ async def verify_otp(email: EmailStr, otp: str):
     if not reset_record:
         raise HTTPException(status_code=400, detail="No reset request found for this email")
     
-    if datetime.fromisoformat(reset_record['expires_at']) < datetime.now(timezone.utc):
+    if as_utc(reset_record['expires_at']) < datetime.now(timezone.utc):
         raise HTTPException(status_code=400, detail="OTP has expired. Please request a new one")
     
     if reset_record['otp'] != otp:
         raise HTTPException(status_code=400, detail="Invalid OTP. Please try again")
     
-    # Mark OTP as verified
+    # Mark OTP as verified, keeping the record around long enough to reset the password
     await db.password_resets.update_one(
         {"email": email},
-        {"$set": {"verified": True}}
+        {"$set": {
+            "verified": True,
+            "expires_at": datetime.now(timezone.utc) + timedelta(minutes=VERIFIED_RECORD_TTL_MINUTES)
+        }}
     )
     
     return {"message": "OTP verified successfully"}
@@ -664,13 +1464,20 @@ async def reset_password(email: EmailStr, otp: str, new_password: str, confirm_p
         raise HTTPException(status_code=400, detail="Invalid OTP")
     
     # Hash new password
-    hashed_password = pwd_context.hash(new_password)
+    with trace_span("bcrypt.hash"):
+        hashed_password = pwd_context.hash(new_password)
     
-    # Update user password
-    await db.users.update_one(
+    # Update user password and sign out every existing token (iat has second precision)
+    user = await db.users.find_one_and_update(
         {"email": email},
-        {"$set": {"password_hash": hashed_password}}
+        {"$set": {
+            "password_hash": hashed_password,
+            "tokens_valid_after": datetime.now(timezone.utc).replace(microsecond=0)
+        }},
+        {"_id": 0, "id": 1}
     )
+    if user:
+        await db.sessions.delete_many({"user_id": user['id']})
     
     # Delete reset record
     await db.password_resets.delete_one({"email": email})
@@ -680,8 +1487,11 @@ async def reset_password(email: EmailStr, otp: str, new_password: str, confirm_p
 # ==================== PHARMACY ROUTES ====================
 
 @api_router.post("/pharmacies", response_model=Pharmacy)
-async def create_pharmacy(pharmacy_data: PharmacyCreate, current_user: Dict = Depends(get_current_user)):
-    """Create a new pharmacy (pharmacy owners only)"""
+async def create_pharmacy(pharmacy_data: PharmacyCreate, response: Response, current_user: Dict = Depends(get_current_user)):
+    """Create a new pharmacy (pharmacy owners only).
+    
+    The X-Auth-Token response header carries a token scoped to the new pharmacy.
+    """
     if current_user['role'] != UserRole.PHARMACY:
         raise HTTPException(status_code=403, detail="Only pharmacy owners can create pharmacies")
     
@@ -695,11 +1505,14 @@ async def create_pharmacy(pharmacy_data: PharmacyCreate, current_user: Dict = De
         **pharmacy_data.model_dump()
     )
     
-    pharmacy_dict = pharmacy.model_dump()
-    pharmacy_dict['created_at'] = pharmacy_dict['created_at'].isoformat()
+    pharmacy_dict = to_document(pharmacy)
     
     await db.pharmacies.insert_one(pharmacy_dict)
     
+    scope = {"pharmacy_id": pharmacy.id}
+    scope_cache[current_user['id']] = scope
+    response.headers["X-Auth-Token"] = create_jwt_token(current_user['id'], current_user['role'], scope)
+    
     return pharmacy
 
 @api_router.get("/pharmacies/my", response_model=Pharmacy)
@@ -723,23 +1536,14 @@ async def get_all_pharmacies():
 # ==================== MEDICINE ROUTES ====================
 
 @api_router.post("/medicines", response_model=Medicine)
-async def create_medicine(medicine_data: MedicineCreate, current_user: Dict = Depends(get_current_user)):
+async def create_medicine(medicine_data: MedicineCreate, pharmacy: Dict = Depends(current_pharmacy)):
     """Create a new medicine (pharmacy owners only)"""
-    if current_user['role'] != UserRole.PHARMACY:
-        raise HTTPException(status_code=403, detail="Only pharmacy owners can add medicines")
-    
-    # Get pharmacy
-    pharmacy = await db.pharmacies.find_one({"owner_id": current_user['id']})
-    if not pharmacy:
-        raise HTTPException(status_code=404, detail="Pharmacy not found. Please create a pharmacy first.")
-    
     medicine = Medicine(
         pharmacy_id=pharmacy['id'],
         **medicine_data.model_dump()
     )
     
-    medicine_dict = medicine.model_dump()
-    medicine_dict['created_at'] = medicine_dict['created_at'].isoformat()
+    medicine_dict = to_document(medicine)
     
     await db.medicines.insert_one(medicine_dict)
     
@@ -756,15 +1560,8 @@ async def get_medicines(pharmacy_id: Optional[str] = None):
     return medicines
 
 @api_router.get("/medicines/my", response_model=List[Medicine])
-async def get_my_medicines(current_user: Dict = Depends(get_current_user)):
+async def get_my_medicines(pharmacy: Dict = Depends(current_pharmacy)):
     """Get medicines for current pharmacy"""
-    if current_user['role'] != UserRole.PHARMACY:
-        raise HTTPException(status_code=403, detail="Only pharmacy owners can access this")
-    
-    pharmacy = await db.pharmacies.find_one({"owner_id": current_user['id']})
-    if not pharmacy:
-        raise HTTPException(status_code=404, detail="Pharmacy not found")
-    
     medicines = await db.medicines.find({"pharmacy_id": pharmacy['id']}, {"_id": 0}).to_list(1000)
     return medicines
 
@@ -780,11 +1577,15 @@ async def search_medicines(q: str, lat: Optional[float] = None, lng: Optional[fl
         "stock_quantity": {"$gt": 0}
     }, {"_id": 0}).to_list(1000)
     
-    # Get pharmacy details and calculate distances
+    # Get pharmacy details in one query and calculate distances
+    pharmacy_ids = list({medicine['pharmacy_id'] for medicine in medicines})
+    pharmacies = await db.pharmacies.find({"id": {"$in": pharmacy_ids}, "is_active": True}, {"_id": 0}).to_list(None)
+    pharmacies_by_id = {pharmacy['id']: pharmacy for pharmacy in pharmacies}
+    
     results = []
     for medicine in medicines:
-        pharmacy = await db.pharmacies.find_one({"id": medicine['pharmacy_id']}, {"_id": 0})
-        if pharmacy and pharmacy['is_active']:
+        pharmacy = pharmacies_by_id.get(medicine['pharmacy_id'])
+        if pharmacy:
             result = {
                 "medicine": medicine,
                 "pharmacy": pharmacy,
@@ -809,15 +1610,8 @@ async def search_medicines(q: str, lat: Optional[float] = None, lng: Optional[fl
     return results
 
 @api_router.put("/medicines/{medicine_id}", response_model=Medicine)
-async def update_medicine(medicine_id: str, medicine_data: MedicineCreate, current_user: Dict = Depends(get_current_user)):
+async def update_medicine(medicine_id: str, medicine_data: MedicineCreate, pharmacy: Dict = Depends(current_pharmacy)):
     """Update medicine details"""
-    if current_user['role'] != UserRole.PHARMACY:
-        raise HTTPException(status_code=403, detail="Only pharmacy owners can update medicines")
-    
-    pharmacy = await db.pharmacies.find_one({"owner_id": current_user['id']})
-    if not pharmacy:
-        raise HTTPException(status_code=404, detail="Pharmacy not found")
-    
     medicine = await db.medicines.find_one({"id": medicine_id, "pharmacy_id": pharmacy['id']})
     if not medicine:
         raise HTTPException(status_code=404, detail="Medicine not found")
@@ -829,21 +1623,31 @@ async def update_medicine(medicine_id: str, medicine_data: MedicineCreate, curre
     return updated
 
 @api_router.delete("/medicines/{medicine_id}")
-async def delete_medicine(medicine_id: str, current_user: Dict = Depends(get_current_user)):
+async def delete_medicine(medicine_id: str, pharmacy: Dict = Depends(current_pharmacy)):
     """Delete a medicine"""
-    if current_user['role'] != UserRole.PHARMACY:
-        raise HTTPException(status_code=403, detail="Only pharmacy owners can delete medicines")
-    
-    pharmacy = await db.pharmacies.find_one({"owner_id": current_user['id']})
-    if not pharmacy:
-        raise HTTPException(status_code=404, detail="Pharmacy not found")
-    
     result = await db.medicines.delete_one({"id": medicine_id, "pharmacy_id": pharmacy['id']})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Medicine not found")
     
     return {"message": "Medicine deleted successfully"}
 
+@api_router.post("/medicines/{medicine_id}/image", response_model=Medicine)
+async def upload_medicine_image(medicine_id: str, background_tasks: BackgroundTasks, file: UploadFile = File(...), pharmacy: Dict = Depends(current_pharmacy)):
+    """Upload a medicine image; thumbnails are served from /api/media/thumbnails/{size}/{digest}.webp"""
+    blob = await store_upload(file)
+    
+    medicine = await db.medicines.find_one_and_update(
+        {"id": medicine_id, "pharmacy_id": pharmacy['id']},
+        {"$set": {"image_url": blob['url']}},
+        {"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not medicine:
+        raise HTTPException(status_code=404, detail="Medicine not found")
+    
+    background_tasks.add_task(generate_thumbnails, blob['digest'], blob['extension'])
+    return medicine
+
 # ==================== ORDER ROUTES ====================
 
 @api_router.post("/orders", response_model=Order)
@@ -920,40 +1724,46 @@ async def create_order(order_data: OrderCreate, current_user: Dict = Depends(get
         notes=order_data.notes
     )
     
-    order_dict = order.model_dump()
-    order_dict['created_at'] = order_dict['created_at'].isoformat()
-    order_dict['updated_at'] = order_dict['updated_at'].isoformat()
+    order_dict = to_document(order)
+    # GeoJSON pickup point for the drivers' available-orders geo index
+    order_dict['pickup_location'] = geo_point(pharmacy['location']['lat'], pharmacy['location']['lng'])
     
-    await db.orders.insert_one(order_dict)
+    # Reward points are settled by the outbox worker
+    async def place(session):
+        await db.orders.insert_one(order_dict, session=session)
+        await enqueue_outbox_event("order.created", order.id, {
+            "customer_id": current_user['id'],
+            "points_delta": points_earned - points_redeemed
+        }, session=session)
     
-    # Update user reward points
-    new_points = user.get('reward_points', 0) - points_redeemed + points_earned
-    await db.users.update_one(
-        {"id": current_user['id']},
-        {"$set": {"reward_points": new_points}}
-    )
+    await in_transaction(place)
     
     return order
 
 @api_router.get("/orders/my", response_model=List[Order])
-async def get_my_orders(current_user: Dict = Depends(get_current_user)):
+async def get_my_orders(request: Request, current_user: Dict = Depends(get_current_user)):
     """Get orders for current user based on role"""
     query = {}
     
     if current_user['role'] == UserRole.CUSTOMER:
         query['customer_id'] = current_user['id']
     elif current_user['role'] == UserRole.PHARMACY:
-        pharmacy = await db.pharmacies.find_one({"owner_id": current_user['id']})
-        if pharmacy:
-            query['pharmacy_id'] = pharmacy['id']
+        scope = await resolve_user_scope(request, current_user)
+        if not scope.get('pharmacy_id'):
+            return []
+        query['pharmacy_id'] = scope['pharmacy_id']
     elif current_user['role'] == UserRole.DRIVER:
-        query['driver_id'] = current_user['id']
+        # Orders reference the driver profile id, not the user id
+        scope = await resolve_user_scope(request, current_user)
+        if not scope.get('driver_id'):
+            return []
+        query['driver_id'] = scope['driver_id']
     
     orders = await db.orders.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
     return orders
 
 @api_router.get("/orders/{order_id}", response_model=Order)
-async def get_order(order_id: str, current_user: Dict = Depends(get_current_user)):
+async def get_order(order_id: str, request: Request, current_user: Dict = Depends(get_current_user)):
     """Get order details"""
     order = await db.orders.find_one({"id": order_id}, {"_id": 0})
     if not order:
@@ -963,25 +1773,28 @@ async def get_order(order_id: str, current_user: Dict = Depends(get_current_user
     if current_user['role'] == UserRole.CUSTOMER and order['customer_id'] != current_user['id']:
         raise HTTPException(status_code=403, detail="Not authorized to view this order")
     elif current_user['role'] == UserRole.PHARMACY:
-        pharmacy = await db.pharmacies.find_one({"owner_id": current_user['id']})
-        if not pharmacy or order['pharmacy_id'] != pharmacy['id']:
+        scope = await resolve_user_scope(request, current_user)
+        if order['pharmacy_id'] != scope.get('pharmacy_id'):
+            raise HTTPException(status_code=403, detail="Not authorized to view this order")
+    elif current_user['role'] == UserRole.DRIVER:
+        scope = await resolve_user_scope(request, current_user)
+        if not scope.get('driver_id') or order.get('driver_id') != scope['driver_id']:
             raise HTTPException(status_code=403, detail="Not authorized to view this order")
-    elif current_user['role'] == UserRole.DRIVER and order.get('driver_id') != current_user['id']:
-        raise HTTPException(status_code=403, detail="Not authorized to view this order")
     
     return order
 
 @api_router.put("/orders/{order_id}/status")
-async def update_order_status(order_id: str, status: str, current_user: Dict = Depends(get_current_user)):
+async def update_order_status(order_id: str, status: str, request: Request, current_user: Dict = Depends(get_current_user)):
     """Update order status"""
     order = await db.orders.find_one({"id": order_id})
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
+    scope = await resolve_user_scope(request, current_user)
+    
     # Pharmacy can accept/reject/prepare orders
     if current_user['role'] == UserRole.PHARMACY:
-        pharmacy = await db.pharmacies.find_one({"owner_id": current_user['id']})
-        if not pharmacy or order['pharmacy_id'] != pharmacy['id']:
+        if order['pharmacy_id'] != scope.get('pharmacy_id'):
             raise HTTPException(status_code=403, detail="Not authorized")
         
         if status not in [OrderStatus.ACCEPTED, OrderStatus.CANCELLED, OrderStatus.PREPARING]:
@@ -989,7 +1802,7 @@ async def update_order_status(order_id: str, status: str, current_user: Dict = D
     
     # Driver can update pickup/delivery status
     elif current_user['role'] == UserRole.DRIVER:
-        if order.get('driver_id') != current_user['id']:
+        if not scope.get('driver_id') or order.get('driver_id') != scope['driver_id']:
             raise HTTPException(status_code=403, detail="Not authorized")
         
         if status not in [OrderStatus.PICKED_UP, OrderStatus.IN_TRANSIT, OrderStatus.DELIVERED]:
@@ -1000,9 +1813,15 @@ async def update_order_status(order_id: str, status: str, current_user: Dict = D
     
     await db.orders.update_one(
         {"id": order_id},
-        {"$set": {"status": status, "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"status": status, "updated_at": datetime.now(timezone.utc)}}
     )
     
+    # Automatic dispatch of newly accepted orders
+    if DISPATCH_AUTO_ASSIGN and status == OrderStatus.ACCEPTED and not order.get('driver_id'):
+        pharmacy = await db.pharmacies.find_one({"id": order['pharmacy_id']}, {"_id": 0, "location": 1})
+        driver_id = await auto_assign_driver(order_id, pharmacy)
+        return {"message": "Order status updated", "status": status, "driver_id": driver_id}
+    
     return {"message": "Order status updated", "status": status}
 
 @api_router.post("/orders/{order_id}/cancel")
@@ -1025,7 +1844,7 @@ async def cancel_order(order_id: str, current_user: Dict = Depends(get_current_u
         raise HTTPException(status_code=400, detail="Order already cancelled")
     
     # Calculate cancellation charge based on time
-    created_at = datetime.fromisoformat(order['created_at'])
+    created_at = as_utc(order['created_at'])
     time_elapsed = (datetime.now(timezone.utc) - created_at).total_seconds() / 60  # minutes
     
     cancellation_charge = 0.0
@@ -1044,47 +1863,79 @@ async def cancel_order(order_id: str, current_user: Dict = Depends(get_current_u
             "$set": {
                 "status": OrderStatus.CANCELLED,
                 "cancellation_charge": cancellation_charge,
-                "updated_at": datetime.now(timezone.utc).isoformat()
+                "updated_at": datetime.now(timezone.utc)
             }
         }
     )
     
+    if order.get('trip_id'):
+        await detach_order_from_trip(order)
+    elif order.get('driver_id'):
+        await release_driver(order['driver_id'])
+    
     return {
         "message": "Order cancelled",
         "cancellation_charge": cancellation_charge
     }
 
+# A pharmacy can (re)assign a driver until the order is picked up
+ASSIGNABLE_STATUSES = [OrderStatus.ACCEPTED, OrderStatus.PREPARING]
+
 @api_router.post("/orders/{order_id}/assign-driver")
-async def assign_driver(order_id: str, driver_id: str, current_user: Dict = Depends(get_current_user)):
+async def assign_driver(order_id: str, driver_id: str, pharmacy: Dict = Depends(current_pharmacy)):
     """Assign a driver to an order (pharmacy only)"""
-    if current_user['role'] != UserRole.PHARMACY:
-        raise HTTPException(status_code=403, detail="Only pharmacy owners can assign drivers")
-    
     order = await db.orders.find_one({"id": order_id})
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
-    pharmacy = await db.pharmacies.find_one({"owner_id": current_user['id']})
-    if not pharmacy or order['pharmacy_id'] != pharmacy['id']:
+    if order['pharmacy_id'] != pharmacy['id']:
         raise HTTPException(status_code=403, detail="Not authorized")
     
-    # Verify driver exists
-    driver = await db.drivers.find_one({"id": driver_id})
+    previous_driver_id = order.get('driver_id')
+    if previous_driver_id == driver_id:
+        return {"message": "Driver assigned successfully"}
+    
+    # Once picked up the order belongs to the driver carrying it, and a trip
+    # order is paid as a leg of its driver's route
+    if order['status'] not in ASSIGNABLE_STATUSES:
+        raise HTTPException(status_code=400, detail=f"Cannot assign a driver to a {order['status']} order")
+    if order.get('trip_id'):
+        raise HTTPException(status_code=400, detail="Order is part of a batched trip")
+    
+    # Take the driver off the dispatch pool; like claim_driver_for_order, only a free driver can be taken
+    driver = await db.drivers.find_one_and_update(
+        {"id": driver_id, "is_available": True},
+        {"$set": {"is_available": False}}
+    )
     if not driver:
-        raise HTTPException(status_code=404, detail="Driver not found")
-    
-    await db.orders.update_one(
-        {"id": order_id},
-        {"$set": {"driver_id": driver_id, "updated_at": datetime.now(timezone.utc).isoformat()}}
+        if not await db.drivers.find_one({"id": driver_id}, {"_id": 0, "id": 1}):
+            raise HTTPException(status_code=404, detail="Driver not found")
+        raise HTTPException(status_code=400, detail="Driver is busy with another delivery")
+    driver_index.remove(driver_id)
+    
+    result = await db.orders.update_one(
+        {"id": order_id, "driver_id": previous_driver_id, "status": {"$in": ASSIGNABLE_STATUSES}, "trip_id": None},
+        {"$set": {"driver_id": driver_id, "updated_at": datetime.now(timezone.utc)}}
     )
+    if result.modified_count == 0:
+        # Assigned, picked up or batched in the meantime; give the driver back
+        await release_driver(driver_id)
+        raise HTTPException(status_code=409, detail="Order changed concurrently, please retry")
+    
+    # A reassigned order frees its previous driver
+    if previous_driver_id:
+        await release_driver(previous_driver_id)
     
     return {"message": "Driver assigned successfully"}
 
 # ==================== DRIVER ROUTES ====================
 
 @api_router.post("/drivers", response_model=Driver)
-async def create_driver_profile(driver_data: DriverCreate, current_user: Dict = Depends(get_current_user)):
-    """Create driver profile"""
+async def create_driver_profile(driver_data: DriverCreate, response: Response, current_user: Dict = Depends(get_current_user)):
+    """Create driver profile.
+    
+    The X-Auth-Token response header carries a token scoped to the new profile.
+    """
     if current_user['role'] != UserRole.DRIVER:
         raise HTTPException(status_code=403, detail="Only drivers can create driver profiles")
     
@@ -1098,11 +1949,14 @@ async def create_driver_profile(driver_data: DriverCreate, current_user: Dict =
         **driver_data.model_dump()
     )
     
-    driver_dict = driver.model_dump()
-    driver_dict['created_at'] = driver_dict['created_at'].isoformat()
+    driver_dict = to_document(driver)
     
     await db.drivers.insert_one(driver_dict)
     
+    scope = {"driver_id": driver.id, "driver_state": driver.state}
+    scope_cache[current_user['id']] = scope
+    response.headers["X-Auth-Token"] = create_jwt_token(current_user['id'], current_user['role'], scope)
+    
     return driver
 
 @api_router.get("/drivers/my", response_model=Driver)
@@ -1111,89 +1965,1004 @@ async def get_my_driver_profile(current_user: Dict = Depends(get_current_user)):
     if current_user['role'] != UserRole.DRIVER:
         raise HTTPException(status_code=403, detail="Only drivers can access this")
     
-    driver = await db.drivers.find_one({"user_id": current_user['id']}, {"_id": 0})
+    driver = await db.drivers.find_one({"user_id": current_user['id']}, DRIVER_PROJECTION)
     if not driver:
         raise HTTPException(status_code=404, detail="Driver profile not found")
     
     return driver
 
-@api_router.get("/drivers/available-orders", response_model=List[Order])
-async def get_available_orders(current_user: Dict = Depends(get_current_user)):
-    """Get available orders for drivers"""
-    if current_user['role'] != UserRole.DRIVER:
-        raise HTTPException(status_code=403, detail="Only drivers can access this")
+@api_router.get("/drivers/available-orders", response_model=List[AvailableOrder])
+async def get_available_orders(radius_km: float = Query(DISPATCH_MAX_PICKUP_KM, gt=0), limit: int = Query(100, ge=1, le=100), driver_scope: Dict = Depends(current_driver)):
+    """Get available orders for drivers, nearest pickup first"""
+    # Position changes every few seconds, so it is read fresh rather than carried in the token
+    driver = await db.drivers.find_one(
+        {"id": driver_scope['id']},
+        {"_id": 0, "current_location": 1, "state": 1}
+    )
+    if not driver:
+        raise HTTPException(status_code=404, detail="Driver profile not found")
     
-    # Get orders that are accepted but not assigned to any driver
-    orders = await db.orders.find({
+    # Orders that are accepted but not assigned to any driver
+    query = {
         "status": OrderStatus.ACCEPTED,
-        "driver_id": None
-    }, {"_id": 0}).to_list(100)
+        "driver_id": None,
+        "trip_id": None
+    }
+    
+    location = driver.get('current_location')
+    if location:
+        orders = await db.orders.aggregate([
+            {"$geoNear": {
+                "near": geo_point(location['lat'], location['lng']),
+                "key": "pickup_location",
+                "distanceField": "pickup_distance_m",
+                "maxDistance": radius_km * 1000,
+                "query": query,
+                "spherical": True
+            }},
+            {"$limit": limit},
+            {"$project": {"_id": 0}}
+        ]).to_list(limit)
+    else:
+        # No known position yet; fall back to unranked results
+        orders = await db.orders.find(query, {"_id": 0}).to_list(limit)
+    
+    for order in orders:
+        distance_m = order.pop('pickup_distance_m', None)
+        order['pickup_distance_km'] = round(distance_m / 1000, 2) if distance_m is not None else None
+        order['driver_earning'] = calculate_driver_earning(order['distance_km'], driver.get('state'))
     
     return orders
 
 @api_router.put("/drivers/location")
-async def update_driver_location(location: Location, current_user: Dict = Depends(get_current_user)):
-    """Update driver's current location"""
-    if current_user['role'] != UserRole.DRIVER:
-        raise HTTPException(status_code=403, detail="Only drivers can update location")
-    
-    driver = await db.drivers.find_one({"user_id": current_user['id']})
+async def update_driver_location(location: Location, order_id: Optional[str] = None, driver_scope: Dict = Depends(current_driver)):
+    """Update driver's current location and append it to the GPS trail"""
+    driver = await db.drivers.find_one_and_update(
+        {"id": driver_scope['id']},
+        {"$set": {"current_location": location.model_dump()}},
+        {"_id": 0, "id": 1, "is_available": 1}
+    )
     if not driver:
         raise HTTPException(status_code=404, detail="Driver profile not found")
     
-    await db.drivers.update_one(
-        {"user_id": current_user['id']},
-        {"$set": {"current_location": location.model_dump()}}
-    )
+    if driver.get('is_available', True):
+        driver_index.upsert(driver['id'], location.lat, location.lng)
+    else:
+        driver_index.remove(driver['id'])
+    
+    # Attach the ping to the driver's active delivery (if any)
+    order_query = {"driver_id": driver['id'], "status": {"$in": ACTIVE_DELIVERY_STATUSES}}
+    if order_id:
+        order_query["id"] = order_id
+    active_order = await db.orders.find_one(order_query, {"_id": 0, "id": 1})
+    
+    await record_location_ping(driver['id'], active_order['id'] if active_order else None, location)
     
     return {"message": "Location updated"}
 
-# ==================== PAYMENT ROUTES ====================
+# ==================== DRIVER LOCATION TRAILS ====================
 
-@api_router.post("/payments/create-razorpay-order")
-async def create_razorpay_order(payment_data: CreateRazorpayOrder, current_user: Dict = Depends(get_current_user)):
-    """Create Razorpay order for payment"""
-    if not razorpay_client:
-        raise HTTPException(status_code=500, detail="Payment gateway not configured")
-    
-    order = await db.orders.find_one({"id": payment_data.order_id})
-    if not order:
-        raise HTTPException(status_code=404, detail="Order not found")
+# Orders a driver is still moving for; pings are attached to these
+ACTIVE_DELIVERY_STATUSES = [
+    OrderStatus.ACCEPTED,
+    OrderStatus.PREPARING,
+    OrderStatus.PICKED_UP,
+    OrderStatus.IN_TRANSIT,
+]
+
+async def ensure_trail_collections():
+    """Create the time-series collection for raw pings and the trail archive indexes"""
+    try:
+        await db.create_collection(
+            "driver_locations",
+            timeseries={"timeField": "ts", "metaField": "meta", "granularity": "seconds"},
+            expireAfterSeconds=TRAIL_RAW_RETENTION_DAYS * 24 * 60 * 60
+        )
+    except CollectionInvalid:
+        pass  # Already exists
     
-    if order['customer_id'] != current_user['id']:
-        raise HTTPException(status_code=403, detail="Not authorized")
+    # Replay reads are a single range scan on (order, time)
+    await db.driver_locations.create_index([("meta.order_id", 1), ("ts", 1)])
+    await db.driver_locations.create_index([("meta.driver_id", 1), ("ts", 1)])
     
-    try:
-        # Create Razorpay order
-        razorpay_order = razorpay_client.order.create({
-            "amount": int(payment_data.amount * 100),  # Convert to paise
-            "currency": "INR",
-            "payment_capture": 1
-        })
+    await db.order_trails.create_index("order_id", unique=True)
+    await db.order_trails.create_index(
+        "archived_at",
+        expireAfterSeconds=TRAIL_ARCHIVE_RETENTION_DAYS * 24 * 60 * 60
+    )
+    await db.orders.create_index([("status", 1), ("updated_at", 1)])
+
+async def record_location_ping(driver_id: str, order_id: Optional[str], location: Location):
+    """Append a location ping to the driver's trail"""
+    await db.driver_locations.insert_one({
+        "ts": datetime.now(timezone.utc),
+        "meta": {"driver_id": driver_id, "order_id": order_id},
+        "lat": location.lat,
+        "lng": location.lng
+    })
+
+def simplify_polyline(points: List[tuple], tolerance_m: float) -> List[tuple]:
+    """Douglas-Peucker simplification of (lat, lng, ts) points with a tolerance in metres"""
+    if len(points) <= 2 or tolerance_m <= 0:
+        return list(points)
+    
+    # Project onto a local equirectangular plane (metres) around the first point
+    R = 6371000
+    lat0 = radians(points[0][0])
+    xy = [
+        (radians(p[1]) * cos(lat0) * R, radians(p[0]) * R)
+        for p in points
+    ]
+    
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    
+    while stack:
+        start, end = stack.pop()
+        (x1, y1), (x2, y2) = xy[start], xy[end]
+        dx, dy = x2 - x1, y2 - y1
+        seg_len_sq = dx * dx + dy * dy
         
-        # Save Razorpay order ID
-        await db.orders.update_one(
-            {"id": payment_data.order_id},
-            {"$set": {"razorpay_order_id": razorpay_order['id']}}
-        )
+        max_dist_sq, index = 0.0, -1
+        for i in range(start + 1, end):
+            px, py = xy[i]
+            if seg_len_sq == 0:
+                dist_sq = (px - x1) ** 2 + (py - y1) ** 2
+            else:
+                # Distance to the segment, clamped to its endpoints
+                t = max(0.0, min(1.0, ((px - x1) * dx + (py - y1) * dy) / seg_len_sq))
+                dist_sq = (px - x1 - t * dx) ** 2 + (py - y1 - t * dy) ** 2
+            if dist_sq > max_dist_sq:
+                max_dist_sq, index = dist_sq, i
         
-        return {
-            "razorpay_order_id": razorpay_order['id'],
-            "amount": razorpay_order['amount'],
-            "currency": razorpay_order['currency'],
-            "key_id": RAZORPAY_KEY_ID
-        }
-    except Exception as e:
-        logging.error(f"Razorpay order creation failed: {str(e)}")
-        raise HTTPException(status_code=500, detail="Failed to create payment order")
+        if index != -1 and max_dist_sq > tolerance_m * tolerance_m:
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+    
+    return [p for p, kept in zip(points, keep) if kept]
 
-@api_router.post("/payments/verify")
-async def verify_payment(payment_data: VerifyPayment, current_user: Dict = Depends(get_current_user)):
-    """Verify Razorpay payment"""
-    if not razorpay_client:
-        raise HTTPException(status_code=500, detail="Payment gateway not configured")
+def polyline_distance(points: List[tuple]) -> float:
+    """Total length in km of a (lat, lng, ...) polyline"""
+    return round(sum(
+        calculate_distance(a[0], a[1], b[0], b[1])
+        for a, b in zip(points, points[1:])
+    ), 2)
+
+async def load_raw_trail(order_id: str) -> List[tuple]:
+    """Read all raw pings for an order in time order"""
+    cursor = db.driver_locations.find(
+        {"meta.order_id": order_id},
+        {"_id": 0, "lat": 1, "lng": 1, "ts": 1}
+    ).sort("ts", 1)
+    return [(p['lat'], p['lng'], p['ts']) async for p in cursor]
+
+async def archive_order_trail(order: Dict) -> Optional[Dict]:
+    """Downsample an order's raw pings into a compact archived trail"""
+    raw_points = await load_raw_trail(order['id'])
+    simplified = simplify_polyline(raw_points, TRAIL_ARCHIVE_TOLERANCE_M)
+    
+    trail = {
+        "order_id": order['id'],
+        "driver_id": order.get('driver_id'),
+        "points": [[p[0], p[1], p[2]] for p in simplified],
+        "raw_point_count": len(raw_points),
+        "distance_km": polyline_distance(raw_points),
+        "archived_at": datetime.now(timezone.utc)
+    }
     
-    order = await db.orders.find_one({"id": payment_data.order_id})
+    await db.order_trails.update_one({"order_id": order['id']}, {"$set": trail}, upsert=True)
+    await db.orders.update_one({"id": order['id']}, {"$set": {"trail_archived": True}})
+    return trail
+
+async def trail_downsampling_loop(interval_seconds: int = 600):
+    """Periodically archive trails of finished orders; raw pings then expire via TTL"""
+    while True:
+        try:
+            cutoff = datetime.now(timezone.utc) - timedelta(minutes=TRAIL_ARCHIVE_DELAY_MINUTES)
+            finished = await db.orders.find({
+                "status": {"$in": [OrderStatus.DELIVERED, OrderStatus.CANCELLED]},
+                "updated_at": {"$lt": cutoff},
+                "driver_id": {"$ne": None},
+                "trail_archived": {"$ne": True}
+            }, {"_id": 0, "id": 1, "driver_id": 1}).to_list(100)
+            
+            for order in finished:
+                await archive_order_trail(order)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Trail downsampling failed: {str(e)}")
+        
+        await asyncio.sleep(interval_seconds)
+
+@api_router.get("/orders/{order_id}/trail")
+async def get_order_trail(order_id: str, request: Request, tolerance_m: float = 10.0, current_user: Dict = Depends(get_current_user)):
+    """Get the simplified driver route for an order"""
+    # Reuses get_order's authorization checks
+    order = await get_order(order_id, request, current_user)
+    
+    archived = await db.order_trails.find_one({"order_id": order_id}, {"_id": 0})
+    if archived:
+        points = [tuple(p) for p in archived['points']]
+        raw_point_count = archived['raw_point_count']
+        distance_km = archived['distance_km']
+    else:
+        points = await load_raw_trail(order_id)
+        raw_point_count = len(points)
+        distance_km = polyline_distance(points)
+    
+    simplified = simplify_polyline(points, tolerance_m)
+    
+    return {
+        "order_id": order_id,
+        "driver_id": order.get('driver_id'),
+        "archived": archived is not None,
+        "raw_point_count": raw_point_count,
+        "distance_km": distance_km,
+        "points": [{"lat": p[0], "lng": p[1], "ts": p[2]} for p in simplified]
+    }
+
+# ==================== DISPATCH ====================
+
+class DriverGridIndex:
+    """In-memory uniform lat/lng grid of available drivers for nearest-driver lookups"""
+    
+    def __init__(self, cell_size_deg: float = DISPATCH_GRID_CELL_DEG):
+        self.cell_size = cell_size_deg
+        self.cells: Dict[tuple, Dict[str, tuple]] = {}
+        self.positions: Dict[str, tuple] = {}  # driver_id -> (lat, lng, cell)
+    
+    def __len__(self) -> int:
+        return len(self.positions)
+    
+    def _cell(self, lat: float, lng: float) -> tuple:
+        return (int(lat // self.cell_size), int(lng // self.cell_size))
+    
+    def upsert(self, driver_id: str, lat: float, lng: float):
+        """Add a driver or move them to a new position"""
+        cell = self._cell(lat, lng)
+        previous = self.positions.get(driver_id)
+        if previous and previous[2] != cell:
+            self._remove_from_cell(driver_id, previous[2])
+        self.cells.setdefault(cell, {})[driver_id] = (lat, lng)
+        self.positions[driver_id] = (lat, lng, cell)
+    
+    def remove(self, driver_id: str):
+        """Drop a driver from the index (no-op if absent)"""
+        previous = self.positions.pop(driver_id, None)
+        if previous:
+            self._remove_from_cell(driver_id, previous[2])
+    
+    def clear(self):
+        self.cells.clear()
+        self.positions.clear()
+    
+    def _remove_from_cell(self, driver_id: str, cell: tuple):
+        bucket = self.cells.get(cell)
+        if bucket is not None:
+            bucket.pop(driver_id, None)
+            if not bucket:
+                del self.cells[cell]
+    
+    def nearest(self, lat: float, lng: float, k: int = 5, max_radius_km: float = DISPATCH_MAX_PICKUP_KM) -> List[tuple]:
+        """Return up to k (distance_km, driver_id) pairs, closest first, within max_radius_km"""
+        if not self.positions or k <= 0:
+            return []
+        
+        # Equirectangular approximation for ranking; exact distance only for the winners
+        km_per_deg_lat = 111.32
+        km_per_deg_lng = 111.32 * cos(radians(lat))
+        ring_km = self.cell_size * min(km_per_deg_lat, km_per_deg_lng)
+        max_ring = ceil(max_radius_km / ring_km) + 1
+        max_radius_sq = max_radius_km * max_radius_km
+        
+        ci, cj = self._cell(lat, lng)
+        best: List[tuple] = []  # max-heap of (-dist_sq, driver_id)
+        
+        for ring in range(max_ring + 1):
+            for i in range(ci - ring, ci + ring + 1):
+                on_edge_row = i == ci - ring or i == ci + ring
+                step = 1 if on_edge_row else 2 * ring
+                for j in range(cj - ring, cj + ring + 1, step or 1):
+                    bucket = self.cells.get((i, j))
+                    if not bucket:
+                        continue
+                    for driver_id, (dlat, dlng) in bucket.items():
+                        dy = (dlat - lat) * km_per_deg_lat
+                        dx = (dlng - lng) * km_per_deg_lng
+                        dist_sq = dx * dx + dy * dy
+                        if dist_sq > max_radius_sq:
+                            continue
+                        if len(best) < k:
+                            heapq.heappush(best, (-dist_sq, driver_id))
+                        elif dist_sq < -best[0][0]:
+                            heapq.heapreplace(best, (-dist_sq, driver_id))
+            
+            # Any cell outside this ring is at least ring * cell width away
+            if len(best) == k and -best[0][0] <= (ring * ring_km) ** 2:
+                break
+        
+        results = []
+        for _, driver_id in best:
+            dlat, dlng, _ = self.positions[driver_id]
+            results.append((calculate_distance(lat, lng, dlat, dlng), driver_id))
+        results.sort()
+        return results
+
+driver_index = DriverGridIndex()
+
+async def load_driver_index():
+    """Rebuild the dispatch index from available drivers with a known location"""
+    drivers = await db.drivers.find(
+        {"is_available": True, "current_location": {"$ne": None}},
+        {"_id": 0, "id": 1, "current_location": 1}
+    ).to_list(None)
+    
+    driver_index.clear()
+    for driver in drivers:
+        driver_index.upsert(driver['id'], driver['current_location']['lat'], driver['current_location']['lng'])
+
+async def driver_index_sync_loop(interval_seconds: int = 60):
+    """Resync the index so pings handled by other app processes are picked up"""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await load_driver_index()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Driver index sync failed: {str(e)}")
+
+async def release_driver(driver_id: str):
+    """Return a driver to the dispatch pool"""
+    driver = await db.drivers.find_one_and_update(
+        {"id": driver_id},
+        {"$set": {"is_available": True}},
+        {"_id": 0, "current_location": 1}
+    )
+    if driver and driver.get('current_location'):
+        driver_index.upsert(driver_id, driver['current_location']['lat'], driver['current_location']['lng'])
+
+async def claim_driver_for_order(order_id: str, driver_id: str) -> bool:
+    """Atomically take an available driver and assign them to an unassigned order"""
+    driver = await db.drivers.find_one_and_update(
+        {"id": driver_id, "is_available": True},
+        {"$set": {"is_available": False}}
+    )
+    driver_index.remove(driver_id)
+    if not driver:
+        return False
+    
+    result = await db.orders.update_one(
+        {"id": order_id, "driver_id": None},
+        {"$set": {"driver_id": driver_id, "updated_at": datetime.now(timezone.utc)}}
+    )
+    if result.modified_count == 0:
+        # Order was assigned concurrently; give the driver back
+        await release_driver(driver_id)
+        return False
+    
+    return True
+
+async def auto_assign_driver(order_id: str, pharmacy: Dict) -> Optional[str]:
+    """Assign the nearest available driver to an order, returning their id"""
+    candidates = driver_index.nearest(pharmacy['location']['lat'], pharmacy['location']['lng'], k=5)
+    for _, driver_id in candidates:
+        if await claim_driver_for_order(order_id, driver_id):
+            return driver_id
+    return None
+
+def pairwise_distances(origins: np.ndarray, destinations: np.ndarray) -> np.ndarray:
+    """Distance matrix in km between (lat, lng) rows, same formula and rounding as calculate_distance"""
+    lat1 = np.radians(origins[:, 0])[:, None]
+    lng1 = np.radians(origins[:, 1])[:, None]
+    lat2 = np.radians(destinations[:, 0])[None, :]
+    lng2 = np.radians(destinations[:, 1])[None, :]
+    
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return np.round(6371 * c, 2)
+
+def solve_assignment(pickups: List[tuple], drivers: List[tuple], max_pickup_km: float = DISPATCH_MAX_PICKUP_KM) -> List[tuple]:
+    """Match pickups to drivers minimising total pickup distance.
+    
+    Returns (pickup_index, driver_index, distance_km) for every feasible pair.
+    """
+    if not pickups or not drivers:
+        return []
+    
+    distances = pairwise_distances(np.asarray(pickups, dtype=float), np.asarray(drivers, dtype=float))
+    
+    # Pairs beyond the pickup radius get a prohibitive cost and are dropped afterwards
+    infeasible = distances > max_pickup_km
+    costs = np.where(infeasible, 1e6, distances)
+    rows, cols = linear_sum_assignment(costs)
+    
+    return [
+        (int(row), int(col), float(distances[row, col]))
+        for row, col in zip(rows, cols)
+        if not infeasible[row, col]
+    ]
+
+def select_match_candidates(pickups: List[tuple], index: "DriverGridIndex", per_order: int = DISPATCH_MATCH_CANDIDATES,
+                            max_pickup_km: float = DISPATCH_MAX_PICKUP_KM) -> List[tuple]:
+    """Drivers worth offering to the solver: the union of each pickup's nearest drivers.
+    
+    Keeps the cost matrix at most M x (per_order * M) however many drivers are
+    online. Returns (driver_id, lat, lng) sorted by id so passes are repeatable.
+    """
+    candidates = set()
+    # Orders from one pharmacy share a pickup point; one wider lookup covers them all
+    for (lat, lng), count in Counter(pickups).items():
+        for _, driver_id in index.nearest(lat, lng, k=per_order * count, max_radius_km=max_pickup_km):
+            candidates.add(driver_id)
+    return [(driver_id, *index.positions[driver_id][:2]) for driver_id in sorted(candidates)]
+
+async def run_batch_matching() -> List[Dict]:
+    """One matching pass over unassigned orders and available drivers"""
+    orders = await db.orders.find(
+        {"status": {"$in": [OrderStatus.ACCEPTED, OrderStatus.PREPARING]}, "driver_id": None, "trip_id": None},
+        {"_id": 0, "id": 1, "pharmacy_id": 1}
+    ).sort("created_at", 1).to_list(DISPATCH_MATCH_MAX_ORDERS)
+    if not orders or not len(driver_index):
+        return []
+    
+    pharmacy_ids = list({order['pharmacy_id'] for order in orders})
+    pharmacies = await db.pharmacies.find(
+        {"id": {"$in": pharmacy_ids}},
+        {"_id": 0, "id": 1, "location": 1}
+    ).to_list(None)
+    locations = {p['id']: (p['location']['lat'], p['location']['lng']) for p in pharmacies}
+    
+    orders = [order for order in orders if order['pharmacy_id'] in locations]
+    pickups = [locations[order['pharmacy_id']] for order in orders]
+    drivers = select_match_candidates(pickups, driver_index)
+    
+    pairs = solve_assignment(pickups, [(lat, lng) for _, lat, lng in drivers])
+    
+    # Each pair is applied with conditional writes, so concurrent manual
+    # assignments or driver state changes simply cause that pair to be skipped
+    claimed = await asyncio.gather(*[
+        claim_driver_for_order(orders[row]['id'], drivers[col][0])
+        for row, col, _ in pairs
+    ])
+    
+    return [
+        {"order_id": orders[row]['id'], "driver_id": drivers[col][0], "distance_km": distance}
+        for (row, col, distance), ok in zip(pairs, claimed)
+        if ok
+    ]
+
+async def batch_matching_loop(interval_seconds: int = DISPATCH_MATCH_INTERVAL_SECONDS):
+    """Periodically match pending orders to free drivers"""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            assignments = await run_batch_matching()
+            if assignments:
+                logging.info(f"Batch matching assigned {len(assignments)} orders")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Batch matching failed: {str(e)}")
+
+@api_router.get("/dispatch/nearest-drivers")
+async def get_nearest_drivers(k: int = 5, max_radius_km: float = DISPATCH_MAX_PICKUP_KM, pharmacy_scope: Dict = Depends(current_pharmacy)):
+    """Get the nearest available drivers to the current pharmacy"""
+    pharmacy = await db.pharmacies.find_one({"id": pharmacy_scope['id']}, {"_id": 0, "location": 1})
+    if not pharmacy:
+        raise HTTPException(status_code=404, detail="Pharmacy not found")
+    
+    nearest = driver_index.nearest(
+        pharmacy['location']['lat'],
+        pharmacy['location']['lng'],
+        k=min(k, 50),
+        max_radius_km=max_radius_km
+    )
+    
+    return [
+        {
+            "driver_id": driver_id,
+            "distance_km": distance,
+            "estimated_pickup_time": estimate_delivery_time(distance)
+        }
+        for distance, driver_id in nearest
+    ]
+
+# ==================== TRIP BATCHING ====================
+
+def calculate_bearing(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Initial compass bearing in degrees from the first point to the second"""
+    lat1, lng1, lat2, lng2 = map(radians, [lat1, lng1, lat2, lng2])
+    dlng = lng2 - lng1
+    x = sin(dlng) * cos(lat2)
+    y = cos(lat1) * sin(lat2) - sin(lat1) * cos(lat2) * cos(dlng)
+    return (degrees(atan2(x, y)) + 360) % 360
+
+def bearing_difference(a: float, b: float) -> float:
+    diff = abs(a - b) % 360
+    return min(diff, 360 - diff)
+
+def plan_drop_sequence(origin: tuple, drops: List[tuple]) -> List[int]:
+    """Open-path TSP from origin over drops: nearest neighbour, then 2-opt. Returns drop indices in visit order."""
+    remaining = list(range(len(drops)))
+    route = []
+    current = origin
+    while remaining:
+        nxt = min(remaining, key=lambda i: calculate_distance(current[0], current[1], drops[i][0], drops[i][1]))
+        route.append(nxt)
+        remaining.remove(nxt)
+        current = drops[nxt]
+    
+    def point(position: int) -> tuple:
+        return origin if position < 0 else drops[route[position]]
+    
+    def dist(a: tuple, b: tuple) -> float:
+        return calculate_distance(a[0], a[1], b[0], b[1])
+    
+    improved = True
+    while improved:
+        improved = False
+        for i in range(len(route) - 1):
+            for j in range(i + 1, len(route)):
+                # Reverse route[i..j]; the path is open so the last edge may not exist
+                before = dist(point(i - 1), point(i))
+                after = dist(point(i - 1), point(j))
+                if j + 1 < len(route):
+                    before += dist(point(j), point(j + 1))
+                    after += dist(point(i), point(j + 1))
+                if after < before - 1e-9:
+                    route[i:j + 1] = reversed(route[i:j + 1])
+                    improved = True
+    
+    return route
+
+def plan_trip_stops(pickup: tuple, orders: List[Dict], start_km: float = 0.0) -> List[TripStop]:
+    """Sequence an order batch from the pickup and recompute per-order ETAs along the route.
+    
+    start_km is the route distance already covered before pickup (when re-planning mid-trip).
+    """
+    drops = [(o['delivery_address']['lat'], o['delivery_address']['lng']) for o in orders]
+    stops = []
+    cumulative = start_km
+    previous = pickup
+    for index in plan_drop_sequence(pickup, drops):
+        leg = calculate_distance(previous[0], previous[1], drops[index][0], drops[index][1])
+        cumulative = round(cumulative + leg, 2)
+        stops.append(TripStop(
+            order_id=orders[index]['id'],
+            location=Location(**orders[index]['delivery_address']),
+            leg_distance_km=leg,
+            cumulative_distance_km=cumulative,
+            estimated_time=estimate_delivery_time(cumulative)
+        ))
+        previous = drops[index]
+    return stops
+
+def group_orders_for_trips(pickup: tuple, orders: List[Dict]) -> List[List[Dict]]:
+    """Group one pharmacy's pending orders by time window, direction and drop proximity"""
+    def created(order: Dict) -> datetime:
+        return as_utc(order['created_at'])
+    
+    for order in orders:
+        order['_bearing'] = calculate_bearing(
+            pickup[0], pickup[1],
+            order['delivery_address']['lat'], order['delivery_address']['lng']
+        )
+    
+    groups = []
+    unassigned = sorted(orders, key=created)
+    while unassigned:
+        seed = unassigned.pop(0)
+        group = [seed]
+        for order in list(unassigned):
+            if len(group) >= TRIP_MAX_ORDERS:
+                break
+            if (created(order) - created(seed)) > timedelta(minutes=TRIP_BATCH_WINDOW_MINUTES):
+                break
+            if bearing_difference(order['_bearing'], seed['_bearing']) > TRIP_MAX_BEARING_SPREAD_DEG / 2:
+                continue
+            if calculate_distance(
+                order['delivery_address']['lat'], order['delivery_address']['lng'],
+                seed['delivery_address']['lat'], seed['delivery_address']['lng']
+            ) > TRIP_MAX_DROP_SPREAD_KM:
+                continue
+            group.append(order)
+            unassigned.remove(order)
+        if len(group) > 1:
+            groups.append(group)
+    
+    for order in orders:
+        order.pop('_bearing', None)
+    return groups
+
+async def apply_trip_plan(trip_id: str, stops: List[TripStop], sequences: List[int]):
+    """Write the stops' sequence numbers, legs and ETAs onto their orders.
+    
+    record_delivery pays the base fare to the stop with sequence 0 and each
+    stop its leg, so a sequence number must never be handed out twice.
+    """
+    await db.orders.bulk_write([
+        UpdateOne(
+            {"id": stop.order_id},
+            {"$set": {
+                "trip_id": trip_id,
+                "trip_sequence": sequence,
+                "trip_leg_km": stop.leg_distance_km,
+                "estimated_time": stop.estimated_time,
+                "updated_at": datetime.now(timezone.utc)
+            }}
+        )
+        for sequence, stop in zip(sequences, stops)
+    ], ordered=False)
+
+async def run_trip_batching() -> List[Trip]:
+    """One batching pass over unassigned orders, creating trips for compatible groups"""
+    # Orders released from an expired trip are not batched again
+    orders = await db.orders.find(
+        {
+            "status": {"$in": [OrderStatus.ACCEPTED, OrderStatus.PREPARING]},
+            "driver_id": None,
+            "trip_id": None,
+            "trip_released": {"$ne": True}
+        },
+        {"_id": 0, "id": 1, "pharmacy_id": 1, "delivery_address": 1, "created_at": 1}
+    ).to_list(2000)
+    
+    by_pharmacy: Dict[str, List[Dict]] = {}
+    for order in orders:
+        by_pharmacy.setdefault(order['pharmacy_id'], []).append(order)
+    by_pharmacy = {pid: group for pid, group in by_pharmacy.items() if len(group) > 1}
+    if not by_pharmacy:
+        return []
+    
+    pharmacies = await db.pharmacies.find(
+        {"id": {"$in": list(by_pharmacy)}},
+        {"_id": 0, "id": 1, "location": 1}
+    ).to_list(None)
+    
+    trips = []
+    for pharmacy in pharmacies:
+        pickup = (pharmacy['location']['lat'], pharmacy['location']['lng'])
+        for group in group_orders_for_trips(pickup, by_pharmacy[pharmacy['id']]):
+            stops = plan_trip_stops(pickup, group)
+            trip = Trip(
+                pharmacy_id=pharmacy['id'],
+                order_ids=[stop.order_id for stop in stops],
+                stops=stops,
+                total_distance_km=stops[-1].cumulative_distance_km
+            )
+            
+            # Claim the orders; back out if any was assigned in the meantime
+            result = await db.orders.update_many(
+                {"id": {"$in": trip.order_ids}, "driver_id": None, "trip_id": None},
+                {"$set": {"trip_id": trip.id}}
+            )
+            if result.modified_count != len(trip.order_ids):
+                await db.orders.update_many({"trip_id": trip.id}, {"$set": {"trip_id": None}})
+                continue
+            
+            trip_dict = to_document(trip)
+            await db.trips.insert_one(trip_dict)
+            await apply_trip_plan(trip.id, trip.stops, list(range(len(trip.stops))))
+            trips.append(trip)
+    
+    return trips
+
+async def detach_order_from_trip(order: Dict):
+    """Remove a cancelled order from its trip and re-plan the stops still to be delivered.
+    
+    Delivered stops have been paid, so they keep their sequence numbers and legs.
+    The rest are re-planned from the last delivered drop (or the pharmacy) and
+    reuse the sequence numbers not yet paid, so the base fare (sequence 0) and
+    the distance already covered are paid once.
+    """
+    trip = await db.trips.find_one({"id": order['trip_id']}, {"_id": 0})
+    if not trip:
+        return
+    
+    trip_orders = await db.orders.find(
+        {"trip_id": trip['id'], "id": {"$ne": order['id']}, "status": {"$ne": OrderStatus.CANCELLED}},
+        {"_id": 0, "id": 1, "status": 1, "delivery_address": 1, "trip_sequence": 1}
+    ).to_list(None)
+    delivered = sorted(
+        (o for o in trip_orders if o['status'] == OrderStatus.DELIVERED),
+        key=lambda o: o['trip_sequence']
+    )
+    remaining = [o for o in trip_orders if o['status'] != OrderStatus.DELIVERED]
+    
+    if not remaining:
+        await db.trips.update_one({"id": trip['id']}, {"$set": {"status": "completed", "updated_at": datetime.now(timezone.utc)}})
+        if trip.get('driver_id'):
+            await release_driver(trip['driver_id'])
+        return
+    
+    stops_by_order = {stop['order_id']: TripStop(**stop) for stop in trip['stops']}
+    delivered_stops = [stops_by_order[o['id']] for o in delivered]
+    if delivered_stops:
+        origin = (delivered_stops[-1].location.lat, delivered_stops[-1].location.lng)
+        start_km = delivered_stops[-1].cumulative_distance_km
+    else:
+        pharmacy = await db.pharmacies.find_one({"id": trip['pharmacy_id']}, {"_id": 0, "location": 1})
+        origin = (pharmacy['location']['lat'], pharmacy['location']['lng'])
+        start_km = 0.0
+    stops = plan_trip_stops(origin, remaining, start_km)
+    
+    paid = {o['trip_sequence'] for o in delivered}
+    unpaid = [sequence for sequence in range(len(trip['stops'])) if sequence not in paid]
+    
+    all_stops = delivered_stops + stops
+    await db.trips.update_one(
+        {"id": trip['id']},
+        {"$set": {
+            "order_ids": [stop.order_id for stop in all_stops],
+            "stops": [stop.model_dump() for stop in all_stops],
+            "total_distance_km": all_stops[-1].cumulative_distance_km,
+            "updated_at": datetime.now(timezone.utc)
+        }}
+    )
+    await apply_trip_plan(trip['id'], stops, unpaid[:len(stops)])
+
+async def expire_open_trips() -> int:
+    """Dissolve trips no driver accepted in time, handing their orders back to single dispatch"""
+    cutoff = datetime.now(timezone.utc) - timedelta(minutes=TRIP_OPEN_MINUTES)
+    stale = await db.trips.find({"status": "open", "created_at": {"$lt": cutoff}}, {"_id": 0, "id": 1}).to_list(500)
+    
+    expired = 0
+    for trip in stale:
+        # Conditional on still being open so a concurrent accept wins cleanly
+        claimed = await db.trips.find_one_and_update(
+            {"id": trip['id'], "status": "open"},
+            {"$set": {"status": "expired", "updated_at": datetime.now(timezone.utc)}}
+        )
+        if not claimed:
+            continue
+        
+        orders = await db.orders.find(
+            {"trip_id": trip['id'], "driver_id": None},
+            {"_id": 0, "id": 1, "distance_km": 1}
+        ).to_list(None)
+        if orders:
+            await db.orders.bulk_write([
+                UpdateOne(
+                    {"id": o['id'], "trip_id": trip['id'], "driver_id": None},
+                    {
+                        "$set": {
+                            "trip_id": None,
+                            "trip_released": True,
+                            "estimated_time": estimate_delivery_time(o['distance_km']),
+                            "updated_at": datetime.now(timezone.utc)
+                        },
+                        "$unset": {"trip_sequence": "", "trip_leg_km": ""}
+                    }
+                )
+                for o in orders
+            ], ordered=False)
+        expired += 1
+    return expired
+
+async def trip_batching_loop(interval_seconds: int = TRIP_BATCHING_INTERVAL_SECONDS):
+    """Periodically batch compatible orders into trips"""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            expired = await expire_open_trips()
+            if expired:
+                logging.info(f"Trip batching released {expired} unaccepted trips")
+            trips = await run_trip_batching()
+            if trips:
+                logging.info(f"Trip batching created {len(trips)} trips")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Trip batching failed: {str(e)}")
+
+@api_router.get("/drivers/available-trips")
+async def get_available_trips(driver: Dict = Depends(current_driver)):
+    """Get open multi-order trips with the driver's payout for the whole route"""
+    trips = await db.trips.find({"status": "open"}, {"_id": 0}).to_list(100)
+    for trip in trips:
+        trip['earning'] = calculate_driver_earning(trip['total_distance_km'], driver['state'])
+    
+    return trips
+
+@api_router.get("/trips/{trip_id}")
+async def get_trip(trip_id: str, request: Request, current_user: Dict = Depends(get_current_user)):
+    """Get trip details for its driver or pharmacy"""
+    trip = await db.trips.find_one({"id": trip_id}, {"_id": 0})
+    if not trip:
+        raise HTTPException(status_code=404, detail="Trip not found")
+    
+    scope = await resolve_user_scope(request, current_user)
+    if current_user['role'] == UserRole.PHARMACY:
+        if trip['pharmacy_id'] != scope.get('pharmacy_id'):
+            raise HTTPException(status_code=403, detail="Not authorized to view this trip")
+    elif current_user['role'] == UserRole.DRIVER:
+        if not scope.get('driver_id') or trip.get('driver_id') not in (None, scope['driver_id']):
+            raise HTTPException(status_code=403, detail="Not authorized to view this trip")
+    else:
+        raise HTTPException(status_code=403, detail="Not authorized to view this trip")
+    
+    return trip
+
+@api_router.post("/trips/{trip_id}/accept")
+async def accept_trip(trip_id: str, driver: Dict = Depends(current_driver)):
+    """Driver takes every order of an open trip"""
+    # Same guard as claim_driver_for_order: a driver already on a delivery cannot take a trip
+    claimed = await db.drivers.find_one_and_update(
+        {"id": driver['id'], "is_available": True},
+        {"$set": {"is_available": False}}
+    )
+    if not claimed:
+        raise HTTPException(status_code=400, detail="Finish your current delivery before accepting a trip")
+    driver_index.remove(driver['id'])
+    
+    trip = await db.trips.find_one_and_update(
+        {"id": trip_id, "status": "open"},
+        {"$set": {"status": "assigned", "driver_id": driver['id'], "updated_at": datetime.now(timezone.utc)}},
+        {"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not trip:
+        await release_driver(driver['id'])
+        raise HTTPException(status_code=400, detail="Trip is no longer available")
+    
+    await db.orders.update_many(
+        {"trip_id": trip_id, "driver_id": None},
+        {"$set": {"driver_id": driver['id'], "updated_at": datetime.now(timezone.utc)}}
+    )
+    
+    return {"message": "Trip accepted", "trip": trip}
+
+# ==================== PAYMENT GATEWAY ====================
+
+class GatewayUnavailable(Exception):
+    """Raised without calling the provider while the circuit is open"""
+
+class CircuitBreaker:
+    """Opens after consecutive failures; after reset_seconds one trial call decides whether to close"""
+    
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+    
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+    
+    def allow(self) -> Optional[str]:
+        """None if the call is rejected, "trial" for the single half-open trial, otherwise "closed"."""
+        state = self.state
+        if state == "closed":
+            return "closed"
+        if state == "half_open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return "trial"
+        return None
+    
+    def record_success(self):
+        self.consecutive_failures = 0
+        self.opened_at = None
+    
+    def record_failure(self, trial: bool = False):
+        self.consecutive_failures += 1
+        if trial or self.consecutive_failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+    
+    def end_trial(self):
+        """Called once the trial call has finished, whatever its outcome"""
+        self.trial_in_flight = False
+
+class PaymentGateway:
+    """Runs the blocking Razorpay SDK in its own thread pool with timeouts,
+    bounded concurrency and a circuit breaker"""
+    
+    def __init__(self, client, max_concurrency: int, timeout_seconds: float):
+        self.client = client
+        self.timeout_seconds = timeout_seconds
+        self.executor = ThreadPoolExecutor(max_concurrency, thread_name_prefix="payment-gateway")
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.breaker = CircuitBreaker(PAYMENT_GATEWAY_FAILURE_THRESHOLD, PAYMENT_GATEWAY_RESET_SECONDS)
+        self.in_flight = 0
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+    
+    async def call(self, fn, *args, **kwargs):
+        admission = self.breaker.allow()
+        if admission is None:
+            self.rejected += 1
+            raise GatewayUnavailable()
+        
+        try:
+            # The span includes time spent waiting for a free slot
+            with trace_span(f"razorpay {fn.__qualname__}", **{"peer.service": "razorpay"}):
+                async with self.semaphore:
+                    self.in_flight += 1
+                    self.calls += 1
+                    try:
+                        # requests enforces the socket timeout; wait_for bounds the whole call
+                        result = await asyncio.wait_for(
+                            asyncio.get_running_loop().run_in_executor(
+                                self.executor, partial(fn, *args, timeout=self.timeout_seconds, **kwargs)
+                            ),
+                            self.timeout_seconds * 2
+                        )
+                    except razorpay.errors.BadRequestError:
+                        # The provider answered; a rejected request says nothing about its health
+                        self.breaker.record_success()
+                        raise
+                    except Exception:
+                        self.failures += 1
+                        self.breaker.record_failure(trial=admission == "trial")
+                        raise
+                    finally:
+                        self.in_flight -= 1
+            
+            self.breaker.record_success()
+            return result
+        finally:
+            # Only the trial call ends the trial; a cancelled one records neither
+            # outcome, so the next caller gets the trial instead
+            if admission == "trial":
+                self.breaker.end_trial()
+    
+    async def create_order(self, amount_paise: int, receipt: str) -> Dict:
+        return await self.call(self.client.order.create, {
+            "amount": amount_paise,
+            "currency": "INR",
+            "receipt": receipt,
+            "payment_capture": 1
+        })
+    
+    async def fetch_order_payments(self, razorpay_order_id: str) -> List[Dict]:
+        return (await self.call(self.client.order.payments, razorpay_order_id)).get('items', [])
+    
+    def stats(self) -> Dict:
+        return {
+            "state": self.breaker.state,
+            "consecutive_failures": self.breaker.consecutive_failures,
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "failures": self.failures,
+            "rejected_while_open": self.rejected
+        }
+
+payment_gateway = PaymentGateway(razorpay_client, PAYMENT_GATEWAY_MAX_CONCURRENCY, PAYMENT_GATEWAY_TIMEOUT_SECONDS) if razorpay_client else None
+
+def verify_razorpay_signature(message, signature: str, secret: str) -> bool:
+    """HMAC-SHA256 check used for checkout and webhook signatures; no network involved"""
+    if isinstance(message, str):
+        message = message.encode()
+    expected = hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or "")
+
+@api_router.get("/health/payments")
+async def get_payment_gateway_health():
+    """Circuit breaker state and call counters for the payment gateway"""
+    unapplied = await db.payment_events.count_documents({"applied_at": None})
+    if not payment_gateway:
+        return {"state": "not_configured", "unapplied_webhook_events": unapplied}
+    return {**payment_gateway.stats(), "unapplied_webhook_events": unapplied}
+
+# ==================== PAYMENT ROUTES ====================
+
+@api_router.post("/payments/create-razorpay-order")
+async def create_razorpay_order(payment_data: CreateRazorpayOrder, current_user: Dict = Depends(get_current_user)):
+    """Create Razorpay order for payment"""
+    if not payment_gateway:
+        raise HTTPException(status_code=500, detail="Payment gateway not configured")
+    
+    order = await db.orders.find_one({"id": payment_data.order_id})
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
@@ -1201,23 +2970,244 @@ async def verify_payment(payment_data: VerifyPayment, current_user: Dict = Depen
         raise HTTPException(status_code=403, detail="Not authorized")
     
     try:
-        # Verify payment signature
-        razorpay_client.utility.verify_payment_signature({
-            'razorpay_order_id': payment_data.razorpay_order_id,
-            'razorpay_payment_id': payment_data.razorpay_payment_id,
-            'razorpay_signature': payment_data.razorpay_signature
+        # Create Razorpay order (amount in paise)
+        razorpay_order = await payment_gateway.create_order(int(payment_data.amount * 100), payment_data.order_id)
+    except GatewayUnavailable:
+        raise HTTPException(status_code=503, detail="Payment gateway is temporarily unavailable. Please try again shortly")
+    except (asyncio.TimeoutError, requests.exceptions.Timeout):
+        logging.error("Razorpay order creation timed out")
+        raise HTTPException(status_code=504, detail="Payment gateway timed out")
+    except razorpay.errors.BadRequestError as e:
+        logging.error(f"Razorpay rejected order creation: {str(e)}")
+        raise HTTPException(status_code=400, detail="Payment gateway rejected the payment order")
+    except Exception as e:
+        logging.error(f"Razorpay order creation failed: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to create payment order")
+    
+    # Save Razorpay order ID
+    await db.orders.update_one(
+        {"id": payment_data.order_id},
+        {"$set": {"razorpay_order_id": razorpay_order['id']}}
+    )
+    
+    return {
+        "razorpay_order_id": razorpay_order['id'],
+        "amount": razorpay_order['amount'],
+        "currency": razorpay_order['currency'],
+        "key_id": RAZORPAY_KEY_ID
+    }
+
+@api_router.post("/payments/verify")
+async def verify_payment(payment_data: VerifyPayment, current_user: Dict = Depends(get_current_user)):
+    """Verify Razorpay payment"""
+    if not RAZORPAY_KEY_SECRET:
+        raise HTTPException(status_code=500, detail="Payment gateway not configured")
+    
+    order = await db.orders.find_one({"id": payment_data.order_id})
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    
+    if order['customer_id'] != current_user['id']:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    
+    # The signature must be for the Razorpay order created for this order
+    signed = verify_razorpay_signature(
+        f"{payment_data.razorpay_order_id}|{payment_data.razorpay_payment_id}",
+        payment_data.razorpay_signature,
+        RAZORPAY_KEY_SECRET
+    )
+    if not signed or order.get('razorpay_order_id') != payment_data.razorpay_order_id:
+        logging.error(f"Payment verification failed for order {payment_data.order_id}")
+        raise HTTPException(status_code=400, detail="Payment verification failed")
+    
+    # Update order payment status
+    await db.orders.update_one(
+        {"id": payment_data.order_id},
+        {"$set": {
+            "payment_status": "completed",
+            "razorpay_payment_id": payment_data.razorpay_payment_id,
+            "updated_at": datetime.now(timezone.utc)
+        }}
+    )
+    
+    return {"message": "Payment verified successfully"}
+
+# ==================== PAYMENT WEBHOOKS ====================
+
+payment_events_wakeup = asyncio.Event()
+
+# Razorpay events that settle an order's payment status
+CAPTURED_PAYMENT_EVENTS = ("payment.captured", "order.paid", "reconcile.captured")
+FAILED_PAYMENT_EVENTS = ("payment.failed", "reconcile.failed")
+
+@api_router.post("/payments/webhook")
+async def razorpay_webhook(request: Request):
+    """Receive Razorpay webhooks: verify, persist, acknowledge. Orders are updated by the applier."""
+    if not RAZORPAY_WEBHOOK_SECRET:
+        raise HTTPException(status_code=500, detail="Payment webhook not configured")
+    
+    body = await request.body()
+    if not verify_razorpay_signature(body, request.headers.get('X-Razorpay-Signature'), RAZORPAY_WEBHOOK_SECRET):
+        raise HTTPException(status_code=400, detail="Invalid webhook signature")
+    
+    try:
+        event = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid webhook payload")
+    
+    payment = event.get('payload', {}).get('payment', {}).get('entity', {})
+    order = event.get('payload', {}).get('order', {}).get('entity', {})
+    try:
+        await db.payment_events.insert_one({
+            # Razorpay retries deliveries with the same event id
+            "event_id": request.headers.get('X-Razorpay-Event-Id') or hashlib.sha256(body).hexdigest(),
+            "event": event.get('event'),
+            "payment_id": payment.get('id'),
+            "razorpay_order_id": payment.get('order_id') or order.get('id'),
+            "amount": payment.get('amount'),
+            "received_at": datetime.now(timezone.utc),
+            "applied_at": None
         })
-        
-        # Update order payment status
-        await db.orders.update_one(
-            {"id": payment_data.order_id},
-            {"$set": {"payment_status": "completed", "updated_at": datetime.now(timezone.utc).isoformat()}}
+    except DuplicateKeyError:
+        pass
+    
+    payment_events_wakeup.set()
+    return {"status": "ok"}
+
+async def apply_payment_events() -> int:
+    """Apply one batch of unapplied payment events to orders; returns how many were consumed.
+    
+    Events are collapsed per payment id, and updates are guarded so re-applying any
+    event (or a redelivery) never changes an order twice.
+    """
+    events = await db.payment_events.find(
+        {"applied_at": None}, {"_id": 1, "event": 1, "payment_id": 1, "razorpay_order_id": 1}
+    ).sort("received_at", 1).to_list(PAYMENT_EVENT_BATCH_SIZE)
+    if not events:
+        return 0
+    
+    captured, failed = {}, {}
+    for event in events:
+        if not event.get('payment_id') or not event.get('razorpay_order_id'):
+            continue
+        if event['event'] in CAPTURED_PAYMENT_EVENTS:
+            captured[event['payment_id']] = event['razorpay_order_id']
+        elif event['event'] in FAILED_PAYMENT_EVENTS:
+            failed[event['payment_id']] = event['razorpay_order_id']
+    
+    now = datetime.now(timezone.utc)
+    operations = [
+        UpdateOne(
+            {"razorpay_order_id": razorpay_order_id, "payment_status": {"$ne": "completed"}},
+            {"$set": {"payment_status": "completed", "razorpay_payment_id": payment_id, "updated_at": now}}
+        )
+        for payment_id, razorpay_order_id in captured.items()
+    ]
+    # A failed attempt only marks orders that have not been paid by another attempt
+    operations += [
+        UpdateOne(
+            {"razorpay_order_id": razorpay_order_id, "payment_status": "pending"},
+            {"$set": {"payment_status": "failed", "updated_at": now}}
         )
+        for payment_id, razorpay_order_id in failed.items()
+        if razorpay_order_id not in captured.values()
+    ]
+    if operations:
+        await db.orders.bulk_write(operations, ordered=False)
+    
+    await db.payment_events.update_many(
+        {"_id": {"$in": [event['_id'] for event in events]}},
+        {"$set": {"applied_at": now}}
+    )
+    return len(events)
+
+async def payment_event_applier_loop():
+    while True:
+        try:
+            if await apply_payment_events() == PAYMENT_EVENT_BATCH_SIZE:
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Payment event apply failed: {str(e)}")
         
-        return {"message": "Payment verified successfully"}
-    except Exception as e:
-        logging.error(f"Payment verification failed: {str(e)}")
-        raise HTTPException(status_code=400, detail="Payment verification failed")
+        payment_events_wakeup.clear()
+        try:
+            await asyncio.wait_for(payment_events_wakeup.wait(), timeout=5.0)
+            # Let a webhook burst accumulate into one batch
+            await asyncio.sleep(PAYMENT_EVENT_LINGER_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+async def reconcile_pending_payments() -> int:
+    """Ask the gateway about orders still pending long after checkout started.
+    
+    Findings go through payment_events like webhooks do. Returns orders checked.
+    """
+    now = datetime.now(timezone.utc)
+    orders = await db.orders.find(
+        {
+            "payment_status": "pending",
+            "razorpay_order_id": {"$ne": None},
+            "created_at": {
+                "$lte": now - timedelta(minutes=PAYMENT_RECONCILE_AFTER_MINUTES),
+                "$gte": now - timedelta(hours=PAYMENT_RECONCILE_WINDOW_HOURS)
+            }
+        },
+        {"_id": 0, "id": 1, "razorpay_order_id": 1}
+    ).sort("payment_checked_at", 1).to_list(PAYMENT_RECONCILE_BATCH_SIZE)
+    
+    checked, events = [], []
+    for order in orders:
+        try:
+            payments = await payment_gateway.fetch_order_payments(order['razorpay_order_id'])
+        except GatewayUnavailable:
+            break
+        except Exception as e:
+            logging.error(f"Reconciliation lookup failed for {order['razorpay_order_id']}: {str(e)}")
+            continue
+        checked.append(order['id'])
+        
+        paid = [p for p in payments if p.get('status') == 'captured']
+        if paid:
+            outcome, payment = "reconcile.captured", paid[0]
+        elif payments and all(p.get('status') == 'failed' for p in payments):
+            outcome, payment = "reconcile.failed", payments[-1]
+        else:
+            continue
+        events.append({
+            "event_id": f"{outcome}:{payment['id']}",
+            "event": outcome,
+            "payment_id": payment['id'],
+            "razorpay_order_id": order['razorpay_order_id'],
+            "amount": payment.get('amount'),
+            "received_at": datetime.now(timezone.utc),
+            "applied_at": None
+        })
+    
+    if events:
+        try:
+            await db.payment_events.insert_many(events, ordered=False)
+        except BulkWriteError:
+            pass  # already recorded by an earlier pass
+        payment_events_wakeup.set()
+    
+    # Rotate through the backlog so orders the gateway knows nothing about don't starve newer ones
+    if checked:
+        await db.orders.update_many({"id": {"$in": checked}}, {"$set": {"payment_checked_at": now}})
+    return len(checked)
+
+async def payment_reconciliation_loop(interval_seconds: int = PAYMENT_RECONCILE_INTERVAL_SECONDS):
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            checked = await reconcile_pending_payments()
+            if checked:
+                logging.info(f"Payment reconciliation checked {checked} pending orders")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Payment reconciliation failed: {str(e)}")
 
 # ==================== CUSTOMER PROFILE ROUTES ====================
 
@@ -1248,8 +3238,7 @@ async def add_address(address: SavedAddress, current_user: Dict = Depends(get_cu
         raise HTTPException(status_code=403, detail="Only customers can add addresses")
     
     address.user_id = current_user['id']
-    address_dict = address.model_dump()
-    address_dict['created_at'] = address_dict['created_at'].isoformat()
+    address_dict = to_document(address)
     
     await db.saved_addresses.insert_one(address_dict)
     return {"message": "Address added", "address": address}
@@ -1278,8 +3267,7 @@ async def add_payment_method(payment: SavedPaymentMethod, current_user: Dict = D
         raise HTTPException(status_code=403, detail="Only customers can add payment methods")
     
     payment.user_id = current_user['id']
-    payment_dict = payment.model_dump()
-    payment_dict['created_at'] = payment_dict['created_at'].isoformat()
+    payment_dict = to_document(payment)
     
     await db.saved_payment_methods.insert_one(payment_dict)
     return {"message": "Payment method added"}
@@ -1316,7 +3304,7 @@ async def subscribe_healer_pro(current_user: Dict = Depends(get_current_user)):
         {"id": current_user['id']},
         {"$set": {
             "is_healer_pro": True,
-            "healer_pro_expires_at": expires_at.isoformat()
+            "healer_pro_expires_at": expires_at
         }}
     )
     
@@ -1408,26 +3396,17 @@ async def update_profile(profile_data: ProfileUpdate, current_user: Dict = Depen
         )
     
     # Return updated user data
-    updated_user = await db.users.find_one({"id": current_user['id']}, {"_id": 0})
+    updated_user = await db.users.find_one({"id": current_user['id']}, USER_PROJECTION)
     updated_user.pop('password_hash', None)
     
     return {"message": "Profile updated successfully", "user": updated_user}
 
 @api_router.post("/profile/upload-picture")
-async def upload_profile_picture(file: UploadFile = File(...), current_user: Dict = Depends(get_current_user)):
+async def upload_profile_picture(background_tasks: BackgroundTasks, file: UploadFile = File(...), current_user: Dict = Depends(get_current_user)):
     """Upload profile picture"""
-    # Validate file type
-    if not file.content_type.startswith('image/'):
-        raise HTTPException(status_code=400, detail="Only image files are allowed")
-    
-    # Validate file size (5MB max)
-    content = await file.read()
-    if len(content) > 5 * 1024 * 1024:
-        raise HTTPException(status_code=400, detail="File size must be less than 5MB")
-    
-    # Convert to base64 for storage (in production, use cloud storage)
-    base64_image = base64.b64encode(content).decode('utf-8')
-    image_url = f"data:{file.content_type};base64,{base64_image}"
+    blob = await store_upload(file)
+    image_url = blob['url']
+    background_tasks.add_task(generate_thumbnails, blob['digest'], blob['extension'])
     
     # Update user profile
     await db.users.update_one(
@@ -1435,7 +3414,293 @@ async def upload_profile_picture(file: UploadFile = File(...), current_user: Dic
         {"$set": {"profile_pic": image_url}}
     )
     
-    return {"message": "Profile picture updated", "profile_pic": image_url}
+    return {
+        "message": "Profile picture updated",
+        "profile_pic": image_url,
+        "thumbnails": thumbnail_urls(blob['digest'])
+    }
+
+# ==================== MEDIA STORE ====================
+
+class BlobTooLarge(Exception):
+    pass
+
+def media_path(digest: str, extension: str) -> Path:
+    """Blobs are sharded by the first two byte pairs of their sha256"""
+    return MEDIA_ROOT / digest[:2] / digest[2:4] / f"{digest}.{extension}"
+
+def media_url(digest: str, extension: str) -> str:
+    """Relative to the API origin; clients prefix their backend URL"""
+    return f"/api/media/{digest}.{extension}"
+
+# Leading bytes of each accepted image format
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+def sniff_image_type(header: bytes) -> Optional[str]:
+    """Content type from a file's first bytes, or None if it is not an accepted image"""
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, content_type in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return content_type
+    return None
+
+def write_blob(source, extension: str, max_bytes: int = MEDIA_MAX_UPLOAD_BYTES) -> tuple:
+    """Copy a file object into the store in chunks, hashing as it goes.
+    
+    Returns (digest, size). Raises BlobTooLarge as soon as max_bytes is exceeded.
+    Identical content is stored once.
+    """
+    staging = MEDIA_ROOT / 'tmp'
+    staging.mkdir(parents=True, exist_ok=True)
+    sha256 = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=staging, delete=False) as out:
+        try:
+            while chunk := source.read(MEDIA_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise BlobTooLarge()
+                sha256.update(chunk)
+                out.write(chunk)
+        except BaseException:
+            out.close()
+            os.unlink(out.name)
+            raise
+    
+    digest = sha256.hexdigest()
+    target = media_path(digest, extension)
+    if target.exists():
+        os.unlink(out.name)
+    else:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(out.name, target)
+    return digest, size
+
+async def store_blob(source, content_type: str) -> Dict:
+    """Store a file object and register it in the media collection"""
+    extension = MEDIA_EXTENSIONS[content_type]
+    digest, size = await asyncio.to_thread(write_blob, source, extension)
+    await db.media.update_one(
+        {"digest": digest},
+        {"$setOnInsert": {
+            "digest": digest,
+            "extension": extension,
+            "content_type": content_type,
+            "size": size,
+            "created_at": datetime.now(timezone.utc)
+        }},
+        upsert=True
+    )
+    return {"digest": digest, "extension": extension, "size": size, "url": media_url(digest, extension)}
+
+async def store_upload(file: UploadFile) -> Dict:
+    """Validate and store an uploaded image.
+    
+    The type comes from the file's magic bytes, not the client's Content-Type.
+    Oversized request bodies are refused by RequestSizeLimitMiddleware before they are read.
+    """
+    if file.size is not None and file.size > MEDIA_MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=400, detail="File size must be less than 5MB")
+    
+    content_type = sniff_image_type(await file.read(16))
+    await file.seek(0)
+    if content_type is None:
+        raise HTTPException(status_code=400, detail="Only JPEG, PNG, WebP or GIF images are allowed")
+    
+    try:
+        return await store_blob(file.file, content_type)
+    except BlobTooLarge:
+        raise HTTPException(status_code=400, detail="File size must be less than 5MB")
+
+MEDIA_FILENAME = re.compile(r"^([0-9a-f]{64})\.([a-z]+)$")
+
+@api_router.get("/media/{filename}")
+async def get_media(filename: str):
+    """Serve a stored blob; content never changes for a digest so it is cached forever"""
+    match = MEDIA_FILENAME.match(filename)
+    if not match or match.group(2) not in MEDIA_EXTENSIONS.values():
+        raise HTTPException(status_code=404, detail="Media not found")
+    
+    digest, extension = match.groups()
+    path = media_path(digest, extension)
+    if not path.exists():
+        raise HTTPException(status_code=404, detail="Media not found")
+    
+    return FileResponse(path, headers={
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "ETag": f'"{digest}"',
+        "X-Content-Type-Options": "nosniff"
+    })
+
+class RequestSizeLimitMiddleware:
+    """Pure ASGI middleware; refuses request bodies over max_bytes before the app reads (and spools) them"""
+    
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        content_length = next((v for k, v in scope["headers"] if k == b"content-length"), None)
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse({"detail": "Request body too large"}, status_code=413)
+            await response(scope, receive, send)
+            return
+        
+        # Chunked bodies carry no length; count them as they arrive. FastAPI passes
+        # an HTTPException raised while reading the body through unchanged.
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(status_code=413, detail="Request body too large")
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+# ==================== THUMBNAILS ====================
+
+class ThumbnailCache:
+    """Least-recently-used accounting for derived files on disk, capped by total bytes"""
+    
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict = OrderedDict()
+        self.total_bytes = 0
+    
+    def load(self):
+        """Rebuild the LRU order from file mtimes (touched on every hit)"""
+        self.entries.clear()
+        self.total_bytes = 0
+        files = [(path.stat().st_mtime, path) for path in self.root.rglob('*-*.*') if not path.name.endswith('.tmp')]
+        for _, path in sorted(files):
+            self.add(path, path.stat().st_size)
+    
+    def touch(self, path: Path) -> bool:
+        if path not in self.entries:
+            if not path.exists():
+                return False
+            self.add(path, path.stat().st_size)
+            return True
+        self.entries.move_to_end(path)
+        os.utime(path)
+        return True
+    
+    def add(self, path: Path, size: int):
+        self.total_bytes += size - self.entries.pop(path, 0)
+        self.entries[path] = size
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            oldest, oldest_size = self.entries.popitem(last=False)
+            self.total_bytes -= oldest_size
+            try:
+                os.unlink(oldest)
+            except FileNotFoundError:
+                pass
+
+thumbnail_cache = ThumbnailCache(MEDIA_ROOT / 'variants', THUMBNAIL_CACHE_MAX_BYTES)
+thumbnail_pool: Optional[ProcessPoolExecutor] = None
+thumbnail_jobs: Dict[Path, asyncio.Future] = {}
+
+def get_thumbnail_pool() -> ProcessPoolExecutor:
+    global thumbnail_pool
+    if thumbnail_pool is None:
+        # Spawned workers avoid forking a process that is running Motor's I/O threads
+        thumbnail_pool = ProcessPoolExecutor(THUMBNAIL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return thumbnail_pool
+
+def reset_thumbnail_pool():
+    global thumbnail_pool
+    if thumbnail_pool is not None:
+        thumbnail_pool.shutdown(wait=False, cancel_futures=True)
+        thumbnail_pool = None
+
+def thumbnail_path(digest: str, size: str, extension: str) -> Path:
+    return MEDIA_ROOT / 'variants' / digest[:2] / f"{digest}-{size}.{extension}"
+
+def thumbnail_urls(digest: str, extension: str = "webp") -> Dict[str, str]:
+    return {size: f"/api/media/thumbnails/{size}/{digest}.{extension}" for size in THUMBNAIL_SIZES}
+
+async def ensure_thumbnail(digest: str, source_extension: str, size: str, extension: str) -> Path:
+    """Return the variant path, rendering it in the process pool on first use.
+    
+    Concurrent requests for the same missing variant share one render.
+    """
+    target = thumbnail_path(digest, size, extension)
+    if thumbnail_cache.touch(target):
+        return target
+    
+    job = thumbnail_jobs.get(target)
+    if job is None:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        job = asyncio.get_running_loop().run_in_executor(
+            get_thumbnail_pool(),
+            render_thumbnail,
+            str(media_path(digest, source_extension)),
+            str(target),
+            THUMBNAIL_SIZES[size],
+            THUMBNAIL_FORMATS[extension],
+            THUMBNAIL_QUALITY
+        )
+        thumbnail_jobs[target] = job
+        job.add_done_callback(lambda _: thumbnail_jobs.pop(target, None))
+        try:
+            written = await job
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM on a huge image); start a fresh pool next time
+            reset_thumbnail_pool()
+            raise
+        thumbnail_cache.add(target, written)
+    else:
+        await job
+    return target
+
+async def generate_thumbnails(digest: str, source_extension: str, extension: str = "webp"):
+    """Pre-render every size of a freshly uploaded image (other formats stay lazy)"""
+    try:
+        await asyncio.gather(*(
+            ensure_thumbnail(digest, source_extension, size, extension) for size in THUMBNAIL_SIZES
+        ))
+    except Exception as e:
+        logging.error(f"Thumbnail generation failed for {digest}: {str(e)}")
+
+@api_router.get("/media/thumbnails/{size}/{filename}")
+async def get_thumbnail(size: str, filename: str):
+    """Serve a fixed-size WebP/JPEG variant of a stored image, rendering it on first request"""
+    match = MEDIA_FILENAME.match(filename)
+    if size not in THUMBNAIL_SIZES or not match or match.group(2) not in THUMBNAIL_FORMATS:
+        raise HTTPException(status_code=404, detail="Media not found")
+    
+    digest, extension = match.groups()
+    target = thumbnail_path(digest, size, extension)
+    if not thumbnail_cache.touch(target):
+        blob = await db.media.find_one({"digest": digest}, {"_id": 0, "extension": 1})
+        if not blob or not media_path(digest, blob['extension']).exists():
+            raise HTTPException(status_code=404, detail="Media not found")
+        try:
+            target = await ensure_thumbnail(digest, blob['extension'], size, extension)
+        except Exception as e:
+            logging.error(f"Thumbnail render failed for {digest}: {str(e)}")
+            raise HTTPException(status_code=422, detail="Image could not be processed")
+    
+    return FileResponse(target, headers={
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "ETag": f'"{digest}-{size}"',
+        "X-Content-Type-Options": "nosniff"
+    })
 
 # ==================== VERIFICATION SYSTEM ROUTES ====================
 
@@ -1443,13 +3708,6 @@ def generate_verification_code() -> str:
     """Generate 6-digit verification code"""
     return str(secrets.randbelow(900000) + 100000)
 
-def can_resend_code(last_resent_at: Optional[str]) -> bool:
-    """Check if 30 seconds have passed since last code send"""
-    if not last_resent_at:
-        return True
-    last_resent_datetime = datetime.fromisoformat(last_resent_at)
-    return datetime.now(timezone.utc) > (last_resent_datetime + timedelta(seconds=30))
-
 @api_router.post("/verification/send-code")
 async def send_verification_code(request: SendVerificationRequest, current_user: Dict = Depends(get_current_user)):
     """Send verification code for email or phone"""
@@ -1467,61 +3725,55 @@ async def send_verification_code(request: SendVerificationRequest, current_user:
         if not request.value or len(request.value) < 10:
             raise HTTPException(status_code=400, detail="Invalid phone number")
     
-    # Check for existing verification
-    existing = await db.verification_codes.find_one({
-        "user_id": current_user['id'],
-        "type": request.type,
-        "value": request.value
-    })
-    
-    # Check resend limit
-    if existing and existing['resend_count'] >= 5:
-        raise HTTPException(status_code=400, detail="Maximum resend attempts reached. Please try again later.")
-    
-    # Check 30-second cooldown
-    if existing and not can_resend_code(existing.get('last_resent_at')):
-        raise HTTPException(status_code=400, detail="Please wait 30 seconds before requesting another code")
-    
-    # Generate new code
+    # Issue the code in one atomic upsert; the filter enforces the resend cap and
+    # cooldown, so a capped or cooling-down record makes the upsert collide with
+    # the unique (user_id, type, value) index instead of matching.
+    # Records written before the datetimes migration hold ISO-string timestamps;
+    # they match on the string branch and are rewritten with native dates here
+    # (expired ones are also removed by purge_expired_records, as TTL skips strings)
+    now = datetime.now(timezone.utc)
     code = generate_verification_code()
-    expires_at = datetime.now(timezone.utc) + timedelta(minutes=10)
+    record_key = {"user_id": current_user['id'], "type": request.type, "value": request.value}
+    resend_after = now - timedelta(seconds=CODE_RESEND_COOLDOWN_SECONDS)
     
-    if existing:
-        # Update existing record
-        await db.verification_codes.update_one(
-            {"id": existing['id']},
+    try:
+        await db.verification_codes.find_one_and_update(
+            {
+                **record_key,
+                "resend_count": {"$lt": CODE_MAX_SENDS},
+                "$or": [
+                    {"last_resent_at": {"$lte": resend_after}},
+                    {"last_resent_at": {"$type": "string", "$lte": resend_after.isoformat()}}
+                ]
+            },
             {
                 "$set": {
                     "code": code,
-                    "expires_at": expires_at.isoformat(),
+                    "expires_at": now + timedelta(minutes=CODE_TTL_MINUTES),
                     "verified": False,
-                    "last_resent_at": datetime.now(timezone.utc).isoformat()
+                    "last_resent_at": now
                 },
-                "$inc": {"resend_count": 1}
-            }
-        )
-    else:
-        # Create new record
-        verification = VerificationCode(
-            user_id=current_user['id'],
-            type=request.type,
-            value=request.value,
-            code=code,
-            expires_at=expires_at,
-            resend_count=1,
-            last_resent_at=datetime.now(timezone.utc)
+                "$inc": {"resend_count": 1},
+                "$setOnInsert": {"id": str(uuid.uuid4()), "created_at": now}
+            },
+            {"_id": 1},
+            upsert=True
         )
-        
-        verification_dict = verification.model_dump()
-        verification_dict['created_at'] = verification_dict['created_at'].isoformat()
-        verification_dict['expires_at'] = verification_dict['expires_at'].isoformat()
-        verification_dict['last_resent_at'] = verification_dict['last_resent_at'].isoformat()
-        
-        await db.verification_codes.insert_one(verification_dict)
+    except DuplicateKeyError:
+        # Slow path: report why the existing record refused a new code
+        existing = await db.verification_codes.find_one(record_key, {"_id": 0, "resend_count": 1, "last_resent_at": 1})
+        if existing and existing['resend_count'] >= CODE_MAX_SENDS:
+            raise HTTPException(status_code=400, detail="Maximum resend attempts reached. Please try again later.")
+        raise HTTPException(status_code=400, detail="Please wait 30 seconds before requesting another code")
     
-    # In production, send email/SMS here
-    # For now, return code (remove in production!)
-    logging.info(f"Verification code for {request.type} {request.value}: {code}")
+    # Delivered asynchronously so provider latency never reaches this request
+    # For now, also return code (remove in production!)
+    notifications.send(
+        "email" if request.type == "email" else "sms",
+        request.value,
+        "Your Healer verification code",
+        f"Your Healer verification code is {code}. It expires in 10 minutes."
+    )
     
     return {
         "message": f"Verification code sent to {request.value}",
@@ -1544,17 +3796,20 @@ async def verify_code(request: VerifyCodeRequest, current_user: Dict = Depends(g
         raise HTTPException(status_code=404, detail="No verification request found")
     
     # Check if expired
-    if datetime.fromisoformat(verification['expires_at']) < datetime.now(timezone.utc):
+    if as_utc(verification['expires_at']) < datetime.now(timezone.utc):
         raise HTTPException(status_code=400, detail="Verification code has expired")
     
     # Check code
     if verification['code'] != request.code:
         raise HTTPException(status_code=400, detail="Invalid verification code")
     
-    # Mark as verified
+    # Mark as verified, keeping the record around long enough to apply the change
     await db.verification_codes.update_one(
         {"id": verification['id']},
-        {"$set": {"verified": True}}
+        {"$set": {
+            "verified": True,
+            "expires_at": datetime.now(timezone.utc) + timedelta(minutes=VERIFIED_RECORD_TTL_MINUTES)
+        }}
     )
     
     return {"message": "Verification successful"}
@@ -1617,37 +3872,86 @@ async def complete_post_signup_verification(request: VerifyCodeRequest, current_
 
 # ==================== DRIVER EARNINGS & REVIEWS ====================
 
+async def record_earnings_rollups(driver_id: str, amount: float, distance_km: float, at: datetime, applied_key: str):
+    """Add one earning to the driver's day, week and month buckets (at most once per applied_key)"""
+    operations = []
+    for period in EARNINGS_PERIODS:
+        start = earnings_bucket_start(at, period)
+        query, update = applied_once(
+            {"driver_id": driver_id, "period": period, "start": start},
+            {
+                "$inc": {"amount": amount, "deliveries": 1, "distance_km": distance_km},
+                "$set": {"updated_at": datetime.now(timezone.utc)},
+                "$setOnInsert": {"bucket": earnings_bucket_label(start, period)}
+            },
+            applied_key
+        )
+        operations.append(UpdateOne(query, update, upsert=True))
+    await db.driver_earnings_rollups.bulk_write(operations, ordered=False)
+
 @api_router.get("/drivers/earnings")
 async def get_driver_earnings(current_user: Dict = Depends(get_current_user)):
-    """Get driver earnings summary and history"""
+    """Get driver earnings summary and recent history"""
     if current_user['role'] != UserRole.DRIVER:
         raise HTTPException(status_code=403, detail="Only drivers can view earnings")
     
-    driver = await db.drivers.find_one({"user_id": current_user['id']}, {"_id": 0})
+    driver = await db.drivers.find_one({"user_id": current_user['id']}, DRIVER_PROJECTION)
     if not driver:
         raise HTTPException(status_code=404, detail="Driver profile not found")
     
-    # Get earnings history
-    earnings = await db.driver_earnings.find({"driver_id": driver['id']}, {"_id": 0}).to_list(1000)
+    # Current day/week/month come straight from the rollup buckets
+    now = datetime.now(timezone.utc)
+    current_buckets = await db.driver_earnings_rollups.find({
+        "driver_id": driver['id'],
+        "$or": [{"period": period, "start": earnings_bucket_start(now, period)} for period in EARNINGS_PERIODS]
+    }, {"_id": 0, "driver_id": 0, "applied_events": 0}).to_list(len(EARNINGS_PERIODS))
+    by_period = {bucket['period']: bucket for bucket in current_buckets}
+    
+    # Only the most recent deliveries; older history is served by /drivers/earnings/rollups
+    earnings = await db.driver_earnings.find(
+        {"driver_id": driver['id']}, {"_id": 0}
+    ).sort("created_at", -1).to_list(50)
     
     return {
         "total_earnings": driver.get('total_earnings', 0.0),
         "total_deliveries": driver.get('total_deliveries', 0),
         "rating": driver.get('rating', 0.0),
         "state": driver.get('state'),
+        "today": by_period.get("day"),
+        "this_week": by_period.get("week"),
+        "this_month": by_period.get("month"),
         "earnings_history": earnings
     }
 
-@api_router.get("/drivers/reviews")
-async def get_driver_reviews(current_user: Dict = Depends(get_current_user)):
-    """Get driver reviews"""
-    if current_user['role'] != UserRole.DRIVER:
-        raise HTTPException(status_code=403, detail="Only drivers can view reviews")
+@api_router.get("/drivers/earnings/rollups")
+async def get_driver_earnings_rollups(period: str = "day", start: Optional[str] = None, end: Optional[str] = None, driver: Dict = Depends(current_driver)):
+    """Get driver earnings per day, week or month over a date range (YYYY-MM-DD, inclusive)"""
+    if period not in EARNINGS_PERIODS:
+        raise HTTPException(status_code=400, detail="Period must be 'day', 'week' or 'month'")
     
-    driver = await db.drivers.find_one({"user_id": current_user['id']})
-    if not driver:
-        raise HTTPException(status_code=404, detail="Driver profile not found")
+    try:
+        end_at = datetime.fromisoformat(end).replace(tzinfo=EARNINGS_TIMEZONE) if end else datetime.now(timezone.utc)
+        default_span = {"day": timedelta(days=30), "week": timedelta(weeks=12), "month": timedelta(days=365)}[period]
+        start_at = datetime.fromisoformat(start).replace(tzinfo=EARNINGS_TIMEZONE) if start else end_at - default_span
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be in YYYY-MM-DD format")
+    
+    buckets = await db.driver_earnings_rollups.find({
+        "driver_id": driver['id'],
+        "period": period,
+        "start": {"$gte": earnings_bucket_start(start_at, period), "$lte": earnings_bucket_start(end_at, period)}
+    }, {"_id": 0, "driver_id": 0, "applied_events": 0}).sort("start", 1).to_list(400)
     
+    return {
+        "period": period,
+        "total_earnings": round(sum(b['amount'] for b in buckets), 2),
+        "total_deliveries": sum(b['deliveries'] for b in buckets),
+        "buckets": buckets
+    }
+
+@api_router.get("/drivers/reviews")
+async def get_driver_reviews(driver: Dict = Depends(current_driver)):
+    """Get driver reviews"""
     reviews = await db.driver_reviews.find({"driver_id": driver['id']}, {"_id": 0}).to_list(1000)
     
     return reviews
@@ -1680,86 +3984,908 @@ async def review_driver(order_id: str, rating: int, comment: Optional[str] = Non
         comment=comment
     )
     
-    review_dict = review.model_dump()
-    review_dict['created_at'] = review_dict['created_at'].isoformat()
-    
-    await db.driver_reviews.insert_one(review_dict)
+    review_dict = to_document(review)
     
-    # Update driver rating
-    all_reviews = await db.driver_reviews.find({"driver_id": order['driver_id']}).to_list(1000)
-    avg_rating = sum(r['rating'] for r in all_reviews) / len(all_reviews)
+    # Unique index on order_id rejects a second review of the same order;
+    # the driver's rating is updated by the outbox worker
+    async def submit(session):
+        await db.driver_reviews.insert_one(review_dict, session=session)
+        await enqueue_outbox_event("review.created", order['driver_id'], {
+            "order_id": order_id,
+            "rating": rating
+        }, key=f"review.created:{order_id}", session=session)
     
-    await db.drivers.update_one(
-        {"id": order['driver_id']},
-        {"$set": {"rating": round(avg_rating, 2)}}
-    )
+    try:
+        await in_transaction(submit)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="This order has already been reviewed")
     
     return {"message": "Review submitted", "rating": rating}
 
-@api_router.put("/orders/{order_id}/complete-delivery")
-async def complete_delivery(order_id: str, current_user: Dict = Depends(get_current_user)):
-    """Mark delivery as complete and record driver earnings"""
-    if current_user['role'] != UserRole.DRIVER:
-        raise HTTPException(status_code=403, detail="Only drivers can complete deliveries")
-    
-    order = await db.orders.find_one({"id": order_id})
+async def recompute_driver_ratings() -> int:
+    """Rebuild every driver's rating sum, count and average from their reviews to repair drift"""
+    totals = await db.driver_reviews.aggregate([
+        {"$group": {"_id": "$driver_id", "rating_sum": {"$sum": "$rating"}, "rating_count": {"$sum": 1}}}
+    ]).to_list(None)
+    
+    operations = [
+        UpdateOne(
+            {"id": total['_id']},
+            {"$set": {
+                "rating_sum": total['rating_sum'],
+                "rating_count": total['rating_count'],
+                "rating": round(total['rating_sum'] / total['rating_count'], 2)
+            }}
+        )
+        for total in totals
+    ]
+    modified = 0
+    for i in range(0, len(operations), 1000):
+        result = await db.drivers.bulk_write(operations[i:i + 1000], ordered=False)
+        modified += result.modified_count
+    return modified
+
+async def driver_rating_repair_loop(interval_seconds: int = 24 * 60 * 60):
+    """Daily rating recomputation; normally a no-op since updates are incremental"""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            repaired = await recompute_driver_ratings()
+            if repaired:
+                logging.warning(f"Driver rating repair corrected {repaired} drivers")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Driver rating repair failed: {str(e)}")
+
+_transactions_supported: Optional[bool] = None
+
+async def supports_transactions() -> bool:
+    """Multi-document transactions need a replica set or sharded cluster"""
+    global _transactions_supported
+    if _transactions_supported is None:
+        hello = await client.admin.command("hello")
+        _transactions_supported = bool(hello.get("setName") or hello.get("msg") == "isdbgrid")
+    return _transactions_supported
+
+async def in_transaction(callback):
+    """Run callback(session) in a transaction when supported, otherwise with session=None"""
+    if await supports_transactions():
+        async with await client.start_session() as session:
+            return await session.with_transaction(callback)
+    return await callback(None)
+
+async def record_delivery(order_id: str, driver: Dict, session=None) -> Optional[tuple]:
+    """Outbox record that pays the driver plus the guarded delivered transition.
+    
+    Returns (order, earning) or None if the order is not deliverable by this driver.
+    """
+    deliverable = {
+        "id": order_id,
+        "driver_id": driver['id'],
+        "status": {"$nin": [OrderStatus.DELIVERED, OrderStatus.CANCELLED]}
+    }
+    order = await db.orders.find_one(deliverable, {"_id": 0}, session=session)
     if not order:
-        raise HTTPException(status_code=404, detail="Order not found")
+        return None
     
-    driver = await db.drivers.find_one({"user_id": current_user['id']})
-    if not driver or order.get('driver_id') != driver['id']:
-        raise HTTPException(status_code=403, detail="Not authorized")
-    
-    # Calculate driver earning
-    earning_amount = calculate_driver_earning(order['distance_km'], driver['state'])
+    # Calculate driver earning (batched trips are paid per leg of the shared route)
+    if order.get('trip_id'):
+        distance_km = order['trip_leg_km']
+        earning_amount = calculate_trip_leg_earning(distance_km, driver['state'], order.get('trip_sequence') == 0)
+    else:
+        distance_km = order['distance_km']
+        earning_amount = calculate_driver_earning(distance_km, driver['state'])
     
-    # Record earning
     earning = DriverEarning(
         driver_id=driver['id'],
         order_id=order_id,
         amount=earning_amount,
-        distance_km=order['distance_km'],
+        distance_km=distance_km,
         state=driver['state']
     )
     
-    earning_dict = earning.model_dump()
-    earning_dict['created_at'] = earning_dict['created_at'].isoformat()
+    earning_dict = to_document(earning)
+    
+    # The payout is recorded before the transition: without a transaction
+    # (standalone mongod) a crash in between leaves an undelivered order the
+    # driver can complete again, never a delivered order with no payout.
+    # The handler defers the event until the order is actually delivered.
+    try:
+        await enqueue_outbox_event("order.delivered", order_id, {"earning": earning_dict}, session=session)
+    except DuplicateKeyError:
+        if session is not None:
+            raise
+        # An earlier attempt recorded the payout but did not finish the transition.
+        # This attempt's earning (driver, distance) replaces it, and an event
+        # that went dead in the meantime gets a fresh set of attempts.
+        await db.outbox.update_one(
+            {"key": f"order.delivered:{order_id}", "status": {"$in": ["pending", "dead"]}},
+            {"$set": {
+                "payload": {"earning": earning_dict},
+                "status": "pending",
+                "attempts": 0,
+                "available_at": datetime.now(timezone.utc),
+                "last_error": None
+            }}
+        )
+    
+    # Only one caller can move the order to delivered, so a double tap pays once
+    result = await db.orders.update_one(
+        deliverable,
+        {"$set": {"status": OrderStatus.DELIVERED, "updated_at": datetime.now(timezone.utc)}},
+        session=session
+    )
+    if result.modified_count == 0:
+        return None
+    
+    return order, earning
+
+@api_router.put("/orders/{order_id}/complete-delivery")
+async def complete_delivery(order_id: str, driver: Dict = Depends(current_driver)):
+    """Mark delivery as complete and record driver earnings"""
+    result = await in_transaction(lambda session: record_delivery(order_id, driver, session))
+    
+    if result is None:
+        # Slow path: work out why the transition was refused
+        order = await db.orders.find_one({"id": order_id}, {"_id": 0, "driver_id": 1, "status": 1})
+        if not order:
+            raise HTTPException(status_code=404, detail="Order not found")
+        if order.get('driver_id') != driver['id']:
+            raise HTTPException(status_code=403, detail="Not authorized")
+        if order['status'] == OrderStatus.DELIVERED:
+            raise HTTPException(status_code=400, detail="Order already delivered")
+        raise HTTPException(status_code=400, detail="Cannot complete a cancelled order")
+    
+    order, earning = result
+    
+    # A driver on a batched trip stays busy until the last stop
+    trip_finished = True
+    if order.get('trip_id'):
+        trip_finished = await db.orders.count_documents({
+            "trip_id": order['trip_id'],
+            "status": {"$nin": [OrderStatus.DELIVERED, OrderStatus.CANCELLED]}
+        }, limit=1) == 0
+        if trip_finished:
+            await db.trips.update_one(
+                {"id": order['trip_id']},
+                {"$set": {"status": "completed", "updated_at": datetime.now(timezone.utc)}}
+            )
     
-    await db.driver_earnings.insert_one(earning_dict)
+    # Return the driver to the dispatch pool
+    if trip_finished:
+        await release_driver(driver['id'])
     
-    # Update driver totals
+    return {
+        "message": "Delivery completed",
+        "earning": earning.amount,
+        "status": OrderStatus.DELIVERED
+    }
+
+# ==================== OUTBOX ====================
+
+outbox_wakeup = asyncio.Event()
+
+class OutboxDeferred(Exception):
+    """Raised by a handler whose event is not ready yet; rescheduled without using an attempt"""
+
+class OutboxMetrics:
+    """In-process counters for the outbox worker pool"""
+    
+    def __init__(self):
+        self.processed_total = 0
+        self.retried_total = 0
+        self.dead_total = 0
+        self.deferred_total = 0
+        self.processed_by_type: Dict[str, int] = {}
+        self.last_lag_seconds = 0.0
+        self.max_lag_seconds = 0.0
+        self._recent = deque()  # completion timestamps for throughput
+    
+    def record_success(self, event_type: str, lag_seconds: float):
+        now = time.monotonic()
+        self.processed_total += 1
+        self.processed_by_type[event_type] = self.processed_by_type.get(event_type, 0) + 1
+        self.last_lag_seconds = lag_seconds
+        self.max_lag_seconds = max(self.max_lag_seconds, lag_seconds)
+        self._recent.append(now)
+        while self._recent and self._recent[0] < now - 60:
+            self._recent.popleft()
+    
+    def snapshot(self) -> Dict:
+        now = time.monotonic()
+        while self._recent and self._recent[0] < now - 60:
+            self._recent.popleft()
+        return {
+            "processed_total": self.processed_total,
+            "retried_total": self.retried_total,
+            "dead_total": self.dead_total,
+            "deferred_total": self.deferred_total,
+            "processed_by_type": dict(self.processed_by_type),
+            "throughput_per_second": round(len(self._recent) / 60, 2),
+            "last_lag_seconds": round(self.last_lag_seconds, 3),
+            "max_lag_seconds": round(self.max_lag_seconds, 3)
+        }
+
+outbox_metrics = OutboxMetrics()
+
+async def enqueue_outbox_event(event_type: str, aggregate_id: str, payload: Dict, key: Optional[str] = None, session=None):
+    """Record a side effect to run after the state change it belongs to.
+    
+    Pass the session of the state change's transaction so both commit together.
+    The key (default "<type>:<aggregate>") is unique, so enqueueing the same
+    side effect twice raises DuplicateKeyError instead of running it twice.
+    """
+    now = datetime.now(timezone.utc)
+    await db.outbox.insert_one({
+        "id": str(uuid.uuid4()),
+        "key": key or f"{event_type}:{aggregate_id}",
+        "type": event_type,
+        "aggregate_id": aggregate_id,
+        "partition": zlib.crc32(aggregate_id.encode()) % OUTBOX_PARTITIONS,
+        "payload": payload,
+        "status": "pending",
+        "attempts": 0,
+        "available_at": now,
+        "locked_until": None,
+        "last_error": None,
+        "created_at": now,
+        "processed_at": None
+    }, session=session)
+    outbox_wakeup.set()
+
+def applied_once(query: Dict, update: Dict, key: str) -> tuple:
+    """Guard an $inc-style update so replaying the same outbox event is a no-op"""
+    guarded = {**query, "applied_events": {"$ne": key}}
+    update = {**update, "$push": {"applied_events": {"$each": [key], "$slice": -OUTBOX_APPLIED_WINDOW}}}
+    return guarded, update
+
+async def handle_order_created(event: Dict):
+    """Settle reward points redeemed and earned by an order"""
+    payload = event['payload']
+    query, update = applied_once(
+        {"id": payload['customer_id']},
+        {"$inc": {"reward_points": payload['points_delta']}},
+        event['key']
+    )
+    await db.users.update_one(query, update)
+
+async def handle_order_delivered(event: Dict):
+    """Write the driver's earning row, totals and rollups"""
+    earning = event['payload']['earning']
+    
+    # Without a transaction the event is written just before the order turns
+    # delivered, and stays waiting if a crash stops the transition in between
+    order = await db.orders.find_one({"id": event['aggregate_id']}, {"_id": 0, "status": 1})
+    if order and order['status'] == OrderStatus.CANCELLED:
+        return
+    if not order or order['status'] != OrderStatus.DELIVERED:
+        raise OutboxDeferred("order is not delivered yet")
+    
+    # Unique index on order_id: the earning row is written exactly once
+    try:
+        await db.driver_earnings.insert_one(dict(earning))
+    except DuplicateKeyError:
+        pass
+    
+    query, update = applied_once(
+        {"id": earning['driver_id']},
+        {"$inc": {"total_earnings": earning['amount'], "total_deliveries": 1}},
+        event['key']
+    )
+    await db.drivers.update_one(query, update)
+    
+    try:
+        await record_earnings_rollups(
+            earning['driver_id'],
+            earning['amount'],
+            earning['distance_km'],
+            as_utc(earning['created_at']),
+            applied_key=event['key']
+        )
+    except BulkWriteError as e:
+        # Buckets that already saw this event fail the guarded upsert with a duplicate key
+        if any(error['code'] != 11000 for error in e.details['writeErrors']):
+            raise
+
+async def handle_review_created(event: Dict):
+    """Fold a new review into the driver's running rating"""
+    payload = event['payload']
+    key = event['key']
     await db.drivers.update_one(
-        {"id": driver['id']},
+        {"id": event['aggregate_id'], "applied_events": {"$ne": key}},
+        [
+            {"$set": {
+                "rating_sum": {"$add": [{"$ifNull": ["$rating_sum", 0]}, payload['rating']]},
+                "rating_count": {"$add": [{"$ifNull": ["$rating_count", 0]}, 1]},
+                "applied_events": {"$slice": [
+                    {"$concatArrays": [{"$ifNull": ["$applied_events", []]}, [key]]},
+                    -OUTBOX_APPLIED_WINDOW
+                ]}
+            }},
+            {"$set": {"rating": {"$round": [{"$divide": ["$rating_sum", "$rating_count"]}, 2]}}}
+        ]
+    )
+
+OUTBOX_HANDLERS = {
+    "order.created": handle_order_created,
+    "order.delivered": handle_order_delivered,
+    "review.created": handle_review_created,
+}
+
+async def process_outbox_event(event: Dict) -> bool:
+    """Claim and run one event; returns False if it failed and should block its aggregate"""
+    now = datetime.now(timezone.utc)
+    claimed = await db.outbox.find_one_and_update(
         {
-            "$inc": {
-                "total_earnings": earning_amount,
-                "total_deliveries": 1
-            }
-        }
+            "_id": event['_id'],
+            "$or": [{"status": "pending"}, {"status": "processing", "locked_until": {"$lt": now}}]
+        },
+        {"$set": {"status": "processing", "locked_until": now + timedelta(seconds=OUTBOX_LEASE_SECONDS)}},
+        return_document=ReturnDocument.AFTER
     )
+    if not claimed:
+        return False  # another worker has it
     
-    # Update order status
-    await db.orders.update_one(
-        {"id": order_id},
-        {"$set": {"status": OrderStatus.DELIVERED, "updated_at": datetime.now(timezone.utc).isoformat()}}
+    try:
+        await OUTBOX_HANDLERS[claimed['type']](claimed)
+    except OutboxDeferred:
+        # Check again soon after enqueueing, then back off as the event ages
+        created_at = claimed['created_at']
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        delay = min(max((now - created_at).total_seconds(), 1), 300)
+        outbox_metrics.deferred_total += 1
+        await db.outbox.update_one(
+            {"_id": claimed['_id']},
+            {"$set": {"status": "pending", "available_at": datetime.now(timezone.utc) + timedelta(seconds=delay)}}
+        )
+        return False
+    except Exception as e:
+        attempts = claimed['attempts'] + 1
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            outbox_metrics.dead_total += 1
+            logging.error(f"Outbox event {claimed['id']} ({claimed['type']}) dead after {attempts} attempts: {str(e)}")
+            update = {"status": "dead", "attempts": attempts, "last_error": str(e)}
+        else:
+            outbox_metrics.retried_total += 1
+            backoff = min(2 ** attempts, 300) * random.uniform(0.5, 1.5)
+            update = {
+                "status": "pending",
+                "attempts": attempts,
+                "last_error": str(e),
+                "available_at": datetime.now(timezone.utc) + timedelta(seconds=backoff)
+            }
+        await db.outbox.update_one({"_id": claimed['_id']}, {"$set": update})
+        return False
+    
+    processed_at = datetime.now(timezone.utc)
+    await db.outbox.update_one(
+        {"_id": claimed['_id']},
+        {"$set": {"status": "done", "processed_at": processed_at, "attempts": claimed['attempts'] + 1}}
+    )
+    created_at = claimed['created_at']
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    outbox_metrics.record_success(claimed['type'], (processed_at - created_at).total_seconds())
+    return True
+
+async def drain_outbox_partitions(partitions: List[int]) -> int:
+    """Process ready events in _id order, never running an event ahead of an unfinished earlier one of its aggregate"""
+    now = datetime.now(timezone.utc)
+    # Aggregates with an event in backoff or leased to another worker are
+    # excluded in the query, so a long backlog behind one of them cannot fill
+    # the batch and starve the rest of the partition
+    blocked = set(await db.outbox.distinct("aggregate_id", {
+        "partition": {"$in": partitions},
+        "$or": [
+            {"status": "pending", "available_at": {"$gt": now}},
+            {"status": "processing", "locked_until": {"$gt": now}}
+        ]
+    }))
+    events = await db.outbox.find(
+        {
+            "partition": {"$in": partitions},
+            "status": {"$in": ["pending", "processing"]},
+            "aggregate_id": {"$nin": list(blocked)}
+        },
+        {"payload": 0}
+    ).sort("_id", 1).to_list(200)
+    
+    processed = 0
+    for event in events:
+        aggregate = event['aggregate_id']
+        if aggregate in blocked:
+            continue
+        locked_until = event.get('locked_until')
+        available_at = event['available_at']
+        if available_at.tzinfo is None:
+            available_at = available_at.replace(tzinfo=timezone.utc)
+        if locked_until is not None and locked_until.tzinfo is None:
+            locked_until = locked_until.replace(tzinfo=timezone.utc)
+        in_flight = event['status'] == "processing" and locked_until and locked_until > now
+        if in_flight or available_at > now:
+            blocked.add(aggregate)
+            continue
+        
+        if await process_outbox_event(event):
+            processed += 1
+        else:
+            blocked.add(aggregate)
+    return processed
+
+async def outbox_worker(worker_index: int, worker_count: int):
+    """Drain this worker's share of the outbox partitions"""
+    partitions = [p for p in range(OUTBOX_PARTITIONS) if p % worker_count == worker_index]
+    while True:
+        try:
+            if await drain_outbox_partitions(partitions):
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Outbox worker {worker_index} failed: {str(e)}")
+        
+        outbox_wakeup.clear()
+        try:
+            await asyncio.wait_for(outbox_wakeup.wait(), timeout=1.0)
+        except asyncio.TimeoutError:
+            pass
+
+def start_outbox_workers() -> List[asyncio.Task]:
+    worker_count = max(1, min(OUTBOX_WORKERS, OUTBOX_PARTITIONS))
+    return [asyncio.create_task(outbox_worker(i, worker_count)) for i in range(worker_count)]
+
+@api_router.get("/health/outbox")
+async def get_outbox_health():
+    """Outbox worker throughput, lag and backlog"""
+    backlog = await db.outbox.count_documents({"status": {"$in": ["pending", "processing"]}})
+    dead = await db.outbox.count_documents({"status": "dead"})
+    oldest = await db.outbox.find_one(
+        {"status": {"$in": ["pending", "processing"]}},
+        {"_id": 0, "created_at": 1},
+        sort=[("_id", 1)]
     )
+    oldest_age = None
+    if oldest:
+        created_at = oldest['created_at']
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        oldest_age = round((datetime.now(timezone.utc) - created_at).total_seconds(), 3)
     
     return {
-        "message": "Delivery completed",
-        "earning": earning_amount,
-        "status": OrderStatus.DELIVERED
+        **outbox_metrics.snapshot(),
+        "backlog": backlog,
+        "dead": dead,
+        "oldest_pending_age_seconds": oldest_age
     }
 
+# ==================== EXPIRING RECORDS ====================
+
+async def purge_expired_records(now: Optional[datetime] = None) -> Dict[str, int]:
+    """Delete expired sessions, codes and resets the TTL monitor has not reached yet.
+    
+    Also removes legacy documents whose expires_at is still an ISO string, which
+    TTL indexes ignore. now defaults to the current time (load tests pass a simulated clock).
+    """
+    now = now or datetime.now(timezone.utc)
+    purged = {}
+    for name in EXPIRING_COLLECTIONS:
+        result = await db[name].delete_many({"$or": [
+            {"expires_at": {"$lte": now}},
+            {"expires_at": {"$type": "string", "$lte": now.isoformat()}}
+        ]})
+        purged[name] = result.deleted_count
+        if EXPIRED_PURGE_COMPACT and result.deleted_count:
+            # Give the freed space back after large purges
+            await db.command("compact", name)
+    return purged
+
+async def expired_record_purge_loop(interval_seconds: int = EXPIRED_PURGE_INTERVAL_SECONDS):
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            purged = await purge_expired_records()
+            if any(purged.values()):
+                logging.info(f"Purged expired records: {purged}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Expired record purge failed: {str(e)}")
+
+async def expiring_record_stats() -> Dict[str, Dict[str, int]]:
+    """Live and expired-but-not-yet-removed document counts per expiring collection"""
+    now = datetime.now(timezone.utc)
+    stats = {}
+    for name in EXPIRING_COLLECTIONS:
+        live, expired = await asyncio.gather(
+            db[name].count_documents({"expires_at": {"$gt": now}}),
+            db[name].count_documents({"expires_at": {"$lte": now}})
+        )
+        stats[name] = {"live": live, "expired": expired}
+    return stats
+
+@api_router.get("/health/storage")
+async def get_storage_health():
+    """Live vs expired counts for sessions, verification codes and password resets"""
+    return await expiring_record_stats()
+
+# ==================== METRICS ====================
+
+# Histogram upper bounds (Prometheus "le"); +Inf is implicit
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum")
+    
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+    
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+    
+    def render(self, name: str, labels: str, lines: List[str]):
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        cumulative += self.counts[-1]
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {cumulative}')
+
+def prometheus_labels(**labels) -> str:
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped))
+
+class RequestMetrics:
+    """Per route template counters and histograms; updated on the event loop, so no locking"""
+    
+    def __init__(self):
+        self.in_flight = 0
+        self.latency: Dict[tuple, Histogram] = {}
+        self.request_size: Dict[tuple, Histogram] = {}
+        self.response_size: Dict[tuple, Histogram] = {}
+    
+    def observe(self, method: str, route: str, status: int, seconds: float, request_bytes: int, response_bytes: int):
+        key = (method, route, status)
+        latency = self.latency.get(key)
+        if latency is None:
+            latency = self.latency[key] = Histogram(LATENCY_BUCKETS)
+            self.request_size[key] = Histogram(SIZE_BUCKETS)
+            self.response_size[key] = Histogram(SIZE_BUCKETS)
+        latency.observe(seconds)
+        self.request_size[key].observe(request_bytes)
+        self.response_size[key].observe(response_bytes)
+    
+    def render(self, lines: List[str]):
+        lines.append("# TYPE healer_http_requests_in_flight gauge")
+        lines.append(f"healer_http_requests_in_flight {self.in_flight}")
+        
+        lines.append("# TYPE healer_http_requests_total counter")
+        for (method, route, status), histogram in self.latency.items():
+            labels = prometheus_labels(method=method, route=route, status=status)
+            lines.append(f"healer_http_requests_total{{{labels}}} {sum(histogram.counts)}")
+        
+        for name, series in (
+            ("healer_http_request_duration_seconds", self.latency),
+            ("healer_http_request_size_bytes", self.request_size),
+            ("healer_http_response_size_bytes", self.response_size),
+        ):
+            lines.append(f"# TYPE {name} histogram")
+            for (method, route, status), histogram in series.items():
+                histogram.render(name, prometheus_labels(method=method, route=route, status=status), lines)
+
+request_metrics = RequestMetrics()
+
+class MetricsMiddleware:
+    """Pure ASGI middleware; labels requests by the matched route template so ids never become labels"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        started = time.perf_counter()
+        status = 500
+        response_bytes = 0
+        
+        async def send_wrapper(message):
+            nonlocal status, response_bytes
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            await send(message)
+        
+        request_metrics.in_flight += 1
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_metrics.in_flight -= 1
+            # The router records the matched route on the scope
+            route = scope.get("route")
+            content_length = next((v for k, v in scope["headers"] if k == b"content-length"), b"0")
+            request_metrics.observe(
+                scope["method"],
+                getattr(route, "path_format", None) or "unmatched",
+                status,
+                time.perf_counter() - started,
+                int(content_length) if content_length.isdigit() else 0,
+                response_bytes
+            )
+
+class QueryStatsMiddleware:
+    """Collects per-request Mongo command counts; warns on requests over DB_QUERY_BUDGET.
+    
+    With DB_DEBUG_HEADERS on, responses carry X-DB-Queries and X-DB-Time-ms (commands
+    finished by the time the response starts).
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        stats = QueryStats()
+        token = request_query_stats.set(stats)
+        
+        async def send_wrapper(message):
+            if DB_DEBUG_HEADERS and message["type"] == "http.response.start":
+                message = {**message, "headers": [
+                    *message.get("headers", []),
+                    (b"x-db-queries", str(stats.count).encode()),
+                    (b"x-db-time-ms", f"{stats.duration_ms:.1f}".encode()),
+                ]}
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_query_stats.reset(token)
+            if stats.count > DB_QUERY_BUDGET:
+                route = getattr(scope.get("route"), "path_format", scope["path"])
+                breakdown = ", ".join(f"{target} x{count}" for target, count in sorted(stats.by_target.items(), key=lambda item: -item[1]))
+                logging.warning(
+                    f"{scope['method']} {route} issued {stats.count} Mongo commands "
+                    f"(budget {DB_QUERY_BUDGET}, {stats.duration_ms:.1f} ms): {breakdown}"
+                )
+
+def render_gauge(lines: List[str], name: str, value, kind: str = "gauge", **labels):
+    lines.append(f"# TYPE {name} {kind}")
+    lines.append(f"{name}{{{prometheus_labels(**labels)}}} {value}" if labels else f"{name} {value}")
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus text exposition of request metrics and background worker state"""
+    lines: List[str] = []
+    request_metrics.render(lines)
+    
+    outbox = outbox_metrics.snapshot()
+    render_gauge(lines, "healer_outbox_processed_total", outbox['processed_total'], "counter")
+    render_gauge(lines, "healer_outbox_retried_total", outbox['retried_total'], "counter")
+    render_gauge(lines, "healer_outbox_dead_total", outbox['dead_total'], "counter")
+    render_gauge(lines, "healer_outbox_deferred_total", outbox['deferred_total'], "counter")
+    render_gauge(lines, "healer_outbox_lag_seconds", outbox['last_lag_seconds'])
+    
+    lines.append("# TYPE healer_notifications_queued gauge")
+    for channel, stats in notifications.stats().items():
+        lines.append(f'healer_notifications_queued{{{prometheus_labels(channel=channel)}}} {stats["queued"]}')
+    lines.append("# TYPE healer_notifications_sent_total counter")
+    for channel, stats in notifications.stats().items():
+        lines.append(f'healer_notifications_sent_total{{{prometheus_labels(channel=channel)}}} {stats["sent_total"]}')
+    
+    if payment_gateway:
+        gateway = payment_gateway.stats()
+        render_gauge(lines, "healer_payment_gateway_open", int(gateway['state'] != "closed"))
+        render_gauge(lines, "healer_payment_gateway_in_flight", gateway['in_flight'])
+        render_gauge(lines, "healer_payment_gateway_failures_total", gateway['failures'], "counter")
+    
+    command_totals = list(command_listener.totals.items())
+    lines.append("# TYPE healer_mongo_commands_total counter")
+    for command_name, (count, _) in command_totals:
+        lines.append(f"healer_mongo_commands_total{{{prometheus_labels(command=command_name)}}} {count}")
+    lines.append("# TYPE healer_mongo_command_seconds_total counter")
+    for command_name, (_, seconds) in command_totals:
+        lines.append(f"healer_mongo_command_seconds_total{{{prometheus_labels(command=command_name)}}} {seconds}")
+    
+    render_gauge(lines, "healer_revocation_filter_items", revocation_filter.item_count)
+    render_gauge(lines, "healer_thumbnail_cache_bytes", thumbnail_cache.total_bytes)
+    render_gauge(lines, "healer_driver_index_size", len(driver_index))
+    
+    if TRACING_ENABLED:
+        render_gauge(lines, "healer_traces_exported_total", trace_exporter.exported_total, "counter")
+        render_gauge(lines, "healer_traces_dropped_total", trace_exporter.dropped_total, "counter")
+        render_gauge(lines, "healer_traces_failed_total", trace_exporter.failed_total, "counter")
+    
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+# ==================== TRACING ====================
+
+class JsonlTraceSink:
+    """Appends one JSON object per trace, rotating the file at TRACE_FILE_MAX_BYTES"""
+    
+    def __init__(self, path: str = TRACE_FILE, max_bytes: int = TRACE_FILE_MAX_BYTES, backups: int = TRACE_FILE_BACKUPS):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+    
+    def rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            older = self.path.with_name(f"{self.path.name}.{index}")
+            if older.exists():
+                older.replace(self.path.with_name(f"{self.path.name}.{index + 1}"))
+        self.path.replace(self.path.with_name(f"{self.path.name}.1"))
+    
+    def write(self, traces: List[Dict]):
+        lines = "".join(json.dumps(trace, default=str) + "\n" for trace in traces)
+        if self.path.exists() and self.path.stat().st_size + len(lines) > self.max_bytes:
+            self.rotate()
+        with open(self.path, "a") as f:
+            f.write(lines)
+
+class OtlpTraceSink:
+    """Posts traces to a local OpenTelemetry collector using OTLP/HTTP with JSON encoding"""
+    
+    def __init__(self, endpoint: str = TRACE_OTLP_ENDPOINT):
+        self.endpoint = endpoint
+    
+    @staticmethod
+    def attribute(key: str, value) -> Dict:
+        if isinstance(value, bool):
+            return {"key": key, "value": {"boolValue": value}}
+        if isinstance(value, int):
+            return {"key": key, "value": {"intValue": str(value)}}
+        if isinstance(value, float):
+            return {"key": key, "value": {"doubleValue": value}}
+        return {"key": key, "value": {"stringValue": str(value)}}
+    
+    def write(self, traces: List[Dict]):
+        spans = [
+            {
+                "traceId": trace['trace_id'],
+                "spanId": span['span_id'],
+                "parentSpanId": span['parent_id'] or "",
+                "name": span['name'],
+                "kind": 2 if span['parent_id'] is None else 1,  # SERVER for the request, INTERNAL below it
+                "startTimeUnixNano": str(span['start_ns']),
+                "endTimeUnixNano": str(span['end_ns']),
+                "attributes": [self.attribute(k, v) for k, v in span['attributes'].items() if v is not None],
+                "status": {"code": 2, "message": span['error']} if span['error'] else {"code": 0}
+            }
+            for trace in traces
+            for span in trace['spans']
+        ]
+        response = requests.post(self.endpoint, json={"resourceSpans": [{
+            "resource": {"attributes": [self.attribute("service.name", "healer-backend")]},
+            "scopeSpans": [{"scope": {"name": "healer"}, "spans": spans}]
+        }]}, timeout=5)
+        response.raise_for_status()
+
+TRACE_SINKS = {
+    "file": JsonlTraceSink,
+    "otlp": OtlpTraceSink,
+}
+
+class TraceExporter:
+    """Bounded queue of finished traces, written in batches off the event loop; drops when full"""
+    
+    def __init__(self, sink):
+        self.sink = sink
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=TRACE_QUEUE_SIZE)
+        self.exported_total = 0
+        self.dropped_total = 0
+        self.failed_total = 0
+    
+    def submit(self, trace: Dict):
+        try:
+            self.queue.put_nowait(trace)
+        except asyncio.QueueFull:
+            self.dropped_total += 1
+    
+    def pending(self) -> List[Dict]:
+        batch = []
+        while len(batch) < TRACE_BATCH_SIZE and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+    
+    async def export(self, batch: List[Dict]):
+        try:
+            await asyncio.to_thread(self.sink.write, batch)
+            self.exported_total += len(batch)
+        except Exception as e:
+            self.failed_total += len(batch)
+            logging.warning(f"Trace export failed: {str(e)}")
+    
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            batch.extend(self.pending())
+            await self.export(batch)
+    
+    async def flush(self):
+        while batch := self.pending():
+            await self.export(batch)
+
+trace_exporter = TraceExporter(TRACE_SINKS[TRACE_EXPORTER]())
+
+class TracingMiddleware:
+    """Opens the root span of each request. Requests are recorded when sampled by rate or,
+    with TRACE_SLOW_MS set, always, and then kept only if they turned out slow.
+    
+    Only installed when TRACING_ENABLED; spans opened elsewhere are no-ops without a root.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        sampled = random.random() < TRACE_SAMPLE_RATE
+        if not sampled and TRACE_SLOW_MS <= 0:
+            await self.app(scope, receive, send)
+            return
+        
+        trace = Trace(f"{random.getrandbits(128):032x}", sampled)
+        root = Span(trace, f"{scope['method']} {scope['path']}", {"http.method": scope["method"]})
+        status = 500
+        
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+        
+        started = time.perf_counter()
+        try:
+            with root:
+                await self.app(scope, receive, send_wrapper)
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            trace.closed = True
+            if sampled or duration_ms >= TRACE_SLOW_MS:
+                route = getattr(scope.get("route"), "path_format", None) or "unmatched"
+                root_record = next(span for span in reversed(trace.spans) if span['span_id'] == root.span_id)
+                root_record['name'] = f"{scope['method']} {route}"
+                root_record['attributes'].update({"http.route": route, "http.status_code": status})
+                trace_exporter.submit({
+                    "trace_id": trace.trace_id,
+                    "name": f"{scope['method']} {route}",
+                    "duration_ms": round(duration_ms, 3),
+                    "kept_by": "rate" if sampled else "latency",
+                    "dropped_spans": trace.dropped_spans,
+                    "spans": trace.spans
+                })
+
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(RequestSizeLimitMiddleware, max_bytes=MAX_REQUEST_BYTES)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Auth-Token", "X-DB-Queries", "X-DB-Time-ms"],
 )
+app.add_middleware(QueryStatsMiddleware)
+app.add_middleware(MetricsMiddleware)
+if TRACING_ENABLED:
+    app.add_middleware(TracingMiddleware)
 
 # Configure logging
 logging.basicConfig(
@@ -1768,6 +4894,73 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+background_tasks: List[asyncio.Task] = []
+
+async def create_unique_index(collection, key: str, migration: str):
+    """Create a unique index, logging instead of failing startup when older data has duplicates"""
+    try:
+        await collection.create_index(key, unique=True)
+    except DuplicateKeyError:
+        logging.error(
+            f"Unique index on {collection.name}.{key} not created: existing documents have duplicate values. "
+            f"Run `python scripts/migrate.py {migration}` and restart"
+        )
+
+@app.on_event("startup")
+async def startup_db_client():
+    await ensure_trail_collections()
+    await db.drivers.create_index([("is_available", 1)])
+    await db.orders.create_index("trip_id")
+    await db.orders.create_index([("pickup_location", "2dsphere"), ("status", 1), ("driver_id", 1)])
+    await db.trips.create_index([("status", 1), ("created_at", 1)])
+    await db.driver_earnings.create_index([("driver_id", 1), ("created_at", -1)])
+    await create_unique_index(db.driver_earnings, "order_id", "dedupe-earnings")
+    await db.driver_earnings_rollups.create_index([("driver_id", 1), ("period", 1), ("start", 1)], unique=True)
+    await create_unique_index(db.driver_reviews, "order_id", "dedupe-reviews")
+    await db.driver_reviews.create_index("driver_id")
+    await db.outbox.create_index([("partition", 1), ("status", 1), ("_id", 1)])
+    await db.outbox.create_index("key", unique=True)
+    await db.outbox.create_index("processed_at", expireAfterSeconds=7 * 24 * 60 * 60)
+    await db.verification_codes.create_index([("user_id", 1), ("type", 1), ("value", 1)], unique=True)
+    await db.verification_codes.create_index("expires_at", expireAfterSeconds=0)
+    await db.password_resets.create_index("email", unique=True)
+    await db.password_resets.create_index("expires_at", expireAfterSeconds=0)
+    await create_unique_index(db.sessions, "session_token", "dedupe-sessions")
+    await db.sessions.create_index("expires_at", expireAfterSeconds=0)
+    await db.revoked_tokens.create_index("jti", unique=True)
+    await db.media.create_index("digest", unique=True)
+    await db.payment_events.create_index("event_id", unique=True)
+    await db.payment_events.create_index([("applied_at", 1), ("received_at", 1)])
+    await db.payment_events.create_index("received_at", expireAfterSeconds=PAYMENT_EVENT_RETENTION_DAYS * 24 * 60 * 60)
+    await db.orders.create_index("razorpay_order_id", sparse=True)
+    await db.orders.create_index([("payment_status", 1), ("payment_checked_at", 1)])
+    await asyncio.to_thread(thumbnail_cache.load)
+    await db.revoked_tokens.create_index("expires_at", expireAfterSeconds=0)
+    await load_driver_index()
+    background_tasks.append(asyncio.create_task(trail_downsampling_loop()))
+    background_tasks.append(asyncio.create_task(driver_index_sync_loop()))
+    background_tasks.append(asyncio.create_task(driver_rating_repair_loop()))
+    background_tasks.extend(start_outbox_workers())
+    background_tasks.extend(notifications.start())
+    background_tasks.append(asyncio.create_task(expired_record_purge_loop()))
+    await sync_revocation_filter()
+    background_tasks.append(asyncio.create_task(revocation_sync_loop()))
+    background_tasks.append(asyncio.create_task(payment_event_applier_loop()))
+    if payment_gateway:
+        background_tasks.append(asyncio.create_task(payment_reconciliation_loop()))
+    if TRIP_BATCHING:
+        background_tasks.append(asyncio.create_task(trip_batching_loop()))
+    if DISPATCH_BATCH_MATCHING:
+        background_tasks.append(asyncio.create_task(batch_matching_loop()))
+    if TRACING_ENABLED:
+        background_tasks.append(asyncio.create_task(trace_exporter.run()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
+    await trace_exporter.flush()
+    reset_thumbnail_pool()
+    if payment_gateway:
+        payment_gateway.executor.shutdown(wait=False, cancel_futures=True)
     client.close()
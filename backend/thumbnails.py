@@ -0,0 +1,27 @@
+"""
+Thumbnail rendering for the process pool
+
+Kept apart from server.py so spawned workers import only Pillow, not the
+app, its Mongo client and the dispatch stack.
+"""
+
+import os
+
+from PIL import Image, ImageOps
+
+def render_thumbnail(source_path: str, target_path: str, max_px: int, image_format: str, quality: int) -> int:
+    """Resize an image to fit max_px x max_px (runs in a worker process). Returns bytes written."""
+    with Image.open(source_path) as image:
+        # Let the JPEG decoder downscale while decoding; exif_transpose would load full size first
+        image.draft("RGB", (max_px, max_px))
+        image = ImageOps.exif_transpose(image)
+        if image_format == "JPEG":
+            image = image.convert("RGB")
+        elif image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        image.thumbnail((max_px, max_px), Image.Resampling.LANCZOS)
+        
+        staging = f"{target_path}.{os.getpid()}.tmp"
+        image.save(staging, image_format, quality=quality, optimize=image_format == "JPEG")
+    os.replace(staging, target_path)
+    return os.path.getsize(target_path)
@@ -2,6 +2,7 @@ import React, { useState, useContext, useEffect } from 'react';
 import axios from 'axios';
 import { CustomerContext } from '../CustomerApp';
 import { User, Mail, Phone, Camera, Lock, Shield, CheckCircle, Clock, AlertCircle } from 'lucide-react';
+import { mediaUrl } from '@/lib/utils';
 
 const CustomerProfile = () => {
   const { user, API, updateUser } = useContext(CustomerContext);
@@ -282,7 +283,7 @@ const CustomerProfile = () => {
         <div className="profile-picture-section">
           <div className="picture-container">
             {user?.profile_pic ? (
-              <img src={user.profile_pic} alt="Profile" className="profile-pic" />
+              <img src={mediaUrl(user.profile_pic)} alt="Profile" className="profile-pic" />
             ) : (
               <div className="profile-pic-placeholder">
                 <User size={48} />
@@ -2,6 +2,7 @@ import React, { useState, useContext, useEffect } from 'react';
 import axios from 'axios';
 import { DriverContext } from '../DriverApp';
 import { User, Mail, Phone, Camera, Lock, Shield, CheckCircle, Clock, AlertCircle, Truck } from 'lucide-react';
+import { mediaUrl } from '@/lib/utils';
 
 const DriverProfile = () => {
   const { user, API, updateUser } = useContext(DriverContext);
@@ -341,7 +342,7 @@ const DriverProfile = () => {
         <div className="profile-picture-section">
           <div className="picture-container">
             {user?.profile_pic ? (
-              <img src={user.profile_pic} alt="Profile" className="profile-pic" />
+              <img src={mediaUrl(user.profile_pic)} alt="Profile" className="profile-pic" />
             ) : (
               <div className="profile-pic-placeholder">
                 <Truck size={48} />
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+complete_delivery latency benchmark
+Compares the previous sequential implementation (read order, read driver,
+insert earning, increment driver, set status) with the current guarded
+transition + outbox path, against a local mongod. Transactions are used on
+a replica set only; the "complete_delivery benchmark" workflow runs both topologies.
+
+Usage: python scripts/bench_complete_delivery.py [--orders 2000] [--mongo-url mongodb://localhost:27017]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=2000)
+    parser.add_argument('--mongo-url', default=os.environ.get('MONGO_URL', 'mongodb://localhost:27017'))
+    return parser.parse_args()
+
+args = parse_args()
+os.environ['MONGO_URL'] = args.mongo_url
+os.environ['DB_NAME'] = 'healer_bench_delivery'
+
+import server  # noqa: E402
+from server import db, OrderStatus  # noqa: E402
+
+async def legacy_complete_delivery(order_id: str, user_id: str):
+    """The pre-transaction implementation, kept here as the baseline"""
+    order = await db.orders.find_one({"id": order_id})
+    driver = await db.drivers.find_one({"user_id": user_id})
+    earning_amount = server.calculate_driver_earning(order['distance_km'], driver['state'])
+    earning = server.DriverEarning(
+        driver_id=driver['id'], order_id=order_id, amount=earning_amount,
+        distance_km=order['distance_km'], state=driver['state']
+    ).model_dump()
+    earning['created_at'] = earning['created_at'].isoformat()
+    earning['order_id'] = f"legacy-{order_id}"  # keep clear of the unique index
+    await db.driver_earnings.insert_one(earning)
+    await db.drivers.update_one({"id": driver['id']}, {"$inc": {"total_earnings": earning_amount, "total_deliveries": 1}})
+    await db.orders.update_one(
+        {"id": order_id},
+        {"$set": {"status": OrderStatus.DELIVERED, "updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+
+async def seed(driver: dict, count: int) -> list:
+    order_ids = [str(uuid.uuid4()) for _ in range(count)]
+    await db.orders.insert_many([
+        {"id": oid, "driver_id": driver['id'], "status": OrderStatus.IN_TRANSIT, "distance_km": 4.2,
+         "created_at": datetime.now(timezone.utc).isoformat()}
+        for oid in order_ids
+    ])
+    return order_ids
+
+def report(name: str, latencies: list):
+    latencies.sort()
+    pct = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000  # noqa: E731
+    print(f"{name:12} p50={pct(0.5):.2f} ms  p95={pct(0.95):.2f} ms  p99={pct(0.99):.2f} ms")
+
+async def main():
+    await server.client.admin.command("ping")
+    await server.client.drop_database('healer_bench_delivery')
+    await server.startup_db_client()
+    for task in server.background_tasks:
+        task.cancel()
+    
+    user_id = str(uuid.uuid4())
+    driver = {"id": str(uuid.uuid4()), "user_id": user_id, "state": "Karnataka", "is_available": False}
+    await db.drivers.insert_one(dict(driver))
+    # What the current_driver dependency resolves from the token's driver scope
+    driver_scope = {"id": driver['id'], "state": driver['state']}
+    
+    transactions = await server.supports_transactions()
+    print(f"orders per run: {args.orders}  (transactions {'on' if transactions else 'off: standalone mongod'})")
+    
+    for name, run in (
+        ("legacy", lambda oid: legacy_complete_delivery(oid, user_id)),
+        ("current", lambda oid: server.complete_delivery(oid, driver_scope)),
+    ):
+        order_ids = await seed(driver, args.orders)
+        latencies = []
+        for oid in order_ids:
+            t0 = time.perf_counter()
+            await run(oid)
+            latencies.append(time.perf_counter() - t0)
+        report(name, latencies)
+    
+    # Double taps must not pay twice
+    oid = (await seed(driver, 1))[0]
+    await server.complete_delivery(oid, driver_scope)
+    try:
+        await server.complete_delivery(oid, driver_scope)
+    except server.HTTPException as e:
+        payouts = await db.outbox.count_documents({"type": "order.delivered", "aggregate_id": oid})
+        print(f"double tap:  rejected ({e.detail}), payout events = {payouts}")
+    
+    await server.client.drop_database('healer_bench_delivery')
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Dispatch index benchmark
+Loads N online drivers around the major delivery cities into the in-memory
+grid index and measures k-nearest lookups and location-ping updates, then
+times the batch order-to-driver matching solver on an M x M instance and a
+full matching pass (candidate selection + solver) for M orders against every
+indexed driver.
+
+Usage: python scripts/bench_dispatch.py [--drivers 50000] [--queries 20000] [--k 5] [--matching 500]
+                                        [--full-matrix]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'healer_bench')
+
+from server import DriverGridIndex, calculate_distance, select_match_candidates, solve_assignment  # noqa: E402
+
+CITY_CENTERS = [
+    (28.6139, 77.2090),  # Delhi
+    (19.0760, 72.8777),  # Mumbai
+    (12.9716, 77.5946),  # Bengaluru
+    (13.0827, 80.2707),  # Chennai
+    (26.8467, 80.9462),  # Lucknow
+    (23.0225, 72.5714),  # Ahmedabad
+    (22.5726, 88.3639),  # Kolkata
+    (26.9124, 75.7873),  # Jaipur
+]
+
+def random_point(rng: random.Random, spread_deg: float = 0.15):
+    lat, lng = rng.choice(CITY_CENTERS)
+    return lat + rng.gauss(0, spread_deg), lng + rng.gauss(0, spread_deg)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--drivers', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=20000)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--matching', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--full-matrix', action='store_true',
+                        help="also solve against every driver (orders x drivers matrix; needs several GB at 50k drivers)")
+    args = parser.parse_args()
+    
+    rng = random.Random(args.seed)
+    index = DriverGridIndex()
+    
+    drivers = [(f"driver-{i}", *random_point(rng)) for i in range(args.drivers)]
+    start = time.perf_counter()
+    for driver_id, lat, lng in drivers:
+        index.upsert(driver_id, lat, lng)
+    load_s = time.perf_counter() - start
+    
+    # Location pings move drivers a few hundred metres
+    pings = [(rng.choice(drivers)[0], *random_point(rng)) for _ in range(args.queries)]
+    start = time.perf_counter()
+    for driver_id, lat, lng in pings:
+        index.upsert(driver_id, lat, lng)
+    ping_us = (time.perf_counter() - start) / len(pings) * 1e6
+    
+    queries = [random_point(rng, 0.1) for _ in range(args.queries)]
+    latencies = []
+    for lat, lng in queries:
+        t0 = time.perf_counter()
+        index.nearest(lat, lng, k=args.k)
+        latencies.append((time.perf_counter() - t0) * 1e6)
+    latencies.sort()
+    
+    # Spot-check against a brute-force scan
+    mismatches = 0
+    for lat, lng in queries[:50]:
+        expected = sorted(
+            (calculate_distance(lat, lng, dlat, dlng), driver_id)
+            for driver_id, (dlat, dlng, _) in index.positions.items()
+        )
+        expected = [d for d in expected if d[0] <= 15][:args.k]
+        got = index.nearest(lat, lng, k=args.k)
+        if [round(d, 1) for d, _ in got] != [round(d, 1) for d, _ in expected]:
+            mismatches += 1
+    
+    print(f"drivers:          {len(index)} in {len(index.cells)} cells (loaded in {load_s:.2f}s)")
+    print(f"ping update:      {ping_us:.1f} us/op")
+    print(f"k={args.k} nearest:      p50={latencies[len(latencies) // 2]:.1f} us  "
+          f"p99={latencies[int(len(latencies) * 0.99)]:.1f} us")
+    print(f"brute-force check: {50 - mismatches}/50 match")
+    
+    # Batch matching within a single city
+    center = [CITY_CENTERS[0]]
+    pickups = [(lat + rng.gauss(0, 0.08), lng + rng.gauss(0, 0.08)) for lat, lng in center * args.matching]
+    free_drivers = [(lat + rng.gauss(0, 0.08), lng + rng.gauss(0, 0.08)) for lat, lng in center * args.matching]
+    timings = []
+    for _ in range(5):
+        t0 = time.perf_counter()
+        pairs = solve_assignment(pickups, free_drivers)
+        timings.append((time.perf_counter() - t0) * 1000)
+    total_km = sum(distance for _, _, distance in pairs)
+    
+    # Greedy one-at-a-time baseline for comparison
+    taken, greedy_km = set(), 0.0
+    for plat, plng in pickups:
+        options = [
+            (calculate_distance(plat, plng, dlat, dlng), j)
+            for j, (dlat, dlng) in enumerate(free_drivers) if j not in taken
+        ]
+        distance, j = min(options)
+        taken.add(j)
+        greedy_km += distance
+    
+    print(f"matching {args.matching}x{args.matching}: best={min(timings):.1f} ms  "
+          f"total pickup {total_km:.0f} km vs greedy {greedy_km:.0f} km")
+    
+    # A matching pass as run_batch_matching does it: orders from a few pharmacies
+    # per city, solved against the nearest-driver candidates out of the whole index
+    pharmacies = [random_point(rng, 0.1) for _ in range(max(1, args.matching // 5))]
+    pickups = [rng.choice(pharmacies) for _ in range(args.matching)]
+    timings = []
+    for _ in range(5):
+        t0 = time.perf_counter()
+        candidates = select_match_candidates(pickups, index)
+        pairs = solve_assignment(pickups, [(lat, lng) for _, lat, lng in candidates])
+        timings.append((time.perf_counter() - t0) * 1000)
+    total_km = sum(distance for _, _, distance in pairs)
+    print(f"matching pass {args.matching} orders x {len(index)} drivers: best={min(timings):.1f} ms  "
+          f"{len(candidates)} candidates, {len(pairs)} matched, total pickup {total_km:.0f} km")
+    
+    if args.full_matrix:
+        everyone = [(lat, lng) for lat, lng, _ in index.positions.values()]
+        t0 = time.perf_counter()
+        full_pairs = solve_assignment(pickups, everyone)
+        full_ms = (time.perf_counter() - t0) * 1000
+        full_km = sum(distance for _, _, distance in full_pairs)
+        print(f"  full {args.matching}x{len(everyone)} matrix: {full_ms:.1f} ms  "
+              f"{len(full_pairs)} matched, total pickup {full_km:.0f} km")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Request metrics overhead benchmark
+Drives a cheap, database-free route straight through the ASGI router, with
+and without MetricsMiddleware, and reports the per-request cost of
+instrumentation. The middleware is also timed around a no-op ASGI app,
+which isolates its own cost from scheduler noise. Also times rendering
+/metrics with many route series.
+
+Usage: python scripts/bench_metrics.py [--requests 20000]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'healer_bench_metrics')
+
+import server  # noqa: E402
+
+PATH = "/api/health/notifications"
+
+def make_scope() -> dict:
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": PATH,
+        "raw_path": PATH.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"host", b"bench")],
+        "client": ("127.0.0.1", 1234),
+        "server": ("bench", 80),
+    }
+
+async def receive():
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+async def send(message):
+    pass
+
+async def noop_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"{}"})
+
+async def drive(asgi_app, count: int) -> float:
+    started = time.perf_counter()
+    for _ in range(count):
+        await asgi_app(make_scope(), receive, send)
+    return (time.perf_counter() - started) / count
+
+async def main(count: int):
+    plain = server.app.router
+    instrumented = server.MetricsMiddleware(server.app.router)
+    
+    # Warm up both paths, then interleave rounds so drift affects both equally
+    await drive(plain, 1000)
+    await drive(instrumented, 1000)
+    plain_times, instrumented_times = [], []
+    for _ in range(10):
+        plain_times.append(await drive(plain, count // 10))
+        instrumented_times.append(await drive(instrumented, count // 10))
+    plain_us = min(plain_times) * 1e6
+    instrumented_us = min(instrumented_times) * 1e6
+    
+    isolated_us = (min([await drive(server.MetricsMiddleware(noop_app), count // 10) for _ in range(5)])
+                   - min([await drive(noop_app, count // 10) for _ in range(5)])) * 1e6
+    
+    print(f"route {PATH}, {count} requests per variant (best of 10 rounds)")
+    print(f"  without middleware: {plain_us:8.2f} µs/request")
+    print(f"  with middleware:    {instrumented_us:8.2f} µs/request")
+    print(f"  overhead:           {instrumented_us - plain_us:8.2f} µs/request ({(instrumented_us / plain_us - 1) * 100:.1f}%)")
+    print(f"  middleware alone:   {isolated_us:8.2f} µs/request (around a no-op app)")
+    
+    # Render cost with a realistic number of series (every route x a few statuses)
+    metrics = server.RequestMetrics()
+    routes = [route.path_format for route in server.app.routes if hasattr(route, "path_format")]
+    for route in routes:
+        for status in (200, 400, 401, 404, 500):
+            metrics.observe("GET", route, status, 0.012, 0, 512)
+    started = time.perf_counter()
+    lines = []
+    metrics.render(lines)
+    print(f"  /metrics render:    {(time.perf_counter() - started) * 1000:8.2f} ms for {len(metrics.latency)} series ({len(lines)} lines)")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20000)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests))
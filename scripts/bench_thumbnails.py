@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Thumbnail pipeline benchmark
+Renders every configured thumbnail size for a set of synthetic photos
+through the same render_thumbnail function and process pool the API uses,
+and reports throughput in images per second overall and per worker core.
+
+Usage: python scripts/bench_thumbnails.py [--images 200] [--width 2400] [--height 1800] [--format webp]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'healer_bench_thumbnails')
+
+import multiprocessing  # noqa: E402
+
+from PIL import Image  # noqa: E402
+
+import server  # noqa: E402
+from thumbnails import render_thumbnail  # noqa: E402
+
+def make_photos(directory: Path, count: int, width: int, height: int) -> list:
+    """JPEGs with noise so the encoder can't take shortcuts on flat colour"""
+    paths = []
+    for i in range(count):
+        path = directory / f"photo-{i}.jpg"
+        Image.effect_noise((width, height), 40 + i % 50).convert("RGB").save(path, "JPEG", quality=90)
+        paths.append(path)
+    return paths
+
+def run(pool: ProcessPoolExecutor, photos: list, out_dir: Path, extension: str) -> float:
+    jobs = [
+        (str(photo), str(out_dir / f"{photo.stem}-{size}.{extension}"), max_px, server.THUMBNAIL_FORMATS[extension], server.THUMBNAIL_QUALITY)
+        for photo in photos
+        for size, max_px in server.THUMBNAIL_SIZES.items()
+    ]
+    started = time.perf_counter()
+    list(pool.map(render_thumbnail, *zip(*jobs), chunksize=4))
+    return time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=200)
+    parser.add_argument('--width', type=int, default=2400)
+    parser.add_argument('--height', type=int, default=1800)
+    parser.add_argument('--format', choices=list(server.THUMBNAIL_FORMATS), default='webp')
+    args = parser.parse_args()
+    
+    cores = os.cpu_count() or 1
+    worker_counts = sorted({1, max(1, cores // 2), cores})
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        print(f"Generating {args.images} {args.width}x{args.height} photos...")
+        photos = make_photos(tmp, args.images, args.width, args.height)
+        
+        print(f"{'workers':>7} {'seconds':>8} {'images/s':>9} {'per core':>9}")
+        for workers in worker_counts:
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                # Warm up so worker start-up is not billed to the first batch
+                run(pool, photos[:workers], tmp, args.format)
+                elapsed = run(pool, photos, tmp, args.format)
+            rate = args.images / elapsed
+            print(f"{workers:>7} {elapsed:>8.2f} {rate:>9.1f} {rate / workers:>9.1f}")
+        print(f"(each image produces {len(server.THUMBNAIL_SIZES)} sizes: {', '.join(server.THUMBNAIL_SIZES)})")
+
+if __name__ == '__main__':
+    main()
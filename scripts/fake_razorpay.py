@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Fake Razorpay gateway for local testing
+Implements the handful of Razorpay REST endpoints the backend uses, with
+knobs for latency and failures so the payment thread pool, timeouts and
+circuit breaker can be exercised without the real provider.
+
+Usage: python scripts/fake_razorpay.py [--port 9100] [--latency-ms 0] [--error-rate 0.0]
+                                      [--webhook-url http://localhost:8001/api/payments/webhook]
+
+Then start the backend with:
+    RAZORPAY_BASE_URL=http://localhost:9100 RAZORPAY_KEY_ID=rzp_test_fake RAZORPAY_KEY_SECRET=fake_secret
+    RAZORPAY_WEBHOOK_SECRET=fake_webhook_secret
+
+Test helpers (not part of the Razorpay API):
+    POST /_fake/orders/{order_id}/pay   capture a payment (or fail it with ?fail=true), send the
+                                        webhooks and return the checkout signature
+    POST /_fake/faults                  change latency_ms / error_rate at runtime
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import random
+import secrets
+import time
+from typing import Optional
+
+import httpx
+import uvicorn
+from fastapi import Depends, FastAPI, HTTPException
+from fastapi.responses import JSONResponse
+from fastapi.security import HTTPBasic, HTTPBasicCredentials
+
+app = FastAPI(title="Fake Razorpay")
+security = HTTPBasic()
+
+state = {
+    "key_id": "rzp_test_fake",
+    "key_secret": "fake_secret",
+    "latency_ms": 0,
+    "error_rate": 0.0,
+    "webhook_url": None,
+    "webhook_secret": "fake_webhook_secret",
+}
+orders = {}
+payments = {}
+
+def authenticate(credentials: HTTPBasicCredentials = Depends(security)):
+    if credentials.username != state['key_id'] or credentials.password != state['key_secret']:
+        raise HTTPException(status_code=401, detail="Authentication failed")
+
+async def simulate_conditions() -> Optional[JSONResponse]:
+    if state['latency_ms']:
+        await asyncio.sleep(state['latency_ms'] / 1000)
+    if random.random() < state['error_rate']:
+        return JSONResponse(status_code=500, content={
+            "error": {"code": "SERVER_ERROR", "description": "The server encountered an error"}
+        })
+    return None
+
+def new_id(prefix: str) -> str:
+    return f"{prefix}_{secrets.token_hex(7)}"
+
+@app.post("/v1/orders", dependencies=[Depends(authenticate)])
+async def create_order(data: dict):
+    failure = await simulate_conditions()
+    if failure:
+        return failure
+    if not isinstance(data.get('amount'), int) or data['amount'] < 100:
+        return JSONResponse(status_code=400, content={
+            "error": {"code": "BAD_REQUEST_ERROR", "description": "The amount must be atleast INR 1.00"}
+        })
+    
+    order = {
+        "id": new_id("order"),
+        "entity": "order",
+        "amount": data['amount'],
+        "amount_paid": 0,
+        "amount_due": data['amount'],
+        "currency": data.get('currency', 'INR'),
+        "receipt": data.get('receipt'),
+        "status": "created",
+        "attempts": 0,
+        "notes": data.get('notes', []),
+        "created_at": int(time.time())
+    }
+    orders[order['id']] = order
+    return order
+
+@app.get("/v1/orders/{order_id}/payments", dependencies=[Depends(authenticate)])
+async def get_order_payments(order_id: str):
+    failure = await simulate_conditions()
+    if failure:
+        return failure
+    items = [payment for payment in payments.values() if payment['order_id'] == order_id]
+    return {"entity": "collection", "count": len(items), "items": items}
+
+@app.get("/v1/payments/{payment_id}", dependencies=[Depends(authenticate)])
+async def get_payment(payment_id: str):
+    failure = await simulate_conditions()
+    if failure:
+        return failure
+    if payment_id not in payments:
+        return JSONResponse(status_code=400, content={
+            "error": {"code": "BAD_REQUEST_ERROR", "description": "The id provided does not exist"}
+        })
+    return payments[payment_id]
+
+async def send_webhook(event_type: str, payment: dict, order: dict):
+    body = json.dumps({
+        "entity": "event",
+        "account_id": "acc_fake",
+        "event": event_type,
+        "contains": ["payment", "order"],
+        "payload": {"payment": {"entity": payment}, "order": {"entity": order}},
+        "created_at": int(time.time())
+    }).encode()
+    signature = hmac.new(state['webhook_secret'].encode(), body, hashlib.sha256).hexdigest()
+    async with httpx.AsyncClient() as client:
+        await client.post(state['webhook_url'], content=body, headers={
+            "Content-Type": "application/json",
+            "X-Razorpay-Signature": signature,
+            "X-Razorpay-Event-Id": new_id("evt")
+        })
+
+@app.post("/_fake/orders/{order_id}/pay")
+async def pay_order(order_id: str, fail: bool = False):
+    """Capture a payment for an order and return what Checkout would hand the client"""
+    order = orders.get(order_id)
+    if not order:
+        raise HTTPException(status_code=404, detail="Unknown order")
+    
+    payment = {
+        "id": new_id("pay"),
+        "entity": "payment",
+        "amount": order['amount'],
+        "currency": order['currency'],
+        "status": "failed" if fail else "captured",
+        "order_id": order_id,
+        "method": "upi",
+        "captured": not fail,
+        "created_at": int(time.time())
+    }
+    payments[payment['id']] = payment
+    order['attempts'] += 1
+    if not fail:
+        order.update(status="paid", amount_paid=order['amount'], amount_due=0)
+    
+    if state['webhook_url']:
+        events = ["payment.failed"] if fail else ["payment.captured", "order.paid"]
+        for event_type in events:
+            await send_webhook(event_type, payment, order)
+    
+    signature = hmac.new(state['key_secret'].encode(), f"{order_id}|{payment['id']}".encode(), hashlib.sha256).hexdigest()
+    return {
+        "razorpay_order_id": order_id,
+        "razorpay_payment_id": payment['id'],
+        "razorpay_signature": signature
+    }
+
+@app.post("/_fake/faults")
+async def set_faults(latency_ms: Optional[int] = None, error_rate: Optional[float] = None):
+    if latency_ms is not None:
+        state['latency_ms'] = latency_ms
+    if error_rate is not None:
+        state['error_rate'] = error_rate
+    return {"latency_ms": state['latency_ms'], "error_rate": state['error_rate']}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--key-id', default=state['key_id'])
+    parser.add_argument('--key-secret', default=state['key_secret'])
+    parser.add_argument('--latency-ms', type=int, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--webhook-url', help="backend /api/payments/webhook URL to notify on payments")
+    parser.add_argument('--webhook-secret', default=state['webhook_secret'])
+    args = parser.parse_args()
+    
+    state.update(
+        key_id=args.key_id,
+        key_secret=args.key_secret,
+        latency_ms=args.latency_ms,
+        error_rate=args.error_rate,
+        webhook_url=args.webhook_url,
+        webhook_secret=args.webhook_secret
+    )
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+if __name__ == '__main__':
+    main()
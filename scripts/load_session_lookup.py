@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Session lookup load test
+Simulates months of sign-ins against a local mongod and measures
+get_current_user-style session lookups as the sessions collection ages.
+Each simulated month inserts that month's sessions (7-day expiry), runs
+the expired-record purge the app performs, and times lookups of live
+tokens. Latency should stay flat because expired sessions are removed at
+the storage layer instead of accumulating.
+
+Usage: python scripts/load_session_lookup.py [--months 6] [--signins-per-day 5000] [--lookups 2000] [--no-purge]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--months', type=int, default=6)
+    parser.add_argument('--signins-per-day', type=int, default=5000)
+    parser.add_argument('--lookups', type=int, default=2000)
+    parser.add_argument('--no-purge', action='store_true', help="keep expired sessions to show the unbounded baseline")
+    parser.add_argument('--mongo-url', default=os.environ.get('MONGO_URL', 'mongodb://localhost:27017'))
+    return parser.parse_args()
+
+args = parse_args()
+os.environ['MONGO_URL'] = args.mongo_url
+os.environ['DB_NAME'] = 'healer_load_sessions'
+
+import server  # noqa: E402
+from server import db  # noqa: E402
+
+async def main():
+    rng = random.Random(7)
+    await server.client.drop_database('healer_load_sessions')
+    await db.sessions.create_index("session_token", unique=True)
+    
+    # Start the simulated clock far enough back that the last month ends today
+    clock = datetime.now(timezone.utc) - timedelta(days=30 * args.months)
+    print(f"{'month':>5} {'stored':>9} {'live':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    
+    for month in range(1, args.months + 1):
+        batch = []
+        for day in range(30):
+            for _ in range(args.signins_per_day):
+                created = clock + timedelta(days=day, seconds=rng.randrange(86400))
+                batch.append({
+                    "id": str(uuid.uuid4()),
+                    "user_id": str(uuid.uuid4()),
+                    "session_token": uuid.uuid4().hex,
+                    "created_at": created,
+                    "expires_at": created + timedelta(days=7)
+                })
+        for i in range(0, len(batch), 10000):
+            await db.sessions.insert_many(batch[i:i + 10000], ordered=False)
+        clock += timedelta(days=30)
+        
+        # Sessions inserted with past timestamps are expired relative to the real clock;
+        # the app's purge runs against the simulated clock instead
+        if not args.no_purge:
+            await server.purge_expired_records(now=clock)
+        
+        live_tokens = [s['session_token'] for s in batch if s['expires_at'] > clock]
+        latencies = []
+        for token in rng.sample(live_tokens, min(args.lookups, len(live_tokens))):
+            t0 = time.perf_counter()
+            await db.sessions.find_one({"session_token": token})
+            latencies.append((time.perf_counter() - t0) * 1000)
+        latencies.sort()
+        
+        stored = await db.sessions.estimated_document_count()
+        print(f"{month:>5} {stored:>9} {len(live_tokens):>8} "
+              f"{latencies[len(latencies) // 2]:>8.3f} {latencies[int(len(latencies) * 0.99)]:>8.3f}")
+    
+    await server.client.drop_database('healer_load_sessions')
+
+if __name__ == '__main__':
+    asyncio.run(main())
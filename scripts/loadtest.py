@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+"""
+Healer load test
+Seeds a scratch database on a local mongod, boots the API under uvicorn and
+drives a weighted mix of the hot customer, pharmacy and driver flows from
+concurrent virtual users:
+
+  search    GET  /api/medicines/search          (anonymous customer search)
+  order     POST /api/orders                    (customer places a COD order)
+  status    PUT  /api/orders/{id}/status        (pharmacy accepts / prepares)
+  location  PUT  /api/drivers/location          (driver GPS ping)
+  login     POST /api/auth/login                (bcrypt password check)
+
+Reports requests, errors, RPS and p50/p95/p99 latency per scenario. Results
+can be saved as a JSON baseline and compared against an earlier one; the
+comparison exits non-zero when a scenario's p95 or RPS regresses by more
+than --tolerance percent.
+
+The load generator is a single asyncio process. With several uvicorn
+workers watch its CPU; if it is saturated the numbers measure the client.
+--in-process drives the ASGI app directly (no uvicorn, no sockets), which
+is handy for profiling but shares one event loop between client and app.
+
+Usage: python scripts/loadtest.py [--duration 30] [--concurrency 32] [--workers 1]
+                                  [--mix search=40,order=10,status=15,location=30,login=5]
+                                  [--save baselines/main.json] [--compare baselines/main.json]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import httpx
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR / 'backend'))
+
+DEFAULT_MIX = "search=40,order=10,status=15,location=30,login=5"
+PASSWORD = "LoadTest@123"
+
+# One or two real cities per state in STATE_DELIVERY_RATES
+CITIES = {
+    "Delhi": [("New Delhi", 28.6139, 77.2090)],
+    "Maharashtra": [("Mumbai", 19.0760, 72.8777), ("Pune", 18.5204, 73.8567)],
+    "Karnataka": [("Bengaluru", 12.9716, 77.5946)],
+    "Tamil Nadu": [("Chennai", 13.0827, 80.2707)],
+    "Uttar Pradesh": [("Lucknow", 26.8467, 80.9462)],
+    "Gujarat": [("Ahmedabad", 23.0225, 72.5714)],
+    "West Bengal": [("Kolkata", 22.5726, 88.3639)],
+    "Rajasthan": [("Jaipur", 26.9124, 75.7873)],
+}
+
+MEDICINES = [
+    "Paracetamol", "Ibuprofen", "Amoxicillin", "Cetirizine", "Azithromycin", "Metformin",
+    "Omeprazole", "Pantoprazole", "Atorvastatin", "Amlodipine", "Losartan", "Montelukast",
+    "Levocetirizine", "Diclofenac", "Dolo", "Crocin", "Vitamin C", "Vitamin D3", "ORS", "Cough Syrup",
+]
+STRENGTHS = ["100mg", "250mg", "500mg", "650mg"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=30, help="measured seconds")
+    parser.add_argument('--warmup', type=float, default=5, help="unmeasured seconds before the run")
+    parser.add_argument('--concurrency', type=int, default=32, help="virtual users")
+    parser.add_argument('--workers', type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="scenario weights")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--pharmacies', type=int, default=40)
+    parser.add_argument('--medicines-per-pharmacy', type=int, default=200)
+    parser.add_argument('--customers', type=int, default=500)
+    parser.add_argument('--drivers', type=int, default=100)
+    parser.add_argument('--pending-orders', type=int, default=5000, help="seeded orders for the status scenario")
+    parser.add_argument('--in-process', action='store_true', help="drive the ASGI app directly instead of uvicorn")
+    parser.add_argument('--keep-data', action='store_true', help="leave the scratch database in place")
+    parser.add_argument('--save', type=Path, help="write results to this JSON baseline")
+    parser.add_argument('--compare', type=Path, help="compare results with this JSON baseline")
+    parser.add_argument('--tolerance', type=float, default=20.0, help="allowed regression in percent")
+    parser.add_argument('--mongo-url', default=os.environ.get('MONGO_URL', 'mongodb://localhost:27017'))
+    parser.add_argument('--db-name', default='healer_loadtest')
+    return parser.parse_args()
+
+args = parse_args()
+os.environ['MONGO_URL'] = args.mongo_url
+os.environ['DB_NAME'] = args.db_name
+
+import server  # noqa: E402
+from server import db  # noqa: E402
+
+# server configures INFO logging; one line per request would swamp the report
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise SystemExit(f"unknown scenario {name!r}; choose from {', '.join(SCENARIOS)}")
+        weights[name] = float(weight)
+    return weights
+
+def near(rng: random.Random, lat: float, lng: float, km: float) -> tuple:
+    """Uniform-ish point within km of (lat, lng)"""
+    offset = km / 111.0
+    return lat + rng.uniform(-offset, offset), lng + rng.uniform(-offset, offset)
+
+# ==================== SEEDING ====================
+
+async def seed(rng: random.Random) -> dict:
+    """Create users, pharmacies, medicines, drivers and pending orders; return what the scenarios need"""
+    await server.client.drop_database(args.db_name)
+    password_hash = server.pwd_context.hash(PASSWORD)
+    places = [(state, *city) for state, cities in CITIES.items() for city in cities]
+    
+    users, pharmacies, medicines, drivers = [], [], [], []
+    fixtures = {"pharmacies": [], "customers": [], "drivers": []}
+    
+    for index in range(args.pharmacies):
+        state, city, lat, lng = places[index % len(places)]
+        owner = server.User(email=f"pharmacy{index}@loadtest.healer", name=f"Pharmacy Owner {index}", phone="+910000000000", role="pharmacy")
+        lat, lng = near(rng, lat, lng, 8)
+        pharmacy = server.Pharmacy(
+            owner_id=owner.id, business_name=f"{city} Pharmacy {index}",
+            location=server.Location(lat=lat, lng=lng, address=f"{index} Main Road, {city}, {state}"),
+            contact_phone="+910000000000", operating_hours="08:00-22:00", license_number=f"LT-{index:05d}"
+        )
+        stock = []
+        for _ in range(args.medicines_per_pharmacy):
+            medicine = server.Medicine(
+                pharmacy_id=pharmacy.id,
+                name=f"{rng.choice(MEDICINES)} {rng.choice(STRENGTHS)}",
+                price=round(rng.uniform(10, 500), 2),
+                stock_quantity=rng.randint(1, 500),
+                category="general"
+            )
+            medicines.append(server.to_document(medicine))
+            stock.append((medicine.id, medicine.name, medicine.price))
+        users.append(owner)
+        pharmacies.append(server.to_document(pharmacy))
+        fixtures["pharmacies"].append({
+            "id": pharmacy.id, "lat": lat, "lng": lng, "stock": stock,
+            "token": server.create_jwt_token(owner.id, owner.role, {"pharmacy_id": pharmacy.id})
+        })
+    
+    for index in range(args.customers):
+        customer = server.User(email=f"customer{index}@loadtest.healer", name=f"Customer {index}", phone="+919999999999", role="customer")
+        users.append(customer)
+        fixtures["customers"].append({"email": customer.email, "token": server.create_jwt_token(customer.id, customer.role)})
+    
+    for index in range(args.drivers):
+        state, city, lat, lng = places[index % len(places)]
+        user = server.User(email=f"driver{index}@loadtest.healer", name=f"Driver {index}", phone="+918888888888", role="driver")
+        lat, lng = near(rng, lat, lng, 8)
+        driver = server.Driver(
+            user_id=user.id, vehicle_type="bike", license_number=f"DL-{index:05d}", vehicle_number=f"LT {index:04d}",
+            address=f"{city}", city=city, state=state, aadhaar_number=f"{index:012d}",
+            current_location=server.Location(lat=lat, lng=lng, address=city), is_verified=True
+        )
+        users.append(user)
+        drivers.append(server.to_document(driver))
+        fixtures["drivers"].append({
+            "lat": lat, "lng": lng,
+            "token": server.create_jwt_token(user.id, user.role, {"driver_id": driver.id, "driver_state": state})
+        })
+    
+    # Pending orders spread over the last week so the status scenario starts with a backlog
+    orders = []
+    now = datetime.now(timezone.utc)
+    customer_ids = [user.id for user in users if user.role == "customer"]
+    for _ in range(args.pending_orders):
+        pharmacy_index = rng.randrange(len(fixtures["pharmacies"]))
+        order = build_order(rng, fixtures["pharmacies"][pharmacy_index])
+        document = server.to_document(server.Order(customer_id=rng.choice(customer_ids), **order))
+        document['created_at'] = now - timedelta(seconds=rng.randrange(7 * 24 * 3600))
+        document['pickup_location'] = server.geo_point(fixtures["pharmacies"][pharmacy_index]['lat'], fixtures["pharmacies"][pharmacy_index]['lng'])
+        orders.append(document)
+        status_queue.append((document['id'], pharmacy_index, server.OrderStatus.ACCEPTED))
+    
+    user_documents = []
+    for user in users:
+        document = server.to_document(user)
+        document['password_hash'] = password_hash
+        user_documents.append(document)
+    
+    for collection, documents in (
+        (db.users, user_documents), (db.pharmacies, pharmacies), (db.medicines, medicines),
+        (db.drivers, drivers), (db.orders, orders),
+    ):
+        for i in range(0, len(documents), 10000):
+            await collection.insert_many(documents[i:i + 10000], ordered=False)
+    # Indexes are left to the app's startup so the run measures what production has
+    
+    print(f"seeded {len(user_documents)} users, {len(pharmacies)} pharmacies, {len(medicines)} medicines, "
+          f"{len(drivers)} drivers, {len(orders)} pending orders")
+    return fixtures
+
+def build_order(rng: random.Random, pharmacy: dict) -> dict:
+    """OrderCreate-shaped body for 1-3 items from one pharmacy, delivered within COD range"""
+    items = [
+        {"medicine_id": medicine_id, "medicine_name": name, "quantity": rng.randint(1, 3), "price": price}
+        for medicine_id, name, price in rng.sample(pharmacy['stock'], min(len(pharmacy['stock']), rng.randint(1, 3)))
+    ]
+    lat, lng = near(rng, pharmacy['lat'], pharmacy['lng'], 4)
+    return {
+        "pharmacy_id": pharmacy['id'],
+        "items": items,
+        "delivery_address": {"lat": lat, "lng": lng, "address": "Load test address"},
+        "payment_method": server.PaymentMethod.CASH_ON_DELIVERY,
+        "phone": "+919999999999",
+    }
+
+# ==================== SCENARIOS ====================
+
+# (order id, pharmacy index, next status); orders placed during the run join the back of the queue
+status_queue: deque = deque()
+NEXT_STATUS = {server.OrderStatus.ACCEPTED: server.OrderStatus.PREPARING}
+
+def auth(token: str) -> dict:
+    return {"Authorization": f"Bearer {token}"}
+
+async def scenario_search(http: httpx.AsyncClient, rng: random.Random, fixtures: dict):
+    pharmacy = rng.choice(fixtures["pharmacies"])
+    lat, lng = near(rng, pharmacy['lat'], pharmacy['lng'], 5)
+    term = rng.choice(MEDICINES).split()[0][:rng.randint(3, 6)].lower()
+    return await http.get("/api/medicines/search", params={"q": term, "lat": lat, "lng": lng})
+
+async def scenario_order(http: httpx.AsyncClient, rng: random.Random, fixtures: dict):
+    pharmacy_index = rng.randrange(len(fixtures["pharmacies"]))
+    customer = rng.choice(fixtures["customers"])
+    response = await http.post("/api/orders", json=build_order(rng, fixtures["pharmacies"][pharmacy_index]), headers=auth(customer['token']))
+    if response.status_code == 200:
+        status_queue.append((response.json()['id'], pharmacy_index, server.OrderStatus.ACCEPTED))
+    return response
+
+async def scenario_status(http: httpx.AsyncClient, rng: random.Random, fixtures: dict):
+    if not status_queue:
+        return None
+    order_id, pharmacy_index, status = status_queue.popleft()
+    pharmacy = fixtures["pharmacies"][pharmacy_index]
+    response = await http.put(f"/api/orders/{order_id}/status", params={"status": status}, headers=auth(pharmacy['token']))
+    if response.status_code == 200 and status in NEXT_STATUS:
+        status_queue.append((order_id, pharmacy_index, NEXT_STATUS[status]))
+    return response
+
+async def scenario_location(http: httpx.AsyncClient, rng: random.Random, fixtures: dict):
+    driver = rng.choice(fixtures["drivers"])
+    driver['lat'], driver['lng'] = near(rng, driver['lat'], driver['lng'], 0.2)
+    return await http.put("/api/drivers/location", json={"lat": driver['lat'], "lng": driver['lng'], "address": "en route"}, headers=auth(driver['token']))
+
+async def scenario_login(http: httpx.AsyncClient, rng: random.Random, fixtures: dict):
+    customer = rng.choice(fixtures["customers"])
+    return await http.post("/api/auth/login", json={"email": customer['email'], "password": PASSWORD})
+
+SCENARIOS = {
+    "search": scenario_search,
+    "order": scenario_order,
+    "status": scenario_status,
+    "location": scenario_location,
+    "login": scenario_login,
+}
+
+# ==================== LOAD ====================
+
+class Results:
+    def __init__(self, names):
+        self.latencies = {name: [] for name in names}
+        self.errors = {name: 0 for name in names}
+        self.skipped = {name: 0 for name in names}
+        self.error_samples = {}
+
+async def virtual_user(http: httpx.AsyncClient, seed: int, fixtures: dict, weights: dict, deadline: float, results: Results):
+    rng = random.Random(seed)
+    names, cumulative = list(weights), list(weights.values())
+    while time.perf_counter() < deadline:
+        name = rng.choices(names, weights=cumulative)[0]
+        started = time.perf_counter()
+        try:
+            response = await SCENARIOS[name](http, rng, fixtures)
+        except httpx.HTTPError as e:
+            response, error = None, f"{type(e).__name__}: {e}"
+        else:
+            if response is None:
+                results.skipped[name] += 1
+                continue
+            error = None if response.status_code < 400 else f"HTTP {response.status_code}: {response.text[:200]}"
+        results.latencies[name].append(time.perf_counter() - started)
+        if error:
+            results.errors[name] += 1
+            results.error_samples.setdefault(name, error)
+
+async def run_load(http: httpx.AsyncClient, fixtures: dict, weights: dict, seconds: float, seed: int) -> Results:
+    results = Results(weights)
+    deadline = time.perf_counter() + seconds
+    await asyncio.gather(*[
+        virtual_user(http, seed * 1000 + index, fixtures, weights, deadline, results)
+        for index in range(args.concurrency)
+    ])
+    return results
+
+def percentile(sorted_values: list, p: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))] * 1000
+
+def summarize(results: Results, seconds: float) -> dict:
+    summary = {}
+    for name, latencies in results.latencies.items():
+        latencies.sort()
+        summary[name] = {
+            "requests": len(latencies),
+            "errors": results.errors[name],
+            "skipped": results.skipped[name],
+            "rps": round(len(latencies) / seconds, 2),
+            "p50_ms": round(percentile(latencies, 0.50), 2) if latencies else None,
+            "p95_ms": round(percentile(latencies, 0.95), 2) if latencies else None,
+            "p99_ms": round(percentile(latencies, 0.99), 2) if latencies else None,
+            "max_ms": round(latencies[-1] * 1000, 2) if latencies else None,
+        }
+    return summary
+
+def print_summary(summary: dict, results: Results):
+    print(f"\n{'scenario':10} {'requests':>9} {'errors':>7} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    fmt = lambda value: f"{value:9.2f}" if value is not None else f"{'-':>9}"  # noqa: E731
+    for name, row in summary.items():
+        print(f"{name:10} {row['requests']:>9} {row['errors']:>7} {row['rps']:>9.1f} "
+              f"{fmt(row['p50_ms'])} {fmt(row['p95_ms'])} {fmt(row['p99_ms'])} {fmt(row['max_ms'])}")
+    total = sum(row['rps'] for row in summary.values())
+    print(f"{'total':10} {sum(row['requests'] for row in summary.values()):>9} "
+          f"{sum(row['errors'] for row in summary.values()):>7} {total:>9.1f}")
+    for name, error in results.error_samples.items():
+        print(f"  first {name} error: {error}")
+
+def compare(summary: dict, baseline: dict) -> bool:
+    """Print per-scenario deltas against a baseline; True if nothing regressed beyond the tolerance"""
+    print(f"\ncompared with {args.compare} (commit {baseline.get('git_commit') or 'unknown'}, tolerance {args.tolerance:.0f}%)")
+    print(f"{'scenario':10} {'rps':>18} {'p95 ms':>20} {'p99 ms':>20}")
+    ok = True
+    for name, row in summary.items():
+        before = baseline['scenarios'].get(name)
+        if not before or not row['requests'] or not before['requests']:
+            continue
+        rps_delta = (row['rps'] / before['rps'] - 1) * 100
+        p95_delta = (row['p95_ms'] / before['p95_ms'] - 1) * 100
+        p99_delta = (row['p99_ms'] / before['p99_ms'] - 1) * 100
+        regressed = rps_delta < -args.tolerance or p95_delta > args.tolerance
+        ok = ok and not regressed
+        print(f"{name:10} {before['rps']:>8.1f} {rps_delta:+8.1f}% {before['p95_ms']:>10.2f} {p95_delta:+8.1f}% "
+              f"{before['p99_ms']:>10.2f} {p99_delta:+8.1f}%{'  REGRESSED' if regressed else ''}")
+    return ok
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def start_server() -> subprocess.Popen:
+    env = {**os.environ, "MONGO_URL": args.mongo_url, "DB_NAME": args.db_name}
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(args.port),
+         "--workers", str(args.workers), "--log-level", "warning", "--no-access-log"],
+        cwd=ROOT_DIR / 'backend', env=env
+    )
+
+async def wait_until_ready(http: httpx.AsyncClient, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"uvicorn exited with code {process.returncode}")
+        try:
+            if (await http.get("/api/health/notifications")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise SystemExit("server did not become ready")
+
+async def main():
+    weights = parse_mix(args.mix)
+    await server.client.admin.command("ping")
+    fixtures = await seed(random.Random(args.seed))
+    
+    process = None
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    if args.in_process:
+        await server.startup_db_client()
+        http = httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://loadtest", timeout=30)
+    else:
+        process = start_server()
+        http = httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", limits=limits, timeout=30)
+    
+    try:
+        if process:
+            await wait_until_ready(http, process)
+        print(f"{args.concurrency} virtual users, mix {args.mix}, {args.warmup:.0f}s warmup + {args.duration:.0f}s measured"
+              f"{' (in-process)' if args.in_process else f', {args.workers} uvicorn worker(s)'}")
+        if args.warmup > 0:
+            await run_load(http, fixtures, weights, args.warmup, args.seed + 1)
+        results = await run_load(http, fixtures, weights, args.duration, args.seed)
+    finally:
+        await http.aclose()
+        if process:
+            process.terminate()
+            process.wait(timeout=10)
+        else:
+            await server.shutdown_db_client()
+    
+    summary = summarize(results, args.duration)
+    print_summary(summary, results)
+    
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "config": {
+            key: getattr(args, key) for key in (
+                "duration", "concurrency", "workers", "mix", "seed", "pharmacies",
+                "medicines_per_pharmacy", "customers", "drivers", "pending_orders", "in_process",
+            )
+        },
+        "scenarios": summary,
+    }
+    ok = True
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        if baseline.get('config') != report['config']:
+            print("warning: baseline was recorded with a different configuration")
+        ok = compare(summary, baseline)
+    if args.save:
+        args.save.parent.mkdir(parents=True, exist_ok=True)
+        args.save.write_text(json.dumps(report, indent=2) + "\n")
+        print(f"\nsaved baseline to {args.save}")
+    
+    if not args.keep_data:
+        await server.client.drop_database(args.db_name)
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Healer data migrations
+Backfills fields that newer versions of the backend expect on existing data.
+Every migration is idempotent and safe to re-run.
+
+Usage: python scripts/migrate.py <migration> [<migration> ...]
+       python scripts/migrate.py --list
+"""
+
+import argparse
+import asyncio
+import base64
+import binascii
+import io
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'healer_db')
+
+from pymongo import UpdateOne  # noqa: E402
+
+import server  # noqa: E402
+from server import db  # noqa: E402
+
+BATCH_SIZE = 1000
+
+async def migrate_pickup_locations():
+    """Add GeoJSON pickup_location to orders for the available-orders geo index"""
+    pharmacies = await db.pharmacies.find({}, {"_id": 0, "id": 1, "location": 1}).to_list(None)
+    modified = 0
+    for pharmacy in pharmacies:
+        result = await db.orders.update_many(
+            {"pharmacy_id": pharmacy['id'], "pickup_location": {"$exists": False}},
+            {"$set": {"pickup_location": server.geo_point(pharmacy['location']['lat'], pharmacy['location']['lng'])}}
+        )
+        modified += result.modified_count
+    print(f"   orders updated: {modified}")
+
+async def remove_duplicates(collection, field: str, projection: dict = None, keep_first: dict = None) -> list:
+    """Delete all but one document per value of field; returns the deleted documents.
+    
+    The document kept is the first in keep_first order (default: the oldest).
+    """
+    removed = []
+    cursor = collection.aggregate([
+        {"$sort": keep_first or {"_id": 1}},
+        {"$group": {"_id": f"${field}", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+    async for group in cursor:
+        extra = group['ids'][1:]
+        removed += await collection.find({"_id": {"$in": extra}}, projection or {"_id": 1}).to_list(None)
+        await collection.delete_many({"_id": {"$in": extra}})
+    return removed
+
+async def migrate_dedupe_earnings():
+    """Remove duplicate driver_earnings per order (double-completed deliveries) and fix driver totals"""
+    removed = await remove_duplicates(db.driver_earnings, "order_id", {"_id": 1, "driver_id": 1})
+    driver_ids = list({earning['driver_id'] for earning in removed})
+    
+    # The duplicate completions also incremented the totals twice
+    totals = db.driver_earnings.aggregate([
+        {"$match": {"driver_id": {"$in": driver_ids}}},
+        {"$group": {"_id": "$driver_id", "amount": {"$sum": "$amount"}, "deliveries": {"$sum": 1}}}
+    ])
+    operations = [
+        UpdateOne(
+            {"id": total['_id']},
+            {"$set": {"total_earnings": round(total['amount'], 2), "total_deliveries": total['deliveries']}}
+        )
+        async for total in totals
+    ]
+    if operations:
+        await db.drivers.bulk_write(operations, ordered=False)
+    print(f"   duplicate earnings removed: {len(removed)}, drivers corrected: {len(operations)}")
+    
+    if removed:
+        # A duplicate may be the only row in a bucket, so those drivers' buckets are rebuilt from scratch
+        await db.driver_earnings_rollups.delete_many({"driver_id": {"$in": driver_ids}})
+        await migrate_earnings_rollups()
+
+async def migrate_earnings_rollups():
+    """Rebuild driver day/week/month earnings buckets from driver_earnings"""
+    totals = {}
+    async for earning in db.driver_earnings.find({}, {"_id": 0, "driver_id": 1, "amount": 1, "distance_km": 1, "created_at": 1}):
+        created_at = server.as_utc(earning['created_at'])
+        for period in server.EARNINGS_PERIODS:
+            key = (earning['driver_id'], period, server.earnings_bucket_start(created_at, period))
+            bucket = totals.setdefault(key, {"amount": 0.0, "deliveries": 0, "distance_km": 0.0})
+            bucket['amount'] += earning['amount']
+            bucket['deliveries'] += 1
+            bucket['distance_km'] += earning.get('distance_km', 0.0)
+    
+    operations = [
+        UpdateOne(
+            {"driver_id": driver_id, "period": period, "start": start},
+            {"$set": {
+                **bucket,
+                "bucket": server.earnings_bucket_label(start, period),
+                "updated_at": datetime.now(timezone.utc)
+            }},
+            upsert=True
+        )
+        for (driver_id, period, start), bucket in totals.items()
+    ]
+    for i in range(0, len(operations), BATCH_SIZE):
+        await db.driver_earnings_rollups.bulk_write(operations[i:i + BATCH_SIZE], ordered=False)
+    print(f"   buckets written: {len(operations)}")
+
+async def migrate_driver_ratings():
+    """Initialise driver rating_sum/rating_count from existing reviews"""
+    modified = await server.recompute_driver_ratings()
+    print(f"   drivers updated: {modified}")
+
+async def migrate_dedupe_reviews():
+    """Remove repeat reviews of the same order and rebuild driver ratings from the rest"""
+    removed = await remove_duplicates(db.driver_reviews, "order_id")
+    print(f"   duplicate reviews removed: {len(removed)}")
+    if removed:
+        await migrate_driver_ratings()
+
+async def migrate_dedupe_sessions():
+    """Remove duplicate session tokens, keeping the copy that expires last"""
+    removed = await remove_duplicates(db.sessions, "session_token", keep_first={"expires_at": -1, "_id": -1})
+    print(f"   duplicate sessions removed: {len(removed)}")
+
+# Fields that older versions stored as ISO strings
+DATETIME_FIELDS = {
+    "users": ["created_at", "healer_pro_expires_at"],
+    "sessions": ["created_at", "expires_at"],
+    "pharmacies": ["created_at"],
+    "medicines": ["created_at"],
+    "orders": ["created_at", "updated_at"],
+    "drivers": ["created_at"],
+    "driver_earnings": ["created_at"],
+    "driver_reviews": ["created_at"],
+    "saved_addresses": ["created_at"],
+    "saved_payment_methods": ["created_at"],
+    "verification_codes": ["created_at", "expires_at", "last_resent_at"],
+    "password_resets": ["created_at", "expires_at"],
+    "trips": ["created_at", "updated_at"],
+}
+
+async def migrate_datetimes():
+    """Convert ISO-string timestamps to native BSON dates"""
+    for collection_name, fields in DATETIME_FIELDS.items():
+        collection = db[collection_name]
+        operations, modified = [], 0
+        cursor = collection.find(
+            {"$or": [{field: {"$type": "string"}} for field in fields]},
+            {field: 1 for field in fields}
+        )
+        async for document in cursor:
+            converted = {
+                field: server.as_utc(document[field])
+                for field in fields
+                if isinstance(document.get(field), str)
+            }
+            operations.append(UpdateOne({"_id": document['_id']}, {"$set": converted}))
+            if len(operations) >= BATCH_SIZE:
+                modified += (await collection.bulk_write(operations, ordered=False)).modified_count
+                operations = []
+        if operations:
+            modified += (await collection.bulk_write(operations, ordered=False)).modified_count
+        print(f"   {collection_name}: {modified}")
+
+async def migrate_profile_pictures():
+    """Move base64 data-URL profile pictures into the media store"""
+    moved, skipped = 0, 0
+    async for user in db.users.find({"profile_pic": {"$regex": "^data:"}}, {"_id": 0, "id": 1, "profile_pic": 1}):
+        _, _, encoded = user['profile_pic'].partition(',')
+        try:
+            content = base64.b64decode(encoded, validate=True)
+        except binascii.Error:
+            content = None
+        # The data URL's declared type is not trusted; the bytes decide
+        content_type = server.sniff_image_type(content[:16]) if content else None
+        if content_type is None:
+            skipped += 1
+            continue
+        
+        blob = await server.store_blob(io.BytesIO(content), content_type)
+        await db.users.update_one(
+            {"id": user['id'], "profile_pic": user['profile_pic']},
+            {"$set": {"profile_pic": blob['url']}}
+        )
+        moved += 1
+    print(f"   pictures moved: {moved}, skipped (unsupported or corrupt): {skipped}")
+
+MIGRATIONS = {
+    "pickup-locations": migrate_pickup_locations,
+    "dedupe-earnings": migrate_dedupe_earnings,
+    "earnings-rollups": migrate_earnings_rollups,
+    "driver-ratings": migrate_driver_ratings,
+    "dedupe-reviews": migrate_dedupe_reviews,
+    "dedupe-sessions": migrate_dedupe_sessions,
+    "datetimes": migrate_datetimes,
+    "profile-pictures": migrate_profile_pictures,
+}
+
+async def run(names: list):
+    for name in names:
+        print(f"🔄 {name}: {MIGRATIONS[name].__doc__}")
+        await MIGRATIONS[name]()
+        print(f"✅ {name} done")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('migrations', nargs='*', metavar='migration')
+    parser.add_argument('--list', action='store_true', help="list available migrations")
+    args = parser.parse_args()
+    
+    if args.list or not args.migrations:
+        for name, fn in MIGRATIONS.items():
+            print(f"{name:20} {fn.__doc__}")
+        return
+    
+    unknown = [name for name in args.migrations if name not in MIGRATIONS]
+    if unknown:
+        parser.error(f"unknown migration(s): {', '.join(unknown)}")
+    
+    asyncio.run(run(args.migrations))
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,35 @@
 #!/bin/bash
 # Healer Database Reset Script
 # Run this to clear all data and start fresh
+#
+# Usage: scripts/reset_database.sh [--seed [scale]]
+#   --seed [scale]  refill the database with synthetic data afterwards
+#                   (scripts/seed_database.py, default scale 0.01)
+# DB_NAME and MONGO_URL select the database (default healer_db on localhost).
+
+DB_NAME="${DB_NAME:-healer_db}"
+MONGO_URL="${MONGO_URL:-mongodb://localhost:27017}"
+SEED_SCALE=""
+
+if [ "$1" == "--seed" ]; then
+    SEED_SCALE="${2:-0.01}"
+fi
 
 echo "========================================="
 echo "  Healer Database Reset Tool"
 echo "========================================="
 echo ""
-echo "⚠️  WARNING: This will delete ALL data!"
+echo "⚠️  WARNING: This will delete ALL data in $DB_NAME!"
 echo "   - All user accounts"
 echo "   - All pharmacies"
 echo "   - All medicines"
 echo "   - All orders"
 echo "   - All drivers"
 echo "   - Everything!"
+if [ -n "$SEED_SCALE" ]; then
+    echo ""
+    echo "   It will then be seeded with synthetic data (scale $SEED_SCALE)."
+fi
 echo ""
 read -p "Are you sure you want to continue? (type 'yes' to confirm): " confirmation
 
@@ -24,18 +41,17 @@ fi
 echo ""
 echo "🔄 Resetting database..."
 
-mongosh --quiet healer_db --eval "
-db.users.deleteMany({});
-db.pharmacies.deleteMany({});
-db.medicines.deleteMany({});
-db.orders.deleteMany({});
-db.drivers.deleteMany({});
-db.driver_earnings.deleteMany({});
-db.driver_reviews.deleteMany({});
-db.password_resets.deleteMany({});
-db.saved_addresses.deleteMany({});
-db.saved_payment_methods.deleteMany({});
-db.sessions.deleteMany({});
+# Every collection is emptied, including ones added after this script was written.
+# Time-series collections (driver GPS pings) are dropped instead; the backend
+# recreates them on startup. Uploaded media files on disk are left in place.
+mongosh --quiet "$MONGO_URL/$DB_NAME" --eval "
+db.getCollectionInfos({ name: { \$not: /^system\\./ } }).forEach(function (info) {
+    if (info.type === 'timeseries') {
+        db.getCollection(info.name).drop();
+    } else if (info.type === 'collection') {
+        db.getCollection(info.name).deleteMany({});
+    }
+});
 
 var usersCount = db.users.countDocuments();
 var pharmaciesCount = db.pharmacies.countDocuments();
@@ -52,7 +68,13 @@ print('   Medicines: ' + medicinesCount);
 print('   Orders: ' + ordersCount);
 print('');
 print('✨ You can now register with any email again!');
-"
+" || exit 1
+
+if [ -n "$SEED_SCALE" ]; then
+    echo ""
+    echo "🌱 Seeding synthetic data..."
+    MONGO_URL="$MONGO_URL" DB_NAME="$DB_NAME" python "$(dirname "$0")/seed_database.py" --drop --scale "$SEED_SCALE" || exit 1
+fi
 
 echo ""
 echo "========================================="
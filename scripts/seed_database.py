@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""
+Healer synthetic data seeder
+Bulk-generates a realistic dataset for index and scaling work:
+
+  - pharmacies clustered around cities in every STATE_DELIVERY_RATES state,
+    each with a catalogue of medicine listings (millions at full scale)
+  - customers, pharmacy owners and drivers (one shared password)
+  - orders spread over --days of history; older orders are delivered or
+    cancelled, recent ones are still moving through the status pipeline
+  - driver earnings for every delivery, reviews for a share of them, and the
+    derived driver totals, ratings, rollups and customer reward points
+
+Documents are written with unordered insert_many batches from --writers
+concurrent writers; the app's indexes are built afterwards. The same --seed
+and --anchor always produce the same data (ids included).
+
+Full scale (--scale 1): 2k pharmacies, 2M medicines, 100k customers,
+5k drivers, 1M orders. --scale 0.01 gives a laptop-sized dataset in seconds
+(20 pharmacies with the full 1k listings each).
+
+Usage: python scripts/seed_database.py [--scale 1.0] [--seed 42] [--drop]
+                                       [--db-name healer_db] [--writers 8] [--batch-size 5000]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from math import cos, radians
+from pathlib import Path
+from typing import Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=float, default=1.0, help="multiplier for every count below but --medicines-per-pharmacy (listings scale with --pharmacies)")
+    parser.add_argument('--pharmacies', type=int, default=2000)
+    parser.add_argument('--medicines-per-pharmacy', type=int, default=1000)
+    parser.add_argument('--customers', type=int, default=100_000)
+    parser.add_argument('--drivers', type=int, default=5000)
+    parser.add_argument('--orders', type=int, default=1_000_000)
+    parser.add_argument('--days', type=int, default=180, help="order history span")
+    parser.add_argument('--review-rate', type=float, default=0.4, help="share of deliveries that get a review")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--anchor', help="ISO date the history ends at (default: today, UTC)")
+    parser.add_argument('--password', default="Healer@123", help="password for every seeded account")
+    parser.add_argument('--writers', type=int, default=8, help="concurrent insert_many calls")
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--drop', action='store_true', help="drop the database first")
+    parser.add_argument('--mongo-url', default=os.environ.get('MONGO_URL', 'mongodb://localhost:27017'))
+    parser.add_argument('--db-name', default=os.environ.get('DB_NAME', 'healer_db'))
+    return parser.parse_args()
+
+args = parse_args()
+os.environ['MONGO_URL'] = args.mongo_url
+os.environ['DB_NAME'] = args.db_name
+
+import server  # noqa: E402
+from server import db, OrderStatus, PaymentMethod  # noqa: E402
+import migrate  # noqa: E402
+
+# Cities per state with a rough population weight; pharmacies cluster around them
+CITIES = {
+    "Delhi": [("New Delhi", 28.6139, 77.2090, 10), ("Dwarka", 28.5921, 77.0460, 3), ("Rohini", 28.7383, 77.0822, 3)],
+    "Maharashtra": [("Mumbai", 19.0760, 72.8777, 10), ("Pune", 18.5204, 73.8567, 6), ("Nagpur", 21.1458, 79.0882, 3)],
+    "Karnataka": [("Bengaluru", 12.9716, 77.5946, 10), ("Mysuru", 12.2958, 76.6394, 2), ("Mangaluru", 12.9141, 74.8560, 2)],
+    "Tamil Nadu": [("Chennai", 13.0827, 80.2707, 8), ("Coimbatore", 11.0168, 76.9558, 3), ("Madurai", 9.9252, 78.1198, 2)],
+    "Uttar Pradesh": [("Lucknow", 26.8467, 80.9462, 5), ("Kanpur", 26.4499, 80.3319, 4), ("Noida", 28.5355, 77.3910, 4)],
+    "Gujarat": [("Ahmedabad", 23.0225, 72.5714, 7), ("Surat", 21.1702, 72.8311, 5), ("Vadodara", 22.3072, 73.1812, 3)],
+    "West Bengal": [("Kolkata", 22.5726, 88.3639, 9), ("Howrah", 22.5958, 88.2636, 3), ("Siliguri", 26.7271, 88.3953, 1)],
+    "Rajasthan": [("Jaipur", 26.9124, 75.7873, 6), ("Jodhpur", 26.2389, 73.0243, 2), ("Udaipur", 24.5854, 73.7125, 2)],
+}
+
+MEDICINE_NAMES = [
+    ("Paracetamol", "pain relief"), ("Ibuprofen", "pain relief"), ("Diclofenac", "pain relief"), ("Aspirin", "pain relief"),
+    ("Amoxicillin", "antibiotic"), ("Azithromycin", "antibiotic"), ("Ciprofloxacin", "antibiotic"), ("Doxycycline", "antibiotic"),
+    ("Cetirizine", "allergy"), ("Levocetirizine", "allergy"), ("Montelukast", "allergy"), ("Fexofenadine", "allergy"),
+    ("Metformin", "diabetes"), ("Glimepiride", "diabetes"), ("Sitagliptin", "diabetes"), ("Insulin Glargine", "diabetes"),
+    ("Amlodipine", "cardiac"), ("Atorvastatin", "cardiac"), ("Losartan", "cardiac"), ("Telmisartan", "cardiac"),
+    ("Omeprazole", "digestive"), ("Pantoprazole", "digestive"), ("Ondansetron", "digestive"), ("ORS", "digestive"),
+    ("Vitamin C", "supplement"), ("Vitamin D3", "supplement"), ("Calcium", "supplement"), ("Zinc", "supplement"),
+    ("Cough Syrup", "cold and flu"), ("Dolo", "cold and flu"), ("Crocin", "cold and flu"), ("Vicks", "cold and flu"),
+]
+PRESCRIPTION_CATEGORIES = {"antibiotic", "diabetes", "cardiac"}
+FORMS = ["Tablet", "Capsule", "Syrup", "Strip", "Gel"]
+STRENGTHS = ["5mg", "10mg", "50mg", "100mg", "250mg", "500mg", "650mg"]
+BRANDS = ["Cipla", "Sun", "Lupin", "Mankind", "Alkem", "Zydus", "Abbott", "Torrent", "Glenmark", "Generic"]
+
+ORDER_REFERENCE_MEDICINES = 50  # catalogue entries per pharmacy that orders draw from
+ACTIVE_PIPELINE_MINUTES = 120  # orders younger than this may still be in progress
+# (minutes after placement, status reached)
+STATUS_TIMELINE = [
+    (0, OrderStatus.PENDING),
+    (8, OrderStatus.ACCEPTED),
+    (15, OrderStatus.PREPARING),
+    (30, OrderStatus.PICKED_UP),
+    (38, OrderStatus.IN_TRANSIT),
+]
+RATING_WEIGHTS = [3, 4, 10, 33, 50]  # 1..5 stars
+
+def scaled(count: int) -> int:
+    return max(1, int(count * args.scale))
+
+def new_id(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+def scatter(rng: random.Random, lat: float, lng: float, km: float) -> tuple:
+    """Gaussian scatter around a point, roughly km standard deviation"""
+    return (
+        lat + rng.gauss(0, km / 111.0),
+        lng + rng.gauss(0, km / (111.0 * cos(radians(lat))))
+    )
+
+class BulkInserter:
+    """Batches documents per collection and keeps a fixed number of unordered insert_many calls in flight.
+    
+    The first failed insert is re-raised from the next add() or from close().
+    """
+    
+    def __init__(self, writers: int, batch_size: int):
+        self.batch_size = batch_size
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=writers * 2)
+        self.pending = defaultdict(list)
+        self.inserted = defaultdict(int)
+        self.error: Optional[Exception] = None
+        self.tasks = [asyncio.create_task(self.writer()) for _ in range(writers)]
+    
+    async def add(self, collection: str, document: dict):
+        if self.error:
+            raise self.error
+        batch = self.pending[collection]
+        batch.append(document)
+        if len(batch) >= self.batch_size:
+            await self.queue.put((collection, batch))
+            self.pending[collection] = []
+            # Generation is CPU-bound; yield so writers can hand their batches to Motor
+            await asyncio.sleep(0)
+    
+    async def writer(self):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            if self.error:
+                continue  # keep draining so add() never blocks on a full queue
+            collection, documents = item
+            try:
+                await db[collection].insert_many(documents, ordered=False)
+            except Exception as e:
+                self.error = self.error or e
+                continue
+            self.inserted[collection] += len(documents)
+    
+    async def close(self):
+        for collection, batch in self.pending.items():
+            if batch and not self.error:
+                await self.queue.put((collection, batch))
+        self.pending.clear()
+        for _ in self.tasks:
+            await self.queue.put(None)
+        await asyncio.gather(*self.tasks)
+        if self.error:
+            raise self.error
+
+def build_places() -> list:
+    return [(state, name, lat, lng, weight) for state, cities in CITIES.items() for name, lat, lng, weight in cities]
+
+async def seed_pharmacies(rng: random.Random, inserter: BulkInserter, places: list, password_hash: str, anchor: datetime) -> list:
+    """Pharmacies (with owners) and their catalogues; returns what orders need per pharmacy"""
+    pharmacies = []
+    weights = [place[4] for place in places]
+    for index in range(scaled(args.pharmacies)):
+        state, city, city_lat, city_lng, _ = rng.choices(places, weights=weights)[0]
+        lat, lng = scatter(rng, city_lat, city_lng, 6)
+        created_at = anchor - timedelta(days=args.days + rng.randrange(365))
+        owner = server.User(
+            id=new_id(rng), email=f"pharmacy{index}@example.com", name=f"Pharmacy Owner {index}",
+            phone=f"+91{9000000000 + index}", role="pharmacy", email_verified=True, phone_verified=True,
+            created_at=created_at
+        )
+        pharmacy = server.Pharmacy(
+            id=new_id(rng), owner_id=owner.id, business_name=f"{rng.choice(BRANDS)} Health {city} {index}",
+            location=server.Location(lat=lat, lng=lng, address=f"{rng.randint(1, 500)} Market Road, {city}, {state}"),
+            contact_phone=owner.phone, operating_hours=rng.choice(["08:00-22:00", "09:00-21:00", "00:00-23:59"]),
+            license_number=f"{state[:2].upper()}-{index:06d}", is_active=rng.random() > 0.03,
+            rating=round(rng.uniform(3.2, 5.0), 1), created_at=created_at
+        )
+        owner_document = server.to_document(owner)
+        owner_document['password_hash'] = password_hash
+        await inserter.add("users", owner_document)
+        await inserter.add("pharmacies", server.to_document(pharmacy))
+        
+        references = []
+        for _ in range(args.medicines_per_pharmacy):
+            name, category = rng.choice(MEDICINE_NAMES)
+            medicine = server.Medicine(
+                id=new_id(rng), pharmacy_id=pharmacy.id,
+                name=f"{name} {rng.choice(STRENGTHS)} {rng.choice(FORMS)}",
+                description=f"{rng.choice(BRANDS)} {category}",
+                price=round(rng.lognormvariate(4.2, 0.8), 2),
+                stock_quantity=rng.choice([0, rng.randint(1, 50), rng.randint(50, 1000)]),
+                category=category, requires_prescription=category in PRESCRIPTION_CATEGORIES,
+                created_at=created_at + timedelta(days=rng.randrange(30))
+            )
+            await inserter.add("medicines", server.to_document(medicine))
+            if len(references) < ORDER_REFERENCE_MEDICINES:
+                references.append((medicine.id, medicine.name, medicine.price))
+        
+        pharmacies.append({"id": pharmacy.id, "state": state, "city": city, "lat": lat, "lng": lng, "medicines": references})
+    return pharmacies
+
+def generate_customers(rng: random.Random, places: list, anchor: datetime) -> list:
+    weights = [place[4] for place in places]
+    customers = []
+    for index in range(scaled(args.customers)):
+        state, city, city_lat, city_lng, _ = rng.choices(places, weights=weights)[0]
+        is_pro = rng.random() < 0.05
+        customers.append({
+            "user": server.User(
+                id=new_id(rng), email=f"customer{index}@example.com", name=f"Customer {index}",
+                phone=f"+91{8000000000 + index}", role="customer", is_healer_pro=is_pro,
+                healer_pro_expires_at=anchor + timedelta(days=rng.randint(1, 365)) if is_pro else None,
+                email_verified=rng.random() < 0.7, created_at=anchor - timedelta(days=rng.randrange(args.days + 365))
+            ),
+            "city": city,
+            "home": scatter(rng, city_lat, city_lng, 5),
+            "points": 0,
+        })
+    return customers
+
+def generate_drivers(rng: random.Random, places: list, anchor: datetime) -> list:
+    weights = [place[4] for place in places]
+    drivers = []
+    for index in range(scaled(args.drivers)):
+        state, city, city_lat, city_lng, _ = rng.choices(places, weights=weights)[0]
+        lat, lng = scatter(rng, city_lat, city_lng, 4)
+        created_at = anchor - timedelta(days=args.days + rng.randrange(365))
+        user = server.User(
+            id=new_id(rng), email=f"driver{index}@example.com", name=f"Driver {index}",
+            phone=f"+91{7000000000 + index}", role="driver", phone_verified=True, created_at=created_at
+        )
+        driver = server.Driver(
+            id=new_id(rng), user_id=user.id, vehicle_type=rng.choice(["bike", "bike", "scooter", "car"]),
+            license_number=f"DL{index:010d}", vehicle_number=f"{state[:2].upper()} {rng.randint(1, 99):02d} {rng.randint(1000, 9999)}",
+            address=f"{rng.randint(1, 300)} {city}", city=city, state=state, aadhaar_number=f"{rng.randrange(10 ** 12):012d}",
+            current_location=server.Location(lat=lat, lng=lng, address=city), is_verified=rng.random() < 0.9,
+            created_at=created_at
+        )
+        drivers.append({"user": user, "driver": driver, "city": city, "earnings": 0.0, "deliveries": 0, "busy": False})
+    return drivers
+
+def order_status(rng: random.Random, age_minutes: float) -> tuple:
+    """(status, minutes after placement of the last update) for an order placed age_minutes ago"""
+    if age_minutes >= ACTIVE_PIPELINE_MINUTES:
+        if rng.random() < 0.1:
+            return OrderStatus.CANCELLED, rng.uniform(1, 20)
+        return OrderStatus.DELIVERED, rng.uniform(45, 90)
+    
+    status, updated = STATUS_TIMELINE[0]
+    for minutes, step in STATUS_TIMELINE:
+        if age_minutes >= minutes:
+            status, updated = step, minutes
+    if age_minutes >= 45 and rng.random() < 0.7:
+        return OrderStatus.DELIVERED, rng.uniform(45, min(age_minutes, 90))
+    return status, updated
+
+async def seed_orders(rng: random.Random, inserter: BulkInserter, pharmacies: list, customers: list, drivers: list, anchor: datetime):
+    """Orders with earnings and reviews; accumulates driver totals and customer reward points"""
+    pharmacies_by_city = defaultdict(list)
+    for pharmacy in pharmacies:
+        pharmacies_by_city[pharmacy['city']].append(pharmacy)
+    drivers_by_city = defaultdict(list)
+    for driver in drivers:
+        drivers_by_city[driver['city']].append(driver)
+    
+    span_minutes = args.days * 24 * 60
+    for _ in range(scaled(args.orders)):
+        customer = rng.choice(customers)
+        city_pharmacies = pharmacies_by_city.get(customer['city']) or pharmacies
+        pharmacy = rng.choice(city_pharmacies)
+        # Recent orders are denser than old ones (the user base grows)
+        age_minutes = span_minutes * rng.random() ** 1.5
+        created_at = anchor - timedelta(minutes=age_minutes)
+        status, updated_after = order_status(rng, age_minutes)
+        
+        lat, lng = scatter(rng, *customer['home'], 1)
+        distance = server.calculate_distance(lat, lng, pharmacy['lat'], pharmacy['lng'])
+        items = [
+            server.OrderItem(medicine_id=medicine_id, medicine_name=name, quantity=rng.choice([1, 1, 1, 2, 3]), price=price)
+            for medicine_id, name, price in rng.sample(pharmacy['medicines'], min(len(pharmacy['medicines']), rng.choice([1, 1, 2, 2, 3, 4])))
+        ]
+        item_total = round(sum(item.price * item.quantity for item in items), 2)
+        user = customer['user']
+        delivery_fee = server.calculate_delivery_fee(distance, user.is_healer_pro)
+        total_amount = round(item_total + delivery_fee + 5.0, 2)
+        
+        payment_method = rng.choices(
+            [PaymentMethod.CASH_ON_DELIVERY, PaymentMethod.UPI, PaymentMethod.CARD],
+            weights=[45 if distance < 10 else 0, 35, 20]
+        )[0]
+        online = payment_method != PaymentMethod.CASH_ON_DELIVERY
+        paid = online and status != OrderStatus.CANCELLED
+        
+        driver = None
+        if status in (OrderStatus.PICKED_UP, OrderStatus.IN_TRANSIT, OrderStatus.DELIVERED):
+            driver = rng.choice(drivers_by_city.get(customer['city']) or drivers)
+        
+        order = server.Order(
+            id=new_id(rng), customer_id=user.id, pharmacy_id=pharmacy['id'], driver_id=driver['driver'].id if driver else None,
+            items=items, item_total=item_total, delivery_fee=delivery_fee, total_amount=total_amount,
+            points_earned=server.calculate_reward_points(total_amount),
+            delivery_address=server.Location(lat=lat, lng=lng, address=f"{rng.randint(1, 999)} {customer['city']}"),
+            phone=user.phone, status=status, payment_method=payment_method,
+            payment_status="completed" if paid else "pending",
+            razorpay_order_id=f"order_{new_id(rng).replace('-', '')[:14]}" if online else None,
+            razorpay_payment_id=f"pay_{new_id(rng).replace('-', '')[:14]}" if paid else None,
+            distance_km=distance, estimated_time=server.estimate_delivery_time(distance),
+            created_at=created_at, updated_at=created_at + timedelta(minutes=updated_after)
+        )
+        document = server.to_document(order)
+        document['pickup_location'] = server.geo_point(pharmacy['lat'], pharmacy['lng'])
+        if status in (OrderStatus.DELIVERED, OrderStatus.CANCELLED):
+            # No GPS pings are seeded; keep the trail archiver from walking every old order
+            document['trail_archived'] = True
+        await inserter.add("orders", document)
+        
+        if status != OrderStatus.CANCELLED:
+            customer['points'] += order.points_earned
+        if driver and status != OrderStatus.DELIVERED:
+            driver['busy'] = True
+        if status == OrderStatus.DELIVERED:
+            state = driver['driver'].state
+            amount = server.calculate_driver_earning(distance, state)
+            driver['earnings'] += amount
+            driver['deliveries'] += 1
+            await inserter.add("driver_earnings", server.to_document(server.DriverEarning(
+                id=new_id(rng), driver_id=driver['driver'].id, order_id=order.id, amount=amount,
+                distance_km=distance, state=state, created_at=order.updated_at
+            )))
+            if rng.random() < args.review_rate:
+                await inserter.add("driver_reviews", server.to_document(server.DriverReview(
+                    id=new_id(rng), order_id=order.id, driver_id=driver['driver'].id, customer_id=user.id,
+                    rating=rng.choices(range(1, 6), weights=RATING_WEIGHTS)[0],
+                    created_at=order.updated_at + timedelta(minutes=rng.randint(5, 600))
+                )))
+
+async def seed_people(inserter: BulkInserter, customers: list, drivers: list, password_hash: str):
+    """Users and driver profiles, written after orders so totals and points are final"""
+    for customer in customers:
+        document = server.to_document(customer['user'])
+        document['reward_points'] = customer['points']
+        document['password_hash'] = password_hash
+        await inserter.add("users", document)
+    for driver in drivers:
+        user_document = server.to_document(driver['user'])
+        user_document['password_hash'] = password_hash
+        await inserter.add("users", user_document)
+        document = server.to_document(driver['driver'])
+        document['total_earnings'] = round(driver['earnings'], 2)
+        document['total_deliveries'] = driver['deliveries']
+        document['is_available'] = not driver['busy']
+        await inserter.add("drivers", document)
+
+async def main():
+    await server.client.admin.command("ping")
+    if args.drop:
+        await server.client.drop_database(args.db_name)
+    elif await db.users.estimated_document_count():
+        raise SystemExit(f"{args.db_name} already has data; pass --drop to replace it")
+    
+    rng = random.Random(args.seed)
+    anchor = datetime.fromisoformat(args.anchor) if args.anchor else datetime.now(timezone.utc)
+    anchor = anchor.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=anchor.tzinfo or timezone.utc)
+    password_hash = server.pwd_context.hash(args.password)
+    places = build_places()
+    started = time.perf_counter()
+    
+    inserter = BulkInserter(args.writers, args.batch_size)
+    print(f"🌱 seeding {args.db_name} at scale {args.scale} (seed {args.seed}, history ending {anchor.date()})")
+    pharmacies = await seed_pharmacies(rng, inserter, places, password_hash, anchor)
+    customers = generate_customers(rng, places, anchor)
+    drivers = generate_drivers(rng, places, anchor)
+    await seed_orders(rng, inserter, pharmacies, customers, drivers, anchor)
+    await seed_people(inserter, customers, drivers, password_hash)
+    await inserter.close()
+    inserted_seconds = time.perf_counter() - started
+    
+    total = sum(inserter.inserted.values())
+    for collection, count in sorted(inserter.inserted.items()):
+        print(f"   {collection:18} {count:>10,}")
+    print(f"✅ inserted {total:,} documents in {inserted_seconds:.1f}s ({total / inserted_seconds:,.0f}/s)")
+    
+    # The app's startup builds every index; its background loops are not needed here
+    print("🔄 building indexes")
+    await server.startup_db_client()
+    for task in server.background_tasks:
+        task.cancel()
+    await migrate.run(["earnings-rollups", "driver-ratings"])
+    
+    print(f"✨ done in {time.perf_counter() - started:.1f}s; every account uses the password {args.password!r}")
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,233 @@
+"""
+Fixtures for the in-process API tests
+
+The app is driven through httpx's ASGI transport against a scratch database
+on a local mongod (TEST_MONGO_URL, default mongodb://localhost:27017). Every
+test is skipped when no mongod answers, unless TEST_MONGO_REQUIRED=true (as in
+CI), which fails them instead. The database is dropped at the end of the session.
+"""
+
+import os
+import random
+import sys
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import httpx
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+TEST_MONGO_URL = os.environ.get('TEST_MONGO_URL', 'mongodb://localhost:27017')
+TEST_MONGO_REQUIRED = os.environ.get('TEST_MONGO_REQUIRED', 'false').lower() == 'true'
+TEST_DB_NAME = f"healer_test_{uuid.uuid4().hex[:8]}"
+os.environ['MONGO_URL'] = TEST_MONGO_URL
+os.environ['DB_NAME'] = TEST_DB_NAME
+os.environ['DB_DEBUG_HEADERS'] = 'true'  # every response carries X-DB-Queries
+
+import server  # noqa: E402
+from server import db  # noqa: E402
+
+# Representative data sizes for the budget tests
+SEARCH_MATCHES = 1000
+SEARCH_PHARMACIES = 50
+CUSTOMER_ORDERS = 5000
+DRIVER_EARNINGS = 500
+DRIVER_REVIEWS = 200
+CUSTOMER_PASSWORD = "Passw0rd!"
+
+# (request, observed commands, budget) for the summary printed after the run
+OBSERVED_QUERIES = []
+
+def mongo_reachable() -> bool:
+    try:
+        with MongoClient(TEST_MONGO_URL, serverSelectionTimeoutMS=1000) as client:
+            client.admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    # Session scoped so every test shares one event loop with the Motor client
+    return "asyncio"
+
+@pytest.fixture(scope="session")
+async def app():
+    if not mongo_reachable():
+        if TEST_MONGO_REQUIRED:
+            pytest.fail(f"no mongod reachable at {TEST_MONGO_URL}")
+        pytest.skip(f"no mongod reachable at {TEST_MONGO_URL}")
+    await server.startup_db_client()
+    # Background loops would add their own commands to the counts
+    for task in server.background_tasks:
+        task.cancel()
+    yield server.app
+    await server.client.drop_database(TEST_DB_NAME)
+    await server.shutdown_db_client()
+
+@pytest.fixture(scope="session")
+async def api(app):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        yield client
+
+def location(lat: float, lng: float) -> server.Location:
+    return server.Location(lat=lat, lng=lng, address="Test address")
+
+def bearer(token: str) -> dict:
+    return {"Authorization": f"Bearer {token}"}
+
+@pytest.fixture(scope="session")
+async def dataset(app) -> dict:
+    """One customer with CUSTOMER_ORDERS orders, SEARCH_MATCHES searchable medicines over
+    SEARCH_PHARMACIES pharmacies, and a driver with earnings and reviews.
+    
+    Returns {"credentials": customer login, "ids": {...}, "headers": {role: auth headers}}.
+    """
+    rng = random.Random(49)
+    now = datetime.now(timezone.utc)
+    customer = server.User(email="customer@example.com", name="Customer", phone="+919999999999", role="customer")
+    owner = server.User(email="owner@example.com", name="Owner", phone="+919999999998", role="pharmacy")
+    driver_user = server.User(email="driver@example.com", name="Driver", phone="+919999999997", role="driver")
+    
+    pharmacies = [
+        server.Pharmacy(
+            owner_id=owner.id if index == 0 else str(uuid.uuid4()),
+            business_name=f"Pharmacy {index}",
+            location=location(12.97 + rng.uniform(-0.05, 0.05), 77.59 + rng.uniform(-0.05, 0.05)),
+            contact_phone="+910000000000", operating_hours="08:00-22:00", license_number=f"T-{index}"
+        )
+        for index in range(SEARCH_PHARMACIES)
+    ]
+    inactive = server.Pharmacy(
+        owner_id=str(uuid.uuid4()), business_name="Closed Pharmacy", location=location(12.97, 77.59),
+        contact_phone="+910000000000", operating_hours="closed", license_number="T-closed", is_active=False
+    )
+    
+    medicines = [
+        server.Medicine(pharmacy_id=pharmacies[index % SEARCH_PHARMACIES].id, name=f"Paracetamol {index}",
+                        price=round(rng.uniform(10, 100), 2), stock_quantity=10)
+        for index in range(SEARCH_MATCHES)
+    ]
+    medicines += [
+        server.Medicine(pharmacy_id=pharmacy.id, name="Ibuprofen 400mg", price=25.0, stock_quantity=5)
+        for pharmacy in (pharmacies[0], pharmacies[1], inactive)
+    ]
+    
+    driver = server.Driver(
+        user_id=driver_user.id, vehicle_type="bike", license_number="DL-1", vehicle_number="KA 01",
+        address="Bengaluru", city="Bengaluru", state="Karnataka", aadhaar_number="000000000001",
+        current_location=location(12.97, 77.59)
+    )
+    
+    statuses = [server.OrderStatus.PENDING, server.OrderStatus.ACCEPTED, server.OrderStatus.DELIVERED, server.OrderStatus.CANCELLED]
+    orders = []
+    for index in range(CUSTOMER_ORDERS):
+        pharmacy = pharmacies[index % SEARCH_PHARMACIES]
+        medicine = medicines[index % SEARCH_MATCHES]
+        status = statuses[index % len(statuses)]
+        order = server.Order(
+            customer_id=customer.id, pharmacy_id=pharmacy.id,
+            items=[server.OrderItem(medicine_id=medicine.id, medicine_name=medicine.name, quantity=1, price=medicine.price)],
+            item_total=medicine.price, delivery_fee=30.0, platform_fee=5.0, total_amount=medicine.price + 35.0,
+            delivery_address=location(12.98, 77.60), phone=customer.phone,
+            payment_method=server.PaymentMethod.CASH_ON_DELIVERY, distance_km=3.0, estimated_time=20,
+            status=status, driver_id=driver.id if status == server.OrderStatus.DELIVERED else None
+        )
+        document = server.to_document(order)
+        document['created_at'] = now - timedelta(minutes=index)
+        document['pickup_location'] = server.geo_point(pharmacy.location.lat, pharmacy.location.lng)
+        orders.append(document)
+    
+    earnings = [
+        server.to_document(server.DriverEarning(
+            driver_id=driver.id, order_id=str(uuid.uuid4()), amount=50.0, distance_km=3.0, state="Karnataka"
+        ))
+        for _ in range(DRIVER_EARNINGS)
+    ]
+    reviews = [
+        server.to_document(server.DriverReview(
+            order_id=str(uuid.uuid4()), driver_id=driver.id, customer_id=customer.id, rating=rng.randint(1, 5)
+        ))
+        for _ in range(DRIVER_REVIEWS)
+    ]
+    rollups = [
+        {"driver_id": driver.id, "period": "day", "start": server.earnings_bucket_start(now - timedelta(days=day), "day"),
+         "amount": 500.0, "deliveries": 10, "distance_km": 30.0}
+        for day in range(30)
+    ]
+    
+    users = [server.to_document(user) for user in (customer, owner, driver_user)]
+    users[0]['password_hash'] = server.pwd_context.hash(CUSTOMER_PASSWORD)
+    await db.users.insert_many(users)
+    await db.pharmacies.insert_many([server.to_document(pharmacy) for pharmacy in (*pharmacies, inactive)])
+    await db.medicines.insert_many([server.to_document(medicine) for medicine in medicines])
+    await db.drivers.insert_one(server.to_document(driver))
+    await db.orders.insert_many(orders)
+    await db.driver_earnings.insert_many(earnings)
+    await db.driver_reviews.insert_many(reviews)
+    await db.driver_earnings_rollups.insert_many(rollups)
+    
+    return {
+        "credentials": {"email": customer.email, "password": CUSTOMER_PASSWORD},
+        "ids": {
+            "pharmacy_id": pharmacies[0].id,
+            "order_id": orders[0]['id'],
+            "pending_order_id": next(o['id'] for o in orders if o['pharmacy_id'] == pharmacies[0].id and o['status'] == server.OrderStatus.PENDING),
+            "medicine_id": medicines[0].id,
+            "medicine_name": medicines[0].name,
+            "medicine_price": medicines[0].price,
+        },
+        "headers": {
+            "anonymous": {},
+            "customer": bearer(server.create_jwt_token(customer.id, customer.role)),
+            "pharmacy": bearer(server.create_jwt_token(owner.id, owner.role, {"pharmacy_id": pharmacies[0].id})),
+            "driver": bearer(server.create_jwt_token(driver_user.id, driver_user.role, {"driver_id": driver.id, "driver_state": driver.state})),
+        },
+    }
+
+async def within_budget(request, max_queries: int, max_peak_kib: int = None) -> httpx.Response:
+    """Await an API call and fail if it issued more than max_queries Mongo commands
+    or (when given) allocated more than max_peak_kib at its peak.
+    
+    Lowering DB_QUERY_BUDGET for the call makes the app log a per-collection
+    breakdown of the commands when the bound is exceeded.
+    """
+    budget = server.DB_QUERY_BUDGET
+    server.DB_QUERY_BUDGET = max_queries
+    if max_peak_kib is not None:
+        tracemalloc.start()
+    try:
+        response = await request
+        peak_kib = tracemalloc.get_traced_memory()[1] / 1024 if max_peak_kib is not None else None
+    finally:
+        if max_peak_kib is not None:
+            tracemalloc.stop()
+        server.DB_QUERY_BUDGET = budget
+    
+    queries = int(response.headers['x-db-queries'])
+    OBSERVED_QUERIES.append((f"{response.request.method} {response.request.url.path}", queries, max_queries))
+    assert response.status_code < 400, f"{response.status_code}: {response.text[:500]}"
+    assert queries <= max_queries, f"{queries} Mongo commands (budget {max_queries})"
+    if max_peak_kib is not None:
+        assert peak_kib <= max_peak_kib, f"peak allocation {peak_kib:.0f} KiB (budget {max_peak_kib} KiB)"
+    return response
+
+def pytest_terminal_summary(terminalreporter):
+    """Observed vs budgeted commands per request, also written to the CI job summary"""
+    if not OBSERVED_QUERIES:
+        return
+    terminalreporter.section(f"Mongo commands per request ({TEST_MONGO_URL})")
+    for request, queries, budget in OBSERVED_QUERIES:
+        terminalreporter.write_line(f"{queries:>3} / {budget:<3} {request}")
+    
+    summary_path = os.environ.get('GITHUB_STEP_SUMMARY')
+    if summary_path:
+        with open(summary_path, 'a') as summary:
+            summary.write(f"### Mongo commands per request ({TEST_MONGO_URL})\n\n| request | observed | budget |\n|---|---|---|\n")
+            for request, queries, budget in OBSERVED_QUERIES:
+                summary.write(f"| `{request}` | {queries} | {budget} |\n")
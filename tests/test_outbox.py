@@ -0,0 +1,91 @@
+"""
+Delivery payouts through the outbox without transactions
+
+On a standalone mongod the order.delivered event is written just before the
+order turns delivered. A crash in between leaves the event waiting on an
+undelivered order; the payout must still be written once the driver
+completes the delivery again, even if the event went dead in the meantime.
+"""
+
+import uuid
+
+import pytest
+
+import server
+from server import db
+
+from .conftest import bearer, location
+
+pytestmark = pytest.mark.anyio
+
+ALL_PARTITIONS = list(range(server.OUTBOX_PARTITIONS))
+
+@pytest.fixture
+def standalone(monkeypatch):
+    monkeypatch.setattr(server, "_transactions_supported", False)
+
+async def in_transit_order() -> dict:
+    """A driver with one order picked up, and the driver's auth headers"""
+    user = server.User(email=f"{uuid.uuid4().hex[:8]}@example.com", name="Driver", phone="+919999999996", role="driver")
+    driver = server.Driver(
+        user_id=user.id, vehicle_type="bike", license_number="DL-2", vehicle_number="KA 02",
+        address="Bengaluru", city="Bengaluru", state="Karnataka", aadhaar_number="000000000002",
+        current_location=location(12.97, 77.59), is_available=False
+    )
+    order = server.Order(
+        customer_id=str(uuid.uuid4()), pharmacy_id=str(uuid.uuid4()),
+        items=[server.OrderItem(medicine_id=str(uuid.uuid4()), medicine_name="Paracetamol", quantity=1, price=20.0)],
+        item_total=20.0, delivery_fee=30.0, platform_fee=5.0, total_amount=55.0,
+        delivery_address=location(12.98, 77.60), phone=user.phone,
+        payment_method=server.PaymentMethod.CASH_ON_DELIVERY, distance_km=4.0, estimated_time=20,
+        status=server.OrderStatus.IN_TRANSIT, driver_id=driver.id
+    )
+    await db.users.insert_one(server.to_document(user))
+    await db.drivers.insert_one(server.to_document(driver))
+    await db.orders.insert_one(server.to_document(order))
+    headers = bearer(server.create_jwt_token(user.id, user.role, {"driver_id": driver.id, "driver_state": driver.state}))
+    return {"order_id": order.id, "driver_id": driver.id, "headers": headers}
+
+async def enqueue_crashed_payout(order_id: str, driver_id: str):
+    """The event an interrupted complete-delivery leaves behind"""
+    earning = server.DriverEarning(driver_id=driver_id, order_id=order_id, amount=1.0, distance_km=0.1, state="Karnataka")
+    await server.enqueue_outbox_event("order.delivered", order_id, {"earning": server.to_document(earning)})
+
+async def test_undelivered_order_defers_without_using_an_attempt(app, standalone):
+    ids = await in_transit_order()
+    await enqueue_crashed_payout(ids['order_id'], ids['driver_id'])
+    
+    assert await server.drain_outbox_partitions(ALL_PARTITIONS) == 0
+    
+    event = await db.outbox.find_one({"key": f"order.delivered:{ids['order_id']}"})
+    assert event['status'] == "pending"
+    assert event['attempts'] == 0
+    assert event['last_error'] is None
+    assert await db.driver_earnings.count_documents({"order_id": ids['order_id']}) == 0
+
+async def test_redelivery_after_dead_event_pays_once(api, standalone):
+    ids = await in_transit_order()
+    await enqueue_crashed_payout(ids['order_id'], ids['driver_id'])
+    await db.outbox.update_one(
+        {"key": f"order.delivered:{ids['order_id']}"},
+        {"$set": {"status": "dead", "attempts": server.OUTBOX_MAX_ATTEMPTS, "last_error": "order is not delivered yet"}}
+    )
+    
+    response = await api.put(f"/api/orders/{ids['order_id']}/complete-delivery", headers=ids['headers'])
+    assert response.status_code == 200, response.text
+    
+    event = await db.outbox.find_one({"key": f"order.delivered:{ids['order_id']}"})
+    assert event['status'] == "pending"
+    assert event['attempts'] == 0
+    
+    await server.drain_outbox_partitions(ALL_PARTITIONS)
+    
+    event = await db.outbox.find_one({"key": f"order.delivered:{ids['order_id']}"})
+    assert event['status'] == "done"
+    earnings = await db.driver_earnings.find({"order_id": ids['order_id']}).to_list(None)
+    assert len(earnings) == 1
+    # The redelivery's earning replaced the one the crashed attempt recorded
+    assert earnings[0]['amount'] == response.json()['earning']
+    driver = await db.drivers.find_one({"id": ids['driver_id']})
+    assert driver['total_deliveries'] == 1
+    assert driver['total_earnings'] == earnings[0]['amount']
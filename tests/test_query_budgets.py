@@ -0,0 +1,103 @@
+"""
+Mongo command budgets per endpoint
+
+Each request must stay within a fixed number of Mongo commands at the data
+sizes seeded in conftest (1k search matches, 5k orders for one customer).
+A per-item lookup shows up as hundreds of commands and fails here.
+
+Bounds count every command the request issues, authentication included
+(one users lookup for a bearer token). List endpoints allow one getMore
+where the result can exceed the first 101-document batch.
+
+The two large-result tests also bound tracemalloc's peak for the request
+(roughly 3x what they allocate today) to catch accidental copies of the
+whole result set.
+"""
+
+import pytest
+
+from .conftest import CUSTOMER_ORDERS, SEARCH_MATCHES, within_budget
+
+pytestmark = pytest.mark.anyio
+
+READ_BUDGETS = [
+    ("anonymous", "/api/pharmacies", 1),
+    ("anonymous", "/api/medicines?pharmacy_id={pharmacy_id}", 1),
+    ("anonymous", "/api/health/notifications", 0),
+    ("anonymous", "/api/health/revocations", 0),
+    ("anonymous", "/api/health/payments", 1),
+    ("anonymous", "/api/health/outbox", 3),
+    ("anonymous", "/api/health/storage", 8),
+    ("anonymous", "/metrics", 0),
+    ("customer", "/api/auth/me", 1),
+    ("customer", "/api/profile", 1),
+    ("customer", "/api/rewards/summary", 2),
+    ("customer", "/api/customer/addresses", 2),
+    ("customer", "/api/customer/payment-methods", 2),
+    ("customer", "/api/orders/{order_id}", 2),
+    ("customer", "/api/orders/{order_id}/trail", 4),
+    ("pharmacy", "/api/pharmacies/my", 2),
+    ("pharmacy", "/api/medicines/my", 2),
+    ("pharmacy", "/api/orders/my", 3),
+    ("driver", "/api/drivers/my", 2),
+    ("driver", "/api/drivers/available-orders", 3),
+    ("driver", "/api/drivers/earnings", 4),
+    ("driver", "/api/drivers/earnings/rollups", 2),
+    ("driver", "/api/drivers/reviews", 3),
+    ("driver", "/api/drivers/available-trips", 2),
+    ("driver", "/api/orders/my", 3),
+]
+
+@pytest.mark.parametrize("role, path, max_queries", READ_BUDGETS, ids=[f"{role} {path}" for role, path, _ in READ_BUDGETS])
+async def test_read_budget(api, dataset, role, path, max_queries):
+    await within_budget(api.get(path.format(**dataset['ids']), headers=dataset['headers'][role]), max_queries)
+
+async def test_search_with_1k_matches(api, dataset):
+    response = await within_budget(
+        api.get("/api/medicines/search", params={"q": "paracetamol", "lat": 12.97, "lng": 77.59}),
+        max_queries=3,
+        max_peak_kib=16 * 1024
+    )
+    results = response.json()
+    assert len(results) == SEARCH_MATCHES
+    assert all(result['pharmacy']['id'] == result['medicine']['pharmacy_id'] for result in results)
+
+async def test_search_skips_inactive_pharmacies(api, dataset):
+    response = await within_budget(api.get("/api/medicines/search", params={"q": "ibuprofen"}), max_queries=2)
+    assert len(response.json()) == 2
+    assert all(result['pharmacy']['is_active'] for result in response.json())
+
+async def test_my_orders_with_5k_orders(api, dataset):
+    response = await within_budget(
+        api.get("/api/orders/my", headers=dataset['headers']['customer']),
+        max_queries=3,
+        max_peak_kib=24 * 1024
+    )
+    # The endpoint returns the newest 1000
+    orders = response.json()
+    assert len(orders) == min(CUSTOMER_ORDERS, 1000)
+    assert orders[0]['created_at'] >= orders[-1]['created_at']
+
+async def test_login(api, dataset):
+    # users lookup only; customers carry no pharmacy/driver scope
+    await within_budget(api.post("/api/auth/login", json=dataset['credentials']), max_queries=1)
+
+async def test_place_order(api, dataset):
+    ids = dataset['ids']
+    body = {
+        "pharmacy_id": ids['pharmacy_id'],
+        "items": [{"medicine_id": ids['medicine_id'], "medicine_name": ids['medicine_name'], "quantity": 2, "price": ids['medicine_price']}],
+        "delivery_address": {"lat": 12.98, "lng": 77.60, "address": "Test address"},
+        "payment_method": "cash_on_delivery",
+        "phone": "+919999999999",
+    }
+    # auth, users, pharmacies, order insert, outbox insert (+ commitTransaction on a replica set)
+    await within_budget(api.post("/api/orders", json=body, headers=dataset['headers']['customer']), max_queries=6)
+
+async def test_update_order_status(api, dataset):
+    path = f"/api/orders/{dataset['ids']['pending_order_id']}/status"
+    await within_budget(api.put(path, params={"status": "accepted"}, headers=dataset['headers']['pharmacy']), max_queries=3)
+
+async def test_driver_location_ping(api, dataset):
+    body = {"lat": 12.971, "lng": 77.591, "address": "en route"}
+    await within_budget(api.put("/api/drivers/location", json=body, headers=dataset['headers']['driver']), max_queries=4)